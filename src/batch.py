@@ -0,0 +1,217 @@
+"""
+Batch runner for reviewing whole example corpora concurrently.
+
+Reviews are almost entirely network wait, so examples are run on a thread pool with a bounded
+number of in-flight reviews. Results are appended to a JSONL file as each review finishes.
+
+Usage:
+    python -m src.batch examples/*.yaml -o results.jsonl -j 8
+"""
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from contextvars import copy_context
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, TypeVar
+import argparse
+import json
+import random
+import time
+
+from .utils import Example, Span, serialize_span, example_id
+from .catalog import iter_examples
+from . import telemetry
+
+import pdb
+
+
+R = TypeVar('R')
+
+
+@dataclass
+class BatchItem:
+    path: Path
+    index: int
+    example: Example
+
+
+@dataclass
+class BatchResult:
+    path: str
+    index: int
+    query: str
+    example: str  # see `example_id`
+    spans: list[Span] | None
+    error: str | None
+    elapsed: float
+    attempts: int
+
+
+def serialize_result(result: BatchResult) -> dict:
+    return {
+        'path': result.path,
+        'index': result.index,
+        'query': result.query,
+        'example': result.example,
+        'spans': None if result.spans is None else [serialize_span(span) for span in result.spans],
+        'error': result.error,
+        'elapsed': result.elapsed,
+        'attempts': result.attempts,
+    }
+
+
+def iter_batch_items(paths: Iterable[Path]) -> Iterator[BatchItem]:
+    """Yield every example from each of the given example files, tagged with its file and index"""
+    for path, index, example in iter_examples(paths):
+        yield BatchItem(path=path, index=index, example=example)
+
+
+def is_rate_limit_error(err: BaseException) -> bool:
+    """Best effort check for whether an error from a provider SDK is a rate limit (HTTP 429) error"""
+    status = getattr(err, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(err, 'response', None), 'status_code', None)
+    if status == 429:
+        return True
+    name = type(err).__name__.lower()
+    return 'ratelimit' in name or 'rate limit' in str(err).lower()
+
+
+def run_with_backoff(
+    fn: Callable[[], R],
+    *,
+    max_retries: int = 5,
+    base_delay: float = 1.0,
+    max_delay: float = 60.0,
+) -> R:
+    """
+    Call `fn`, retrying with jittered exponential backoff whenever it fails with a rate limit error.
+
+    Args:
+        fn (Callable[[], R]): the function to call
+        max_retries (int, optional): maximum number of retries after the first attempt. Defaults to 5.
+        base_delay (float, optional): delay in seconds before the first retry. Doubles on each retry. Defaults to 1.0.
+        max_delay (float, optional): upper bound on the delay between retries. Defaults to 60.0.
+
+    Returns:
+        R: the result of `fn`
+    """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return fn()
+        except Exception as err:
+            if attempt > max_retries or not is_rate_limit_error(err):
+                raise
+            delay = min(max_delay, base_delay * 2 ** (attempt - 1))
+            time.sleep(delay * random.uniform(0.5, 1.0))
+
+
+def review_batch(
+    paths: Iterable[Path],
+    output: Path,
+    *,
+    concurrency: int = 8,
+    max_retries: int = 5,
+    base_delay: float = 1.0,
+    review: Callable[[Example], list[Span]] | None = None,
+) -> list[BatchResult]:
+    """
+    Review every example in the given example files concurrently.
+
+    Each result is appended to `output` (JSONL, one result per line) as soon as its review finishes,
+    so partial results survive an interrupted run. A failed review is recorded with its error rather
+    than aborting the rest of the batch.
+
+    Args:
+        paths (Iterable[Path]): example yaml files to review
+        output (Path): JSONL file to append results to
+        concurrency (int, optional): maximum number of reviews in flight at once. Defaults to 8.
+        max_retries (int, optional): retries per example on rate limit errors. Defaults to 5.
+        base_delay (float, optional): initial backoff delay in seconds for rate limit retries. Defaults to 1.0.
+        review (Callable[[Example], list[Span]], optional): the review function to run. Defaults to `review_code`.
+
+    Returns:
+        list[BatchResult]: the results, in the order they finished
+    """
+    if review is None:
+        from .review import review_code
+        review = review_code
+
+    def run(item: BatchItem) -> BatchResult:
+        attempts = 0
+        def attempt() -> list[Span]:
+            nonlocal attempts
+            attempts += 1
+            return review(item.example)
+
+        t0 = time.perf_counter()
+        spans, error = None, None
+        with telemetry.span('batch.review', path=str(item.path), index=item.index):
+            try:
+                spans = run_with_backoff(attempt, max_retries=max_retries, base_delay=base_delay)
+            except Exception as err:
+                error = f'{type(err).__name__}: {err}'
+            telemetry.add('batch.attempts', attempts)
+        return BatchResult(
+            path=str(item.path),
+            index=item.index,
+            query=item.example['query'],
+            example=example_id(item.example),
+            spans=spans,
+            error=error,
+            elapsed=time.perf_counter() - t0,
+            attempts=attempts,
+        )
+
+    results: list[BatchResult] = []
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'a') as f, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # each review runs in a copy of the caller's context (e.g. so cache.disabled() applies to it)
+        futures = [pool.submit(copy_context().run, run, item) for item in iter_batch_items(paths)]
+        for future in as_completed(futures):
+            result = future.result()
+            f.write(json.dumps(serialize_result(result)) + '\n')
+            f.flush()
+            results.append(result)
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Review every example in one or more example files concurrently')
+    parser.add_argument('paths', nargs='+', type=Path, help='example yaml files to review')
+    parser.add_argument('-o', '--output', type=Path, default=Path('review_results.jsonl'), help='JSONL file to append results to')
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help='maximum number of reviews in flight at once')
+    parser.add_argument('--max-retries', type=int, default=5, help='retries per example on rate limit errors')
+    parser.add_argument('--base-delay', type=float, default=1.0, help='initial backoff delay (seconds) for rate limit retries')
+    parser.add_argument('--parallel-tasks', action='store_true', help='also run the review tasks of each example concurrently')
+    parser.add_argument('--trace', type=Path, help='record a trace of the run (timings, tokens, tool calls, cache hits) to this file')
+    parser.add_argument('--trace-format', choices=['jsonl', 'otel'], default='jsonl', help='trace file format: one span per line, or an OTLP/JSON document')
+    args = parser.parse_args(argv)
+
+    review = None
+    if args.parallel_tasks:
+        from .review import review_code
+        review = lambda example: review_code(example, parallel=True)
+
+    trace = telemetry.tracing(args.trace, args.trace_format) if args.trace else nullcontext()
+    t0 = time.perf_counter()
+    with trace as tracer:
+        results = review_batch(
+            args.paths,
+            args.output,
+            concurrency=args.concurrency,
+            max_retries=args.max_retries,
+            base_delay=args.base_delay,
+            review=review,
+        )
+    n_failed = sum(result.error is not None for result in results)
+    print(f'reviewed {len(results)} examples ({n_failed} failed) in {time.perf_counter() - t0:.1f}s -> {args.output}')
+    if tracer is not None:
+        print(f'trace -> {args.trace}: {json.dumps(tracer.summary()["counters"])}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+"""
+Offline benchmarks: end-to-end reviews against a deterministic stand-in LLM (see fake_llm), microbenchmarks
+of the CPU-bound pieces (span resolution, overlap merging, line numbering, example loading, the disk cache),
+and the size of the review prompts.
+
+Nothing here touches the network or the real review cache, so runs are repeatable and can be compared
+across commits:
+
+    python -m src.bench --out before.jsonl
+    ... make changes ...
+    python -m src.bench --out after.jsonl --compare before.jsonl
+"""
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable
+import argparse
+import json
+import random
+import statistics
+import time
+
+from .utils import Example, Span, VagueSpan, SpanResolver, pinpoint_span, add_line_numbers, load_examples, estimate_tokens
+from .display import handle_overlaps
+from .cache import diskcache, disabled
+from .catalog import Catalog
+from .spanset import SpanSet
+
+import pdb
+
+
+here = Path(__file__).parent
+examples_dir = here.parent / 'examples'
+
+
+@dataclass
+class BenchResult:
+    name: str
+    ops: int            # operations per run
+    seconds: float      # best wall time over the repeats
+    median: float       # median wall time over the repeats
+    params: dict
+
+    @property
+    def us_per_op(self) -> float:
+        return self.seconds / self.ops * 1e6
+
+
+def timeit(name: str, fn: Callable[[], object], ops: int = 1, repeat: int = 5, **params) -> BenchResult:
+    """Run `fn` `repeat` times and record the best and median wall time"""
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return BenchResult(name=name, ops=ops, seconds=min(times), median=statistics.median(times), params=params)
+
+
+def load_corpus() -> list[Example]:
+    return [example for path in sorted(examples_dir.glob('*.yaml')) for example in load_examples(path)]
+
+
+def synthetic_code(corpus: list[Example], n_lines: int) -> str:
+    """a program of about `n_lines` lines, made by concatenating the example programs"""
+    lines: list[str] = []
+    while len(lines) < n_lines:
+        for example in corpus:
+            lines.extend(example['code'].splitlines())
+    return '\n'.join(lines[:n_lines])
+
+
+def perturb(quote: str, rng: random.Random) -> str:
+    """mangle a quote the way models tend to: reflowed whitespace and the odd wrong character"""
+    chars = list(' '.join(quote.split()))
+    for _ in range(max(1, len(chars) // 40)):
+        i = rng.randrange(len(chars))
+        chars[i] = rng.choice('abcdefghijklmnopqrstuvwxyz')
+    return ''.join(chars)
+
+
+def vague_spans(code: str, n: int, rng: random.Random, fuzzy: bool = False) -> list[VagueSpan]:
+    lines = code.splitlines()
+    spans: list[VagueSpan] = []
+    while len(spans) < n:
+        start = rng.randrange(len(lines))
+        quote = '\n'.join(lines[start:start + rng.randint(1, 4)])
+        if len(quote.strip()) < 20:
+            continue
+        spans.append(VagueSpan(start_line=start + 1, quote=perturb(quote, rng) if fuzzy else quote, reason='bench'))
+    return spans
+
+
+def random_spans(n: int, length: int, rng: random.Random) -> list[Span]:
+    spans = []
+    for _ in range(n):
+        start = rng.randrange(length)
+        spans.append(Span(start, min(length, start + rng.randint(1, 400)), f'reason {rng.randrange(50)}', rng.randrange(5)))
+    return spans
+
+
+def bench_micro(corpus: list[Example], scale: float = 1.0, repeat: int = 5) -> list[BenchResult]:
+    rng = random.Random(0)
+    n = lambda base: max(1, int(base * scale))
+    results = []
+
+    code = synthetic_code(corpus, n(5000))
+    exact = vague_spans(code, n(500), rng)
+    fuzzy = vague_spans(code, n(50), rng, fuzzy=True)
+    resolver = SpanResolver(code)
+
+    def resolve_all(spans: list[VagueSpan]):
+        for span in spans:
+            try:
+                resolver.resolve(span)
+            except ValueError:
+                pass
+
+    results.append(timeit('resolver.exact', lambda: resolve_all(exact), ops=len(exact), repeat=repeat, lines=n(5000)))
+    results.append(timeit('resolver.fuzzy', lambda: resolve_all(fuzzy), ops=len(fuzzy), repeat=repeat, lines=n(5000)))
+    few = exact[:n(50)]
+    def pinpoint_all():
+        for span in few:
+            pinpoint_span(span, code)
+    results.append(timeit('pinpoint_span.exact', pinpoint_all, ops=len(few), repeat=repeat, lines=n(5000)))
+
+    spans = random_spans(n(20000), len(code), rng)
+    for policy in ('nest', 'merge', 'distinct'):
+        results.append(timeit(f'handle_overlaps.{policy}', lambda: handle_overlaps(spans, policy), ops=len(spans), repeat=repeat, spans=len(spans)))
+    span_set = SpanSet.from_spans(spans)
+    results.append(timeit('spanset.merge', lambda: span_set.merged('merge'), ops=len(spans), repeat=repeat, spans=len(spans)))
+    results.append(timeit('spanset.sort', span_set.sorted, ops=len(spans), repeat=repeat, spans=len(spans)))
+    results.append(timeit('spanset.serialize', lambda: json.dumps(span_set.to_dict()), ops=len(spans), repeat=repeat, spans=len(spans)))
+
+    big = synthetic_code(corpus, n(50000))
+    results.append(timeit('add_line_numbers', lambda: add_line_numbers(big), ops=n(50000), repeat=repeat, lines=n(50000)))
+
+    with TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'examples.yaml'
+        copies = (corpus * (n(1000) // len(corpus) + 1))[:n(1000)]
+        path.write_text(''.join(
+            f'- query: {json.dumps(example["query"])}\n  code: {json.dumps(example["code"])}\n' for example in copies
+        ))
+        results.append(timeit('load_examples', lambda: load_examples(path), ops=len(copies), repeat=repeat, examples=len(copies)))
+        catalog = Catalog(Path(tmp) / 'bench.catalog')
+        results.append(timeit('catalog.compile', lambda: catalog.refresh(path), ops=len(copies), repeat=1, examples=len(copies)))
+        indices = [rng.randrange(len(copies)) for _ in range(n(1000))]
+        results.append(timeit('catalog.get', lambda: [catalog.get(path, i) for i in indices], ops=len(indices), repeat=repeat, examples=len(copies)))
+        results.append(timeit('catalog.iter', lambda: sum(1 for _ in catalog.iter([path])), ops=len(copies), repeat=repeat, examples=len(copies)))
+        catalog.close()
+
+        @diskcache(cache_path=Path(tmp) / 'bench.cache', memory_size=0, auto_compact=False)
+        def split_lines(example: Example) -> list[str]:
+            return example['code'].splitlines()
+
+        store = split_lines.cache  # type: ignore[attr-defined]
+        value = json.dumps(copies[0]['code'].splitlines())
+        results.append(timeit('diskcache.set', lambda: [store.set(str(i), value, 'bench') for i in range(n(1000))], ops=n(1000), repeat=1))
+        results.append(timeit('diskcache.get', lambda: [store.get(str(i), 'bench') for i in range(n(1000))], ops=n(1000), repeat=repeat))
+        results.append(timeit('diskcache.call', lambda: [split_lines(example) for example in copies], ops=len(copies), repeat=repeat))
+        store.close()
+
+    return results
+
+
+def bench_e2e(latency: float, concurrency: int, spans_per_task: int, repeat: int = 1) -> list[BenchResult]:
+    """Review every example in examples/ through the batch runner, against the stand-in model with the given per-turn latency"""
+    from . import review as review_module
+    from .batch import review_batch
+    from .fake_llm import SyntheticResponder, register_fake_model
+
+    name = register_fake_model('bench', lambda: SyntheticResponder(spans_per_task), latency=latency)
+    paths = sorted(examples_dir.glob('*.yaml'))
+    results = []
+    model, review_module.MODEL = review_module.MODEL, name
+    try:
+        for parallel in (False, True):
+            for _ in range(repeat):
+                with disabled(), TemporaryDirectory() as tmp:
+                    t0 = time.perf_counter()
+                    batch = review_batch(
+                        paths, Path(tmp) / 'results.jsonl', concurrency=concurrency,
+                        review=lambda example: review_module.review_code(example, parallel=parallel),
+                    )
+                    wall = time.perf_counter() - t0
+                errors = [result.error for result in batch if result.error is not None]
+                if errors:
+                    raise RuntimeError(f'{len(errors)} reviews failed, e.g. {errors[0]}')
+                elapsed = sorted(result.elapsed for result in batch)
+                results.append(BenchResult(
+                    name=f'e2e.{"parallel" if parallel else "sequential"}',
+                    ops=len(batch),
+                    seconds=wall,
+                    median=statistics.median(elapsed),
+                    params={
+                        'latency': latency,
+                        'concurrency': concurrency,
+                        'p95': elapsed[int(0.95 * (len(elapsed) - 1))],
+                        'spans': sum(len(result.spans or []) for result in batch),
+                        'throughput': len(batch) / wall,
+                    },
+                ))
+    finally:
+        review_module.MODEL = model
+    return results
+
+
+def bench_prompts(corpus: list[Example], issue_examples: int = 8, repeat: int = 5) -> list[BenchResult]:
+    """Tokens in each example's review prompt with the whole issue catalog vs. only its most relevant entries (see issues.py)"""
+    from langchain_core.messages import HumanMessage
+    from . import review as review_module
+
+    def prompt_tokens(k: int | None) -> list[int]:
+        review_module.ISSUE_EXAMPLES = k
+        return [estimate_tokens([HumanMessage(content=review_module.review_prompt(example))]) for example in corpus]
+
+    setting = review_module.ISSUE_EXAMPLES
+    try:
+        full = prompt_tokens(None)
+        result = timeit('prompts.issue_examples', lambda: prompt_tokens(issue_examples), ops=len(corpus), repeat=repeat)
+        selected = prompt_tokens(issue_examples)
+    finally:
+        review_module.ISSUE_EXAMPLES = setting
+    result.params = {
+        'issue_examples': issue_examples,
+        'full_tokens': statistics.mean(full),
+        'selected_tokens': statistics.mean(selected),
+        'reduction': 1 - sum(selected) / sum(full),
+    }
+    return [result]
+
+
+def serialize_result(result: BenchResult) -> dict:
+    return {**asdict(result), 'us_per_op': result.us_per_op}
+
+
+def report(results: list[BenchResult], baseline: dict[str, dict] | None = None) -> None:
+    for result in results:
+        line = f'{result.name:24} {result.seconds*1e3:10.2f} ms  {result.us_per_op:12.2f} us/op'
+        if baseline and result.name in baseline:
+            line += f'  x{baseline[result.name]["seconds"] / result.seconds:.2f} vs baseline'
+        extra = {k: round(v, 3) if isinstance(v, float) else v for k, v in result.params.items()}
+        print(f'{line}  {extra}')
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Run the offline benchmark suite')
+    parser.add_argument('--only', choices=['micro', 'e2e', 'prompts'], help='only run one group of benchmarks')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier on microbenchmark input sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats per microbenchmark (best is reported)')
+    parser.add_argument('--latency', type=float, default=0.05, help='injected seconds per model turn for e2e runs')
+    parser.add_argument('-j', '--concurrency', type=int, default=8, help='examples in flight at once for e2e runs')
+    parser.add_argument('--spans-per-task', type=int, default=3, help='spans the stand-in model selects per task')
+    parser.add_argument('--issue-examples', type=int, default=8, help='issue catalog entries per prompt for the prompt size benchmark')
+    parser.add_argument('--out', type=Path, help='JSONL file to append results to')
+    parser.add_argument('--compare', type=Path, help='JSONL results of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    results = []
+    if args.only in (None, 'micro'):
+        results += bench_micro(load_corpus(), scale=args.scale, repeat=args.repeat)
+    if args.only in (None, 'e2e'):
+        results += bench_e2e(args.latency, args.concurrency, args.spans_per_task)
+    if args.only in (None, 'prompts'):
+        results += bench_prompts(load_corpus(), args.issue_examples, repeat=args.repeat)
+
+    baseline = None
+    if args.compare:
+        # the last entry per name wins, so a file that has been appended to across runs compares against the latest
+        baseline = {entry['name']: entry for entry in map(json.loads, args.compare.read_text().splitlines()) if entry}
+    report(results, baseline)
+
+    if args.out:
+        with open(args.out, 'a') as f:
+            for result in results:
+                f.write(json.dumps(serialize_result(result)) + '\n')
+
+
+if __name__ == '__main__':
+    main()
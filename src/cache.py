@@ -1,9 +1,22 @@
 # from .path import Path, p, here
 import atexit
-from typing import Callable, TypeVar, ParamSpec, overload
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import IO, Any, Callable, Iterable, Iterator, TypeVar, ParamSpec, overload
+from concurrent.futures import Future
+import hashlib
 import inspect
+import os
 import platform
 import json
+import sqlite3
+import sys
+import threading
+import time
+
+from . import telemetry
 
 from pathlib import Path
 
@@ -53,83 +66,646 @@ def freeze(obj):
         raise TypeError(f"Unhashable and unfreezable type: ({type(obj)}): {obj}")
 
 
-
 Serializable = dict | list | str | int | float | bool | None
 
+KEY_VERSION = 2  # bump whenever the way keys are computed changes, so entries with old style keys become stale
+BLOB_THRESHOLD = 256  # strings in the arguments longer than this are stored once in the blob table rather than in every entry
+
+
+def digest(data: str) -> str:
+    return hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+
+
+def make_key(args: tuple, kwargs: dict) -> tuple[str, object]:
+    """
+    Compute the content addressed cache key for a set of arguments.
+
+    Returns:
+        tuple[str, object]: the fixed size key (a digest of the canonical encoding of the arguments), and the frozen arguments
+    """
+    frozen = freeze((tuple(args), tuple(sorted(kwargs.items()))))
+    return digest(json.dumps(frozen)), frozen
+
+
+def subject_digest(value: object) -> str:
+    """Digest of a function's first argument, by which cache entries can be looked up whatever the rest of their arguments (see `DiskStore.latest`)"""
+    return digest(json.dumps(freeze(value)))
+
+
+def extract_blobs(obj, blobs: dict[str, str]) -> Serializable:
+    """Replace any large strings in a frozen object with {"$blob": digest} references, collecting the strings into blobs"""
+    if isinstance(obj, str) and len(obj) > BLOB_THRESHOLD:
+        blob_digest = digest(obj)
+        blobs[blob_digest] = obj
+        return {'$blob': blob_digest}
+    if isinstance(obj, (tuple, list)):
+        return [extract_blobs(item, blobs) for item in obj]
+    return obj
+
+
+def restore_blobs(obj: Serializable, blobs: dict[str, str]) -> Serializable:
+    """Inverse of `extract_blobs`"""
+    if isinstance(obj, dict) and '$blob' in obj:
+        return blobs[obj['$blob']]
+    if isinstance(obj, list):
+        return [restore_blobs(item, blobs) for item in obj]
+    return obj
+
+
 identity = lambda x: x  # type: ignore
 
-# TODO: diskcache should hash the function body and save it in the cache file, so it knows to invalidate the cache if the hash doesn't match
+
+class _Missing: ...
+MISSING = _Missing()  # sentinel for a key not being in the cache
+
+
+_enabled: ContextVar[bool] = ContextVar('diskcache_enabled', default=True)
+
+@contextmanager
+def disabled():
+    """Within this context (and any tasks/threads that copy it), diskcache'd functions always recompute and never store results"""
+    token = _enabled.set(False)
+    try:
+        yield
+    finally:
+        _enabled.reset(token)
+
+
+class FileLock:
+    """
+    Exclusive lock on a file, shared between threads and processes.
+    Uses flock on posix and msvcrt.locking on windows, so the lock is released if the holding process dies.
+
+    If `remove`, the file is deleted when the lock is released (where the OS allows deleting an open file), so
+    locks on short lived names (e.g. one per cache key) don't pile up. Waiters that were holding the deleted file
+    open notice, and retry on the path's new file.
+    """
+    def __init__(self, path: Path, remove: bool = False):
+        self.path = path
+        self.remove = remove
+        self._file: IO[str] | None = None
+
+    def __enter__(self) -> 'FileLock':
+        while True:
+            self._file = open(self.path, 'a+')
+            self._lock()
+            if not self.remove or self._is_current():
+                return self
+            self._unlock()  # the file was removed (and maybe recreated) while waiting on it
+
+    def __exit__(self, *exc) -> None:
+        if self.remove:
+            try:
+                self.path.unlink()
+            except OSError:
+                pass  # e.g. windows doesn't allow deleting a file that is open
+        self._unlock()
+
+    def _is_current(self) -> bool:
+        """whether the locked file is (still) the one at self.path"""
+        assert self._file is not None
+        try:
+            return os.path.samestat(os.fstat(self._file.fileno()), os.stat(self.path))
+        except FileNotFoundError:
+            return False
+
+    def _lock(self) -> None:
+        assert self._file is not None
+        if sys.platform == 'win32':
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after ~10s. keep waiting
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+
+    def _unlock(self) -> None:
+        assert self._file is not None
+        if sys.platform == 'win32':
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class DiskStore:
+    """
+    SQLite backed key/value store holding the cache for a single function.
+
+    Nothing is read from disk until the first lookup, and only the entries that are actually looked up
+    are ever loaded. Entries are keyed by a fixed size digest of their arguments (see `make_key`), and values
+    are stored as JSON text. Large strings in the arguments are stored once in a separate blob table. Entries
+    are also indexed by their first argument, e.g. to find the latest result for an input under any settings, and
+optionally by a tag computed from the arguments, e.g. to find the results for related inputs without loading the rest.
+
+    Safe to share between threads (each thread gets its own connection) and processes (SQLite handles
+    locking, and each write is its own transaction).
+
+    A `readonly` store never creates, migrates or writes to the file, e.g. for inspecting a cache from the CLI.
+    """
+    SQLITE_HEADER = b'SQLite format 3\x00'
+    COLUMNS = {
+        'args': 'TEXT',                         # the arguments (JSON), with large strings replaced by references into the blobs table
+        'fingerprint': 'TEXT',                  # fingerprint of the function (and its dependencies) that computed the value
+        'created_at': 'REAL NOT NULL DEFAULT 0',  # unix time the value was stored
+        'size': 'INTEGER NOT NULL DEFAULT 0',     # bytes of key + value
+        'subject': 'TEXT',                      # `subject_digest` of the first argument (however it was passed), if any
+        'tag': 'TEXT',                          # the function's `tag` of the arguments (see `diskcache`), if any
+    }
+
+    def __init__(self, path: Path, timeout: float = 60.0, readonly: bool = False):
+        self.path = path
+        self.timeout = timeout  # how long to wait on another process holding the database lock
+        self.readonly = readonly
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection | None = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        with self._init_lock:
+            if not self._initialized:
+                if not self.readonly:
+                    self._initialize()
+                self._initialized = True
+                atexit.register(self.close)
+            if self.readonly:
+                conn = sqlite3.connect(f'{self.path.resolve().as_uri()}?mode=ro', uri=True, timeout=self.timeout, check_same_thread=False)
+            else:
+                conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self._connections.append(conn)
+        self._local.conn = conn
+        return conn
+
+    def _initialize(self) -> None:
+        """Create the database (importing any legacy JSONL cache). Serialized across processes by a lock file"""
+        with FileLock(self.path.with_name(self.path.name + '.lock')):
+            legacy_lines = self._take_legacy_lines()
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            try:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                # columns added after the table was first introduced
+                columns = {row[1] for row in conn.execute('PRAGMA table_info(entries)')}
+                for column, decl in self.COLUMNS.items():
+                    if column not in columns:
+                        conn.execute(f'ALTER TABLE entries ADD COLUMN {column} {decl}')
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_subject ON entries (subject, created_at)')
+                conn.execute('CREATE INDEX IF NOT EXISTS entries_tag ON entries (tag, fingerprint, created_at)')
+                # large argument payloads (e.g. source code) are stored once, no matter how many entries use them
+                conn.execute('CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, data TEXT NOT NULL)')
+                conn.execute('CREATE TABLE IF NOT EXISTS entry_blobs (key TEXT NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (key, digest))')
+                if legacy_lines:
+                    # legacy entries have no fingerprint, so they are treated as stale
+                    now = time.time()
+                    rows = []
+                    for args, value in map(json.loads, legacy_lines):
+                        args, value = json.dumps(args), json.dumps(value)
+                        rows.append((digest(args), args, value, now, len(args) + len(value)))
+                    conn.executemany('INSERT OR REPLACE INTO entries (key, args, value, created_at, size) VALUES (?, ?, ?, ?, ?)', rows)
+                if legacy_lines or 'subject' not in columns:
+                    self._backfill_subjects(conn)
+                conn.commit()
+            finally:
+                conn.close()
+
+    @staticmethod
+    def _backfill_subjects(conn: sqlite3.Connection) -> None:
+        """
+        Index the entries stored before subjects were recorded. The store doesn't know the function's parameter names,
+        so only entries whose first argument was passed by position can be indexed
+        """
+        rows = []
+        for key, args in conn.execute('SELECT key, args FROM entries WHERE subject IS NULL AND args IS NOT NULL').fetchall():
+            call = json.loads(args)
+            if isinstance(call, list) and call and call[0]:
+                blobs = dict(conn.execute(
+                    'SELECT blobs.digest, blobs.data FROM entry_blobs JOIN blobs ON entry_blobs.digest = blobs.digest WHERE entry_blobs.key = ?',
+                    (key,),
+                ))
+                rows.append((digest(json.dumps(restore_blobs(call[0][0], blobs))), key))
+        conn.executemany('UPDATE entries SET subject = ? WHERE key = ?', rows)
+
+    def _take_legacy_lines(self) -> list[str]:
+        """If path holds a cache in the old JSONL format, move it aside (to <path>.jsonl) and return its lines for import"""
+        try:
+            with open(self.path, 'rb') as f:
+                header = f.read(len(self.SQLITE_HEADER))
+        except FileNotFoundError:
+            return []
+        if header == self.SQLITE_HEADER:
+            return []
+        legacy_path = self.path.with_name(self.path.name + '.jsonl')
+        self.path.rename(legacy_path)
+        return legacy_path.read_text().splitlines()
+
+    def key_lock(self, key: str) -> FileLock:
+        """Inter-process lock for computing the value of a single key. Its lock file is removed again once released"""
+        lock_dir = self.path.with_name(self.path.name + '.locks')
+        lock_dir.mkdir(exist_ok=True)
+        return FileLock(lock_dir / f'{key}.lock', remove=True)
+
+    def get(self, key: str, fingerprint: str) -> str | None:
+        """Get the JSON encoded value for the given key, or None if the key is not in the store (or its entry is stale)"""
+        row = self._connect().execute('SELECT value FROM entries WHERE key = ? AND fingerprint = ?', (key, fingerprint)).fetchone()
+        return None if row is None else row[0]
+
+    def peek(self, key: str) -> str | None:
+        """Get the JSON encoded value for the given key regardless of its fingerprint (i.e. even if it is stale)"""
+        row = self._connect().execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set(
+        self, key: str, value: str, fingerprint: str, args: str = 'null', blobs: dict[str, str] | None = None,
+        subject: str | None = None, tag: str | None = None,
+    ) -> None:
+        """
+        Store the JSON encoded value for the given key, replacing any existing value
+
+        Args:
+            key (str): the key digest
+            value (str): the JSON encoded value
+            fingerprint (str): fingerprint of the function that computed the value
+            args (str, optional): JSON encoded arguments the value was computed from, possibly with blob references
+            blobs (dict[str, str], optional): any large strings referenced by args, keyed by their digest
+            subject (str, optional): `subject_digest` of the first argument, to look the entry up by (see `latest`)
+            tag (str, optional): another key to look the entry up by (see `tagged`)
+        """
+        blobs = blobs or {}
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO blobs (digest, data) VALUES (?, ?)', blobs.items())
+            conn.execute('DELETE FROM entry_blobs WHERE key = ?', (key,))
+            conn.executemany('INSERT INTO entry_blobs (key, digest) VALUES (?, ?)', [(key, blob_digest) for blob_digest in blobs])
+            conn.execute(
+                'INSERT OR REPLACE INTO entries (key, args, value, fingerprint, created_at, size, subject, tag) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, args, value, fingerprint, time.time(), len(key) + len(args) + len(value), subject, tag),
+            )
+
+    def items(self) -> Iterator[tuple[str, str | None, str]]:
+        """Iterate over every entry (including stale ones) as (key, fingerprint, JSON encoded value), oldest first"""
+        yield from self._connect().execute('SELECT key, fingerprint, value FROM entries ORDER BY created_at')
+
+    def latest(self, subject: str) -> tuple[str, str | None, str] | None:
+        """The newest entry (including stale ones) whose first argument has the given `subject_digest`, as (key, fingerprint, JSON encoded value)"""
+        return self._connect().execute(
+            'SELECT key, fingerprint, value FROM entries WHERE subject = ? ORDER BY created_at DESC LIMIT 1', (subject,)
+        ).fetchone()
+
+    def tagged(self, tag: str, fingerprint: str) -> Iterator[tuple[str, str]]:
+        """Iterate over the current (non-stale) entries with the given tag as (key, JSON encoded value), newest first"""
+        yield from self._connect().execute(
+            'SELECT key, value FROM entries WHERE tag = ? AND fingerprint = ? ORDER BY created_at DESC', (tag, fingerprint)
+        )
+
+    def load_args(self, key: str) -> Serializable:
+        """Get the (JSON decoded) arguments the entry for the given key was computed from, with any blobs restored"""
+        conn = self._connect()
+        row = conn.execute('SELECT args FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        blobs = dict(conn.execute(
+            'SELECT blobs.digest, blobs.data FROM entry_blobs JOIN blobs ON entry_blobs.digest = blobs.digest WHERE entry_blobs.key = ?',
+            (key,),
+        ))
+        return restore_blobs(json.loads(row[0]), blobs)
+
+    def load_call(self, key: str) -> tuple[list, dict[str, Serializable]]:
+        """Get the positional and keyword arguments the entry for the given key was computed from (see `load_args`)"""
+        call = self.load_args(key)
+        assert isinstance(call, list) and len(call) == 2, f'malformed arguments for {key}: {call!r}'
+        args, kwargs = call
+        assert isinstance(args, list) and isinstance(kwargs, list)
+        # frozen dicts (including the kwargs) are stored as lists of [key, value] pairs
+        return args, {name: value for name, value in kwargs}
+
+    def compact(
+        self,
+        fingerprint: str | None = None,
+        *,
+        max_entries: int | None = None,
+        max_bytes: int | None = None,
+        max_age: float | None = None,
+    ) -> int:
+        """
+        Remove stale and evicted entries, and reclaim their space on disk.
+
+        Args:
+            fingerprint (str, optional): the current fingerprint. If given, entries with any other fingerprint are removed
+            max_entries (int, optional): keep at most this many entries (newest first)
+            max_bytes (int, optional): keep at most this many bytes of keys + values (newest first)
+            max_age (float, optional): remove entries older than this many seconds
+
+        Returns:
+            int: the number of entries removed
+        """
+        conn = self._connect()
+        with conn:
+            removed = 0
+            if fingerprint is not None:
+                removed += conn.execute('DELETE FROM entries WHERE fingerprint IS NULL OR fingerprint != ?', (fingerprint,)).rowcount
+            if max_age is not None:
+                removed += conn.execute('DELETE FROM entries WHERE created_at < ?', (time.time() - max_age,)).rowcount
+            if max_entries is not None:
+                removed += conn.execute(
+                    'DELETE FROM entries WHERE key NOT IN (SELECT key FROM entries ORDER BY created_at DESC LIMIT ?)',
+                    (max_entries,),
+                ).rowcount
+            if max_bytes is not None:
+                removed += conn.execute(
+                    'DELETE FROM entries WHERE key IN ('
+                    '  SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY created_at DESC, key) AS total FROM entries)'
+                    '  WHERE total > ?'
+                    ')',
+                    (max_bytes,),
+                ).rowcount
+            if removed:
+                conn.execute('DELETE FROM entry_blobs WHERE key NOT IN (SELECT key FROM entries)')
+                conn.execute('DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM entry_blobs)')
+        if removed:
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return removed
+
+    def __len__(self) -> int:
+        return self._connect().execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def close(self) -> None:
+        with self._init_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._local = threading.local()
+
+
+def fingerprint_function(f: Callable, depends_on: Iterable[object] = ()) -> str:
+    """
+    Fingerprint of a function's source code, plus anything else its results depend on.
+
+    Args:
+        f (Callable): the function to fingerprint
+        depends_on (Iterable[object], optional): other inputs to the function's results. Paths are fingerprinted by
+            their file contents, functions/classes by their source code, and anything else by its JSON (or repr) encoding.
+
+    Returns:
+        str: hex digest fingerprint
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for dep in (f, *depends_on):
+        if isinstance(dep, Path):
+            data = dep.read_bytes() if dep.exists() else b'<missing file>'
+        elif inspect.isfunction(dep) or inspect.isclass(dep) or inspect.ismethod(dep):
+            try:
+                data = inspect.getsource(dep).encode()
+            except (OSError, TypeError):
+                # e.g. defined interactively, so the source isn't available
+                data = dep.__code__.co_code if hasattr(dep, '__code__') else repr(dep).encode()
+        else:
+            data = json.dumps(dep, sort_keys=True, default=repr).encode()
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+
 # TODO: also ideally diskcache could be more automatic about serialization e.g. it can probably figure it out in a lot of cases
 @overload
 def diskcache(func: Callable[P, R], /) -> Callable[P, R]: ...
 @overload
 def diskcache(
     *,
-    serializer: Callable[[R], Serializable] = identity,
-    deserializer: Callable[[Serializable], R] = identity,
-    cache_path: Path | None = None
+    serializer: Callable[[R], Serializable],
+    deserializer: Callable[[Any], R],  # gets whatever the serializer returned, after a round trip through JSON
+    cache_path: Path | None = None,
+    memory_size: int = 128,
+    depends_on: Iterable[object] = (),
+    settings: Callable[[], Serializable] | None = None,
+    max_entries: int | None = None,
+    max_bytes: int | None = None,
+    max_age: float | None = None,
+    auto_compact: bool = True,
+    tag: Callable[..., str | None] | None = None,
+) -> Callable[[Callable[P, R]], Callable[P, R]]: ...
+@overload
+def diskcache(
+    *,
+    cache_path: Path | None = None,
+    memory_size: int = 128,
+    depends_on: Iterable[object] = (),
+    settings: Callable[[], Serializable] | None = None,
+    max_entries: int | None = None,
+    max_bytes: int | None = None,
+    max_age: float | None = None,
+    auto_compact: bool = True,
+    tag: Callable[..., str | None] | None = None,
 ) -> Callable[[Callable[P, R]], Callable[P, R]]: ...
-def diskcache(func=None, /, *, serializer=identity, deserializer=identity, cache_path: Path|None = None):
+def diskcache(
+    func=None, /, *,
+    serializer=identity,
+    deserializer=identity,
+    cache_path: Path|None = None,
+    memory_size: int = 128,
+    depends_on: Iterable[object] = (),
+    settings: Callable[[], Serializable] | None = None,
+    max_entries: int | None = None,
+    max_bytes: int | None = None,
+    max_age: float | None = None,
+    auto_compact: bool = True,
+    tag: Callable[..., str | None] | None = None,
+):
     """
     decorator that acts like @cache, but stores the cache in a file on disk
 
-    Saves the cache to a file on disk in the directory specified by cache_dir.
+    Saves the cache to an SQLite file on disk. The file is opened lazily on the first call, and only the
+    entries that are looked up get deserialized. Recently used values are also kept in memory.
+
+    Every entry records a fingerprint of the function's source and its declared dependencies (see
+    `fingerprint_function`). Entries whose fingerprint doesn't match the current one are stale: they are
+    ignored on lookup, but kept (e.g. for switching back to another branch, or undoing an edit to a prompt)
+    until they fall outside the eviction limits, or are removed explicitly with `.compact(stale=True)`.
 
     Args:
         serializer (function): function that takes a value and returns a serializable object
         deserializer (function): function that takes a serializable object and returns the original value
         cache_path (Path): path to cache file. If not provided, path will be generated based on function name and signature
+        memory_size (int): maximum number of deserialized values to keep in memory (least recently used are dropped first). 0 disables the in-memory layer
+        depends_on (Iterable[object]): other inputs the function's results depend on, e.g. data files, prompt text. Read once, on the first call
+        settings (function): returns the current values of any settings the results depend on that may change at runtime (e.g.
+            module level options). Called on every call, and part of both the key and the fingerprint, so results under
+            different settings are cached side by side, and entries under other settings count as stale
+        max_entries (int): evict the oldest entries beyond this many during compaction
+        max_bytes (int): evict the oldest entries beyond this many bytes during compaction
+        max_age (float): evict entries older than this many seconds during compaction
+        auto_compact (bool): enforce the eviction limits (if any) in a background thread the first time the function is called. Defaults to True
+        tag (function): called with the function's arguments when a new value is stored, returns a key (or None) to look the entry up by
+            later with `.cache.tagged()`, e.g. to find every result for a group of related inputs without loading every entry
 
     Returns:
-        function: the decorated function
+        function: the decorated function. The underlying store is available as `.cache`, `.compact()` enforces the eviction limits
+            on demand (`.compact(stale=True)` also removes every stale entry), and `.fingerprint()` gives the current fingerprint
+            (entries with any other are stale)
     """
     # allow for decorator as @diskcache or @diskcache(options...)
     if func is not None:
-        return diskcache(serializer=serializer, deserializer=deserializer, cache_path=cache_path)(func)
+        return diskcache(
+            serializer=serializer, deserializer=deserializer, cache_path=cache_path, memory_size=memory_size,
+            depends_on=depends_on, settings=settings, max_entries=max_entries, max_bytes=max_bytes, max_age=max_age, auto_compact=auto_compact,
+            tag=tag,
+        )(func)
 
     def decorator(f: Callable[P, R]):
         nonlocal cache_path
         if cache_path is None:
             cache_path = caller_here() / make_filesafe_signature(f)
 
-        # load the cache from the file
-        cache: dict[P, R]
-        try:
-            lines = cache_path.read_text().splitlines()
-            cache = {freeze((tuple(args), tuple(map(tuple, kwargs)))): deserializer(value)
-                     for (args, kwargs), value in map(json.loads, lines)}
-        except FileNotFoundError:
-            # create an empty cache file
-            cache_path.touch()
-            cache = {}
+        store = DiskStore(cache_path)
+        first_param = next(iter(inspect.signature(f).parameters.values()), None)
+        dependencies = tuple(depends_on)
+        fingerprint: str | None = None  # computed on first call, so dependency files are only read if the function is used
+        hot: OrderedDict[str, R] = OrderedDict()
+        hot_lock = threading.Lock()
 
-        # open the cache file for appending, and ensure it closes on exit
-        cache_file = open(cache_path, 'a')
-        atexit.register(cache_file.close)
+        def remember(key: str, value: Any) -> None:
+            if memory_size <= 0:
+                return
+            with hot_lock:
+                hot[key] = value
+                hot.move_to_end(key)
+                while len(hot) > memory_size:
+                    hot.popitem(last=False)
 
-        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
-            key = freeze((tuple(args), tuple(kwargs.items())))
-            if key in cache:
-                return cache[key]
+        # computations currently running in this process, so concurrent callers with the same key can wait on them
+        inflight: dict[str, Future] = {}
+        inflight_lock = threading.Lock()
+
+        def settings_digest() -> str:
+            """digest of the current settings (if any), to fold into keys and fingerprints"""
+            return '' if settings is None else digest(json.dumps(freeze(settings())))
 
-            value = f(*args, **kwargs)
-            cache[key] = value
-            cache_file.write(json.dumps((key, serializer(value))) + '\n')
+        def get_fingerprint(current_settings: str | None = None) -> str:
+            nonlocal fingerprint
+            if fingerprint is None:
+                fingerprint = fingerprint_function(f, (KEY_VERSION, *dependencies))
+            current_settings = settings_digest() if current_settings is None else current_settings
+            return digest(fingerprint + current_settings) if current_settings else fingerprint
 
+        # the background compaction is started by the first call (rather than e.g. reading the fingerprint), as it rewrites the file
+        compaction_started = not auto_compact or (max_entries, max_bytes, max_age) == (None, None, None)
+        compaction_lock = threading.Lock()
+
+        def start_compaction() -> None:
+            nonlocal compaction_started
+            with compaction_lock:
+                if compaction_started:
+                    return
+                compaction_started = True
+            threading.Thread(target=compact, daemon=True).start()
+
+        def compact(stale: bool = False) -> int:
+            """Enforce the eviction limits, and if `stale`, remove every stale entry. Returns the number of entries removed"""
+            return store.compact(get_fingerprint() if stale else None, max_entries=max_entries, max_bytes=max_bytes, max_age=max_age)
+
+        def lookup(key: str, fingerprint: str) -> R | _Missing:
+            with hot_lock:
+                if key in hot:
+                    hot.move_to_end(key)
+                    telemetry.add(f'cache.{f.__name__}.hits')
+                    return hot[key]
+            t0 = time.perf_counter()
+            raw = store.get(key, fingerprint)
+            if raw is None:
+                return MISSING
+            value = deserializer(json.loads(raw))
+            remember(key, value)
+            telemetry.add(f'cache.{f.__name__}.hits')
+            telemetry.add(f'cache.{f.__name__}.load_seconds', time.perf_counter() - t0)
             return value
 
+        def subject(args: tuple, kwargs: dict) -> str | None:
+            """`subject_digest` of the first argument, whether it was passed by position or keyword"""
+            if args:
+                return subject_digest(args[0])
+            if first_param is not None and first_param.name in kwargs:
+                return subject_digest(kwargs[first_param.name])
+            return None
+
+        @wraps(f)
+        def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+            if not _enabled.get():
+                return f(*args, **kwargs)
+
+            if not compaction_started:
+                start_compaction()
+            key, frozen_args = make_key(args, kwargs)
+            current_settings = settings_digest()
+            if current_settings:
+                key = digest(key + current_settings)  # the stored arguments stay as they are
+            current_fingerprint = get_fingerprint(current_settings)
+            value = lookup(key, current_fingerprint)
+            if not isinstance(value, _Missing):
+                return value
+
+            # single-flight: only one caller per key computes the value, any others wait for its result
+            with inflight_lock:
+                future = inflight.get(key)
+                is_leader = future is None
+                if is_leader:
+                    future = inflight[key] = Future()
+            assert future is not None
+            if not is_leader:
+                return future.result()
+
+            try:
+                # other processes computing the same key hold the same lock
+                with store.key_lock(key):
+                    stored = lookup(key, current_fingerprint)  # may have been computed by another process while waiting for the lock
+                    if isinstance(stored, _Missing):
+                        telemetry.add(f'cache.{f.__name__}.misses')
+                        result = f(*args, **kwargs)
+                        blobs: dict[str, str] = {}
+                        stored_args = json.dumps(extract_blobs(frozen_args, blobs))
+                        entry_tag = None if tag is None else tag(*args, **kwargs)
+                        store.set(key, json.dumps(serializer(result)), current_fingerprint, stored_args, blobs, subject(args, kwargs), entry_tag)
+                        remember(key, result)
+                    else:
+                        result = stored
+                future.set_result(result)
+                return result
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            finally:
+                with inflight_lock:
+                    del inflight[key]
+
+        wrapper.cache = store  # type: ignore[attr-defined]
+        wrapper.compact = compact  # type: ignore[attr-defined]
+        wrapper.fingerprint = get_fingerprint  # type: ignore[attr-defined]
         return wrapper
     return decorator
 
 
 def make_filesafe_signature(f:Callable[P, R]) -> str:
     """Generate a file-safe signature string for the function. More flexible on linux"""
+    return filesafe_cache_name(p(f.__code__.co_filename).name, f.__name__, str(inspect.signature(f)))
+
+
+def filesafe_cache_name(filename: str, name: str, f_sig: str) -> str:
+    """The cache file name for function `name` with signature `f_sig` defined in `filename` (see `make_filesafe_signature`)"""
     # determine if the OS is flexible with file names
     os = platform.system().lower()
     flexible_os = {'linux'}
 
-    f_sig = str(inspect.signature(f))
-    
     if os in flexible_os:
         # linux is pretty flexible with file names, so we can use mostly the original signature
         f_sig = f_sig.replace("/", "\\")
@@ -143,7 +719,7 @@ def make_filesafe_signature(f:Callable[P, R]) -> str:
             .replace(',', '_')   \
             .replace('=', '-')
 
-    return f'{p(f.__code__.co_filename).name}.cache.({f.__name__}{f_sig})'
+    return f'{filename}.cache.({name}{f_sig})'
 
 
 if __name__ == '__main__':
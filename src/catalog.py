@@ -0,0 +1,171 @@
+"""
+Compiled catalog of example files, for random access and streaming without re-parsing yaml.
+
+Each example file is parsed (with the C yaml loader when available) and validated once, and its examples are
+stored in an SQLite index along with the file's mtime, size and content hash. Later lookups only stat the file:
+if it's unchanged (or only touched, with the same hash) the index is used as is, otherwise the file is recompiled.
+
+    example = load_example(Path('examples/contrived_examples.yaml'), 0)
+    for path, index, example in iter_examples(paths):
+        ...
+"""
+from pathlib import Path
+from typing import Iterable, Iterator
+import atexit
+import hashlib
+import json
+import sqlite3
+import threading
+
+from .utils import Example, parse_examples, example_id
+
+import pdb
+
+
+here = Path(__file__).parent
+
+
+def strip_gold(example: Example, with_gold: bool) -> Example:
+    if not with_gold:
+        example.pop('gold', None)
+    return example
+
+
+class Catalog:
+    """
+    SQLite index of example files, keyed by (file, index) and by example id (see `utils.example_id`).
+
+    Safe to share between threads (each thread gets its own connection) and processes (a file is compiled
+    inside a write transaction, after re-checking whether another process already did it).
+    """
+    def __init__(self, path: Path, timeout: float = 60.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn: sqlite3.Connection | None = getattr(self._local, 'conn', None)
+        if conn is not None:
+            return conn
+
+        with self._init_lock:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, isolation_level=None)
+            if not self._initialized:
+                conn.execute('PRAGMA journal_mode=WAL')
+                conn.execute('CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, hash TEXT, count INTEGER)')
+                conn.execute('CREATE TABLE IF NOT EXISTS examples (path TEXT, idx INTEGER, id TEXT, example TEXT, PRIMARY KEY (path, idx))')
+                conn.execute('CREATE INDEX IF NOT EXISTS examples_id ON examples (id)')
+                self._initialized = True
+                atexit.register(self.close)
+            self._connections.append(conn)
+        self._local.conn = conn
+        return conn
+
+    def refresh(self, source: Path) -> str:
+        """
+        Make sure the index of an example file is up to date, compiling it if it's new or has changed.
+
+        Returns:
+            str: the key of the file in the index (its resolved path)
+        """
+        key = str(source.resolve())
+        stat = source.stat()
+        conn = self._connect()
+        row = conn.execute('SELECT mtime_ns, size FROM files WHERE path = ?', (key,)).fetchone()
+        if row == (stat.st_mtime_ns, stat.st_size):
+            return key
+
+        data = source.read_bytes()
+        file_hash = hashlib.blake2b(data, digest_size=16).hexdigest()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT mtime_ns, size, hash FROM files WHERE path = ?', (key,)).fetchone()
+            if row is not None and row[2] == file_hash:
+                # touched but not changed (or another process just compiled it), so only the stat needs updating
+                conn.execute('UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?', (stat.st_mtime_ns, stat.st_size, key))
+            else:
+                examples = parse_examples(data, source)
+                conn.execute('DELETE FROM examples WHERE path = ?', (key,))
+                conn.executemany(
+                    'INSERT INTO examples (path, idx, id, example) VALUES (?, ?, ?, ?)',
+                    ((key, index, example_id(example), json.dumps(example)) for index, example in enumerate(examples)),
+                )
+                conn.execute(
+                    'INSERT OR REPLACE INTO files (path, mtime_ns, size, hash, count) VALUES (?, ?, ?, ?, ?)',
+                    (key, stat.st_mtime_ns, stat.st_size, file_hash, len(examples)),
+                )
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return key
+
+    def count(self, source: Path) -> int:
+        """Number of examples in a file"""
+        key = self.refresh(source)
+        return self._connect().execute('SELECT count FROM files WHERE path = ?', (key,)).fetchone()[0]
+
+    def get(self, source: Path, index: int, with_gold: bool = False) -> Example:
+        """
+        Get a single example from a file.
+
+        Args:
+            source (Path): the example yaml file
+            index (int): index of the example in the file
+            with_gold (bool, optional): whether to keep any gold annotations (see `utils.load_examples`). Defaults to False.
+        """
+        key = self.refresh(source)
+        row = self._connect().execute('SELECT example FROM examples WHERE path = ? AND idx = ?', (key, index)).fetchone()
+        if row is None:
+            raise IndexError(f'{source} has {self.count(source)} examples, there is no example {index}')
+        return strip_gold(json.loads(row[0]), with_gold)
+
+    def find(self, id: str, with_gold: bool = False) -> tuple[Path, int, Example]:
+        """
+        Find an example by id among the files already in the index (checking that its file hasn't changed since)
+
+        Returns:
+            tuple[Path, int, Example]: the file the example is in, its index in the file, and the example
+        """
+        for path, index in self._connect().execute('SELECT path, idx FROM examples WHERE id = ?', (id,)).fetchall():
+            source = Path(path)
+            if not source.exists():
+                continue
+            self.refresh(source)
+            row = self._connect().execute('SELECT example FROM examples WHERE path = ? AND idx = ? AND id = ?', (path, index, id)).fetchone()
+            if row is not None:
+                return source, index, strip_gold(json.loads(row[0]), with_gold)
+        raise KeyError(id)
+
+    def iter(self, sources: Iterable[Path], with_gold: bool = False) -> Iterator[tuple[Path, int, Example]]:
+        """Stream every example of the given files, as (file, index, example), decoding one at a time"""
+        for source in sources:
+            key = self.refresh(source)
+            cursor = self._connect().execute('SELECT idx, example FROM examples WHERE path = ? ORDER BY idx', (key,))
+            while rows := cursor.fetchmany(256):
+                for index, example in rows:
+                    yield source, index, strip_gold(json.loads(example), with_gold)
+
+    def close(self) -> None:
+        with self._init_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._local = threading.local()
+
+
+# kept next to the review caches, and like them git ignored (with its -wal/-shm/.lock siblings)
+default_catalog = Catalog(here / 'examples.catalog')
+
+
+def load_example(source: Path, index: int, with_gold: bool = False) -> Example:
+    """Get a single example from a file, via the default catalog (see `Catalog.get`)"""
+    return default_catalog.get(source, index, with_gold)
+
+
+def iter_examples(sources: Iterable[Path], with_gold: bool = False) -> Iterator[tuple[Path, int, Example]]:
+    """Stream every example of the given files, via the default catalog (see `Catalog.iter`)"""
+    return default_catalog.iter(sources, with_gold)
@@ -0,0 +1,232 @@
+"""
+Chunked review of large programs.
+
+The program is split along `ast` boundaries (each top-level function or class, and runs of other top-level
+statements) into chunks of at most about `max_lines` lines. Each chunk is prefixed with a shared header of
+the program's imports and module level constants, and reviewed on its own (concurrently), so the prompt
+and per-turn latency scale with the chunk size rather than the file size. Spans selected in a chunk are
+mapped back to offsets in the whole program, and duplicates (e.g. the same import flagged from several
+chunks) are combined.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from dataclasses import dataclass
+from typing import Callable
+import ast
+
+from .cache import digest
+from .utils import Example, Span
+from .spanset import REASON_DIVIDER
+from . import telemetry
+
+import pdb
+
+
+# set while a chunk of a program is reviewed as an example of its own (see `review_chunks`)
+sub_review: ContextVar[bool] = ContextVar('sub_review', default=False)
+
+
+def query_tag(query: str) -> str:
+    return digest(query)
+
+
+def review_tag(example: Example, *args, **kwargs) -> str | None:
+    """
+    Cache tag (see `cache.diskcache`) of a review: a digest of the example's query, or None for the review of a chunk,
+    so that the reviews of whole programs with a given query can be looked up without loading every cache entry
+    """
+    return None if sub_review.get() else query_tag(example['query'])
+
+
+@dataclass
+class Segment:
+    """a run of chunk text that was copied from the program: chunk[local:local+length] == program[start:start+length]"""
+    local: int
+    start: int
+    length: int
+
+
+@dataclass
+class Chunk:
+    code: str
+    segments: list[Segment]
+    first_line: int  # 1-based line range of the program that the chunk body covers
+    last_line: int
+
+    def to_global(self, span: Span) -> Span | None:
+        """Map a span over the chunk's code to the same code in the program. None if it starts outside any copied text"""
+        for segment in self.segments:
+            if segment.local <= span.start < segment.local + segment.length:
+                offset = segment.start - segment.local
+                # a span running past the end of its segment (e.g. out of the header) is cut off there
+                stop = min(span.stop, segment.local + segment.length)
+                return Span(span.start + offset, stop + offset, span.reason, span.task)
+        return None
+
+
+def top_level_units(tree: ast.Module, n_lines: int) -> list[tuple[int, int]]:
+    """
+    Split a module into contiguous 1-based [first, last] line ranges: one per top-level function/class, and one
+    per run of other statements. Comments and blank lines before a unit belong to it.
+    """
+    units: list[list[int]] = []
+    previous_is_definition = True
+    for node in tree.body:
+        end = node.end_lineno or node.lineno
+        is_definition = isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef))
+        if units and not is_definition and not previous_is_definition:
+            units[-1][1] = end
+        else:
+            units.append([units[-1][1] + 1 if units else 1, end])
+        previous_is_definition = is_definition
+    if not units:
+        return [(1, n_lines)]
+    units[-1][1] = n_lines  # trailing comments and blank lines
+    return [(first, last) for first, last in units]
+
+
+def header_lines(tree: ast.Module) -> list[tuple[int, int]]:
+    """1-based [first, last] line ranges of the top-level imports and constants (UPPER_CASE = ...) shared with every chunk"""
+    ranges = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            ranges.append((node.lineno, node.end_lineno or node.lineno))
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            if all(isinstance(target, ast.Name) and target.id.isupper() for target in targets):
+                ranges.append((node.lineno, node.end_lineno or node.lineno))
+    return ranges
+
+
+def line_offsets(code: str) -> list[int]:
+    """offsets[i] is the offset of the start of (0-based) line i, with a final entry for the end of the code"""
+    offsets = [0]
+    for line in code.splitlines(keepends=True):
+        offsets.append(offsets[-1] + len(line))
+    return offsets
+
+
+def make_chunk(code: str, offsets: list[int], first: int, last: int, header: list[tuple[int, int]]) -> Chunk:
+    """The chunk of lines [first, last] (1-based) of the program, preceded by any header lines it doesn't already contain"""
+    text: list[str] = []
+    segments: list[Segment] = []
+    def copy(first_line: int, last_line: int):
+        start, stop = offsets[first_line - 1], offsets[last_line]
+        block = code[start:stop]
+        if not block.endswith('\n'):
+            block += '\n'  # the separator below must start on its own line
+        segments.append(Segment(sum(map(len, text)), start, stop - start))
+        text.append(block)
+
+    shared = [(a, b) for a, b in header if b < first or a > last]
+    for a, b in shared:
+        copy(a, b)
+    if shared:
+        text.append(f'# ... (lines {first}-{last} of the full program follow)\n')
+    copy(first, last)
+    return Chunk(''.join(text), segments, first, last)
+
+
+def split_code(code: str, max_lines: int = 200) -> list[Chunk]:
+    """
+    Split a program into chunks of at most about `max_lines` lines, including the shared header (a single
+    function or class longer than that is still kept whole). Code that doesn't parse, or fits in one chunk,
+    comes back as a single chunk.
+    """
+    offsets = line_offsets(code)
+    n_lines = len(offsets) - 1
+    whole = [Chunk(code, [Segment(0, 0, len(code))], 1, n_lines)]
+    if n_lines <= max_lines:
+        return whole
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return whole
+
+    # greedily pack consecutive units into chunks, leaving room for the header (but no less than half the chunk)
+    header = header_lines(tree)
+    budget = max(max_lines - sum(last - first + 1 for first, last in header), max_lines // 2)
+    groups: list[tuple[int, int]] = []
+    for first, last in top_level_units(tree, n_lines):
+        if groups and last - groups[-1][0] + 1 <= budget:
+            groups[-1] = (groups[-1][0], last)
+        else:
+            groups.append((first, last))
+    if len(groups) == 1:
+        return whole
+
+    return [make_chunk(code, offsets, first, last, header) for first, last in groups]
+
+
+def review_chunks(
+    example: Example,
+    chunks: list[Chunk],
+    parallel: bool = False,
+    concurrency: int = 4,
+    review: Callable[..., list[Span]] | None = None,
+) -> list[list[Span]]:
+    """
+    Review chunks of an example's code concurrently, each as an example of its own.
+
+    Returns:
+        list[list[Span]]: for each chunk, its spans as offsets into the whole program (spans starting in
+            inserted text such as the separator are dropped)
+    """
+    if review is None:
+        from .review import review_code
+        review = review_code
+
+    def run(chunk: Chunk) -> list[Span]:
+        sub_review.set(True)  # in a copy of the context, so only for this chunk
+        spans = review({**example, 'code': chunk.code}, parallel=parallel)
+        return [span for span in map(chunk.to_global, spans) if span is not None]
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda chunk: copy_context().run(run, chunk), chunks))
+
+
+def dedupe_spans(spans: list[Span]) -> list[Span]:
+    """Combine spans selected more than once (e.g. a header line flagged from several chunks), keeping each distinct reason"""
+    combined: dict[tuple[int, int, int | None], Span] = {}
+    for span in spans:
+        key = (span.start, span.stop, span.task)
+        if key not in combined:
+            combined[key] = Span(span.start, span.stop, span.reason, span.task)
+        elif span.reason not in combined[key].reason.split(REASON_DIVIDER):
+            combined[key].reason += REASON_DIVIDER + span.reason
+    return sorted(combined.values(), key=lambda span: (span.start, span.stop))
+
+
+def review_code_chunked(
+    example: Example,
+    max_lines: int = 200,
+    parallel: bool = False,
+    concurrency: int = 4,
+    review: Callable[..., list[Span]] | None = None,
+) -> list[Span]:
+    """
+    Review a (large) program chunk by chunk, with the chunks reviewed concurrently.
+
+    Each chunk is reviewed (and cached) by `review_code` as an example of its own, so an unchanged chunk of an
+    edited program is not reviewed again.
+
+    Args:
+        example (Example): the example to review
+        max_lines (int, optional): target chunk size in lines, see `split_code`. Defaults to 200.
+        parallel (bool, optional): also run the review tasks of each chunk concurrently, see `review_code`. Defaults to False.
+        concurrency (int, optional): maximum number of chunks reviewed at once. Defaults to 4.
+        review (Callable[..., list[Span]], optional): the review function for each chunk. Defaults to `review_code`.
+
+    Returns:
+        list[Span]: the spans selected over all chunks, as offsets into the whole program, sorted by position
+    """
+    chunks = split_code(example['code'], max_lines)
+    if len(chunks) == 1:
+        if review is None:
+            from .review import review_code
+            review = review_code
+        return review(example, parallel=parallel)
+
+    with telemetry.span('review_code_chunked', chunks=len(chunks)):
+        results = review_chunks(example, chunks, parallel, concurrency, review)
+    return dedupe_spans([span for spans in results for span in spans])
@@ -0,0 +1,214 @@
+"""
+Command line interface: list, validate, review and show examples.
+
+Only `review` and `cache` import the LLM stack (archytas, langchain, ...), so the other commands start quickly.
+
+Usage:
+    llm-review list
+    llm-review validate examples/*.yaml
+    llm-review review examples/contrived_examples.yaml -i 0
+    llm-review show examples/contrived_examples.yaml -i 0 [--results results.jsonl]
+    llm-review cache compact [--stale]
+
+(or `python -m src.cli ...` without installing)
+"""
+from pathlib import Path
+from typing import Iterator
+import argparse
+import json
+import shutil
+import sys
+
+from .utils import Example, Span, VagueSpan, SpanResolver, load_examples, deserialize_span
+from .catalog import default_catalog, iter_examples
+
+import pdb
+
+
+here = Path(__file__).parent
+default_examples = sorted((here.parent / 'examples').glob('*.yaml'))
+
+# signature of review.review_code, which names its cache file (see cache.make_filesafe_signature). Spelled out here so
+# that `show` needn't import review.py. test_review_cache_path checks that it still matches
+REVIEW_CODE_SIGNATURE = '(example: src.utils.Example, parallel: bool = False) -> list[src.utils.Span]'
+
+
+def load_example(path: Path, index: int) -> Example:
+    try:
+        return default_catalog.get(path, index)
+    except IndexError as e:
+        raise SystemExit(str(e))
+
+
+def cmd_list(args: argparse.Namespace) -> int:
+    width = shutil.get_terminal_size().columns
+    for path, index, example in iter_examples(args.paths, with_gold=True):
+        gold = f' [{len(example["gold"])} gold]' if 'gold' in example else ''
+        prefix = f'{path.name}:{index}{gold}  '
+        query = ' '.join(example['query'].split())
+        print(prefix + query[:max(20, width - len(prefix) - 1)])
+    return 0
+
+
+def cmd_validate(args: argparse.Namespace) -> int:
+    n_errors = 0
+    for path in args.paths:
+        try:
+            examples = load_examples(path, with_gold=True)
+        except Exception as e:
+            print(f'{path}: {type(e).__name__}: {e}')
+            n_errors += 1
+            continue
+        for index, example in enumerate(examples):
+            resolver = SpanResolver(example['code'])
+            for gold in example.get('gold', []):
+                try:
+                    resolver.resolve(VagueSpan(gold['start_line'], gold['quote'], gold.get('reason', '')))
+                except ValueError as e:
+                    print(f'{path}:{index}: gold span on line {gold["start_line"]}: {e}')
+                    n_errors += 1
+        print(f'{path}: {len(examples)} examples, {sum(len(example.get("gold", [])) for example in examples)} gold spans')
+    if n_errors:
+        print(f'{n_errors} errors')
+    return 1 if n_errors else 0
+
+
+def cmd_review(args: argparse.Namespace) -> int:
+    from .review import review_code, review_code_stream
+    from .display import explain_code_live
+
+    example = load_example(args.path, args.index)
+    if args.stream:
+        spans: list[Span] = []
+        def collect(stream: Iterator[Span]) -> Iterator[Span]:
+            for span in stream:
+                spans.append(span)
+                yield span
+        explain_code_live(example['code'], collect(review_code_stream(example, parallel=args.parallel)), policy=args.policy)
+        if args.export:
+            display(args, example, spans)
+    elif args.incremental:
+        from .incremental import review_code_incremental
+        display(args, example, review_code_incremental(example, parallel=args.parallel))
+    elif args.chunk_lines:
+        from .chunking import review_code_chunked
+        display(args, example, review_code_chunked(example, max_lines=args.chunk_lines, parallel=args.parallel))
+    else:
+        display(args, example, review_code(example, parallel=args.parallel))
+    return 0
+
+
+def display(args: argparse.Namespace, example: Example, spans: list[Span]) -> None:
+    """show the spans in the terminal (whole file, or only windows around the spans if --context was given), and/or export them"""
+    from .display import explain_code, explain_code_windowed, export_review
+
+    if args.export:
+        export_review(args.export, example['code'], spans, policy=args.policy, context=args.context or 3, title=f'{args.path.name}:{args.index}')
+        print(f'exported review of {args.path}:{args.index} -> {args.export}')
+    elif args.context is not None:
+        explain_code_windowed(example['code'], spans, policy=args.policy, context=args.context, page_size=args.page_size)
+    else:
+        explain_code(example['code'], spans, policy=args.policy)
+
+
+def cached_review(example: Example) -> list[Span] | None:
+    """
+    Look up the latest cached review_code result for an example (however it was called, with any settings, and
+    even if stale) without importing the LLM stack
+    """
+    import sqlite3
+    from .cache import DiskStore, filesafe_cache_name, subject_digest
+
+    path = here / filesafe_cache_name('review.py', 'review_code', REVIEW_CODE_SIGNATURE)
+    if not path.exists():
+        return None
+    store = DiskStore(path, readonly=True)
+    try:
+        # keys also depend on review.py's settings (e.g. the model), so go by the example instead
+        entry = store.latest(subject_digest(example))
+    except sqlite3.DatabaseError:
+        return None  # e.g. a cache in an older format, which only review_code itself migrates
+    finally:
+        store.close()
+    return None if entry is None else [deserialize_span(span) for span in json.loads(entry[2])]
+
+
+def results_review(path: Path, example_path: Path, index: int) -> list[Span] | None:
+    """The latest successful review of an example in a batch.py results file"""
+    spans = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if Path(record['path']).resolve() == example_path.resolve() and record['index'] == index and record['spans'] is not None:
+                spans = [deserialize_span(span) for span in record['spans']]
+    return spans
+
+
+def cmd_show(args: argparse.Namespace) -> int:
+    example = load_example(args.path, args.index)
+    spans = results_review(args.results, args.path, args.index) if args.results else cached_review(example)
+    if spans is None:
+        print(f'no review of {args.path}:{args.index} found in {args.results or "the review cache"}', file=sys.stderr)
+        return 1
+
+    display(args, example, spans)
+    return 0
+
+
+def cmd_cache_compact(args: argparse.Namespace) -> int:
+    from .review import review_code, review_task
+    from .incremental import _review_code_incremental
+
+    for cached in (review_code, review_task, _review_code_incremental):
+        removed = cached.compact(stale=args.stale)  # type: ignore[union-attr]
+        print(f'{cached.__name__}: removed {removed} entries, {len(cached.cache)} left')  # type: ignore[union-attr]
+    return 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog='llm-review', description='Review LLM generated code examples')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    list_parser = commands.add_parser('list', help='list the examples in example files')
+    list_parser.add_argument('paths', nargs='*', type=Path, default=default_examples, help='example yaml files (default: examples/*.yaml)')
+    list_parser.set_defaults(run=cmd_list)
+
+    validate_parser = commands.add_parser('validate', help='check that example files load, and their gold spans resolve')
+    validate_parser.add_argument('paths', nargs='*', type=Path, default=default_examples, help='example yaml files (default: examples/*.yaml)')
+    validate_parser.set_defaults(run=cmd_validate)
+
+    for name, run, help in [
+        ('review', cmd_review, 'review an example with the LLM and show the selected spans'),
+        ('show', cmd_show, 'show an earlier review of an example (from the cache or a results file) without calling the LLM'),
+    ]:
+        command = commands.add_parser(name, help=help)
+        command.add_argument('path', type=Path, help='example yaml file')
+        command.add_argument('-i', '--index', type=int, default=0, help='index of the example in the file')
+        command.add_argument('--policy', choices=['nest', 'merge', 'distinct'], default='nest', help='how to display overlapping spans')
+        command.add_argument('-C', '--context', type=int, help='only show this many lines around each span, collapsing the rest (for large files)')
+        command.add_argument('--page-size', type=int, help='with --context, pause after this many windows')
+        command.add_argument('--export', type=Path, help='write the review to a static .html or .json file instead of displaying it')
+        command.set_defaults(run=run)
+        if name == 'review':
+            command.add_argument('--parallel', action='store_true', help='run the review tasks concurrently')
+            mode = command.add_mutually_exclusive_group()
+            mode.add_argument('--stream', action='store_true', help='show spans as soon as they are selected (with --export, the review is also exported once done)')
+            mode.add_argument('--chunk-lines', type=int, help='review large programs in chunks of about this many lines (split at top-level functions and classes), concurrently')
+            mode.add_argument('--incremental', action='store_true', help='only re-review what changed since the most similar earlier review of the same query')
+        else:
+            command.add_argument('--results', type=Path, help='batch.py results file to take the review from, instead of the cache')
+
+    cache_parser = commands.add_parser('cache', help='manage the review caches')
+    cache_commands = cache_parser.add_subparsers(dest='cache_command', required=True)
+    compact_parser = cache_commands.add_parser('compact', help='evict entries beyond the cache limits, and reclaim their space on disk')
+    compact_parser.add_argument('--stale', action='store_true', help='also remove every entry computed with other prompts, code or settings (e.g. another model)')
+    compact_parser.set_defaults(run=cmd_cache_compact)
+
+    args = parser.parse_args(argv)
+    if getattr(args, 'stream', False) and (args.context is not None or args.page_size is not None):
+        parser.error('-C/--context and --page-size cannot be combined with --stream')
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,22 +4,52 @@ from rich.text import Text
 from rich.panel import Panel
 from rich.columns import Columns
 from rich.table import Table
+from rich.live import Live
 
 
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from html import escape
+from itertools import accumulate
+from pathlib import Path
+from typing import Iterable, Iterator, Literal
+import json
+
 from .utils import Span
 
 import pdb
 
 
-def explain_code(source_code: str, spans: list[Span]):
+def explain_code(source_code: str, spans: list[Span], policy: 'MergePolicy' = 'nest', min_overlap: float = 0.0):
     """
     Displays source code with highlighted spans and explanations.
+    Overlapping spans are merged according to `policy` and `min_overlap` (see `handle_overlaps`).
     """
     # handle merging any overlapping spans
-    spans = handle_overlaps(spans)
+    spans = handle_overlaps(spans, policy, min_overlap)
 
     console = Console()
+    console.print(render_explanation(source_code, spans))
+
+
+def explain_code_live(source_code: str, spans: Iterable[Span], policy: 'MergePolicy' = 'nest', min_overlap: float = 0.0) -> list[Span]:
+    """
+    Like `explain_code`, but spans may arrive over time (e.g. from `review.review_code_stream`).
+    The display is updated in place as each span arrives, re-merging only the region of code the new span touches.
+
+    Returns:
+        list[Span]: the final merged spans
+    """
+    merger = IncrementalMerger(policy, min_overlap)
+    with Live(render_explanation(source_code, merger.merged), refresh_per_second=4) as live:
+        for span in spans:
+            merger.add(span)
+            live.update(render_explanation(source_code, merger.merged))
+    return merger.merged
 
+
+def render_explanation(source_code: str, spans: list[Span]) -> Columns:
+    """Render source code with the given (already merged) spans highlighted, side by side with their explanations"""
     # Sort spans so we don’t mess up indexes when inserting highlights
     spans = sorted(spans, key=lambda x: x.start)
 
@@ -30,12 +60,11 @@ def explain_code(source_code: str, spans: list[Span]):
     code_text = Text(source_code)  # this preserves your exact positions
 
     # Apply color highlights to spans
-    colors = ["on red", "on green", "on yellow", "on cyan", "on magenta", "on blue"]
     labels: list[tuple[str, str, str]] = []
 
     for i, span in enumerate(spans):
         label = f"[{i + 1}]"
-        color = colors[i % len(colors)]
+        color = COLORS[i % len(COLORS)]
 
         # highlight the selection in the code
         code_text.stylize(color, span.start, span.stop)
@@ -44,18 +73,23 @@ def explain_code(source_code: str, spans: list[Span]):
     # Left panel: highlighted code
     code_panel = Panel(code_text, title="Source Code", border_style="blue", width=80)
 
-    # Right panel: explanations using a table for indentation
+    # Display side by side
+    return Columns([code_panel, render_explanations(labels, len(spans))])
+
+
+COLORS = ["on red", "on green", "on yellow", "on cyan", "on magenta", "on blue"]
+
+
+def render_explanations(labels: list[tuple[str, str, str]], n_labels: int) -> Panel:
+    """Right panel: (label, color, explanation) rows, using a table for indentation"""
     explanation_table = Table(show_header=False, box=None, padding=(1, 1, 0, 0))
-    explanation_table.add_column("Label", width=len(str(len(spans)))+2, style="bold", justify="right")
+    explanation_table.add_column("Label", width=len(str(n_labels))+2, style="bold", justify="right")
     explanation_table.add_column("Explanation", style="white", overflow="fold")
 
     for label, color, expl in labels:
         explanation_table.add_row(Text(f'{label}', style=color), Text(f'{expl}'))
 
-    explanation_panel = Panel(explanation_table, title="Explanations", border_style="green", width=90)
-
-    # Display side by side
-    console.print(Columns([code_panel, explanation_panel]))
+    return Panel(explanation_table, title="Explanations", border_style="green", width=90)
 
 
 def merge_spans(left: Span, right: Span) -> Span:
@@ -64,65 +98,341 @@ def merge_spans(left: Span, right: Span) -> Span:
         min(left.start, right.start),
         max(left.stop, right.stop),
         f'{left.reason}\n{"-" * 80}\n{right.reason}',
+        left.task if left.task == right.task else None,
     )
 
-def handle_overlaps(spans: list[Span]) -> list[Span]:
-    # repeat span merging until there are no more overlaps
-    n_spans = len(spans)
-    while True:
-        spans=_handle_overlaps(spans)
-        if len(spans) == n_spans:
-            break
-        n_spans = len(spans)
-    return spans
 
-def _handle_overlaps(spans: list[Span]) -> list[Span]:
+MergePolicy = Literal['nest', 'merge', 'distinct']
+
+
+def overlap_ratio(left: 'Span | _SpanGroup', right: 'Span | _SpanGroup') -> float:
+    """How much two spans overlap, as a fraction (0.0 to 1.0) of the shorter span"""
+    overlap = min(left.stop, right.stop) - max(left.start, right.start)
+    shorter = min(left.stop - left.start, right.stop - right.start)
+    return max(overlap, 0) / max(shorter, 1)
+
+
+@dataclass(slots=True)
+class _SpanGroup:
+    """A run of spans being merged together into a single span"""
+    start: int
+    stop: int
+    reasons: list[str]
+    task: int | None
+    order: int  # position of the group's first span in sorted order, so groups with the same range keep the order of their spans
+
+    def absorb(self, other: '_SpanGroup') -> None:
+        self.start = min(self.start, other.start)
+        self.stop = max(self.stop, other.stop)
+        self.reasons.extend(other.reasons)
+        if self.task != other.task:
+            self.task = None
+
+    def to_span(self) -> Span:
+        return Span(self.start, self.stop, f'\n{"-" * 80}\n'.join(self.reasons), self.task)
+
+
+def handle_overlaps(spans: list[Span], policy: MergePolicy = 'nest', min_overlap: float = 0.0) -> list[Span]:
     """
-    Merges spans that overlap the exact same or almost exact range.
+    Merges overlapping spans in a single sorted sweep.
+
+    Policies for spans that overlap (or touch):
+    - 'nest': a span strictly inside another is kept as a separate (nested) span, any other overlap is merged
+    - 'merge': every overlap is merged, including nested spans
+    - 'distinct': spans are never merged
+
+    Unlike the pairwise loop this replaced, which only compared neighbours in sorted order, a span nested in a
+    group doesn't keep the group from merging with a later span that overlaps it. E.g. with 'nest', [0, 10), [2, 4)
+    and [8, 12) become [0, 12) and [2, 4), where the pairwise loop kept all three apart.
+
+    Args:
+        spans (list[Span]): the spans to merge
+        policy (MergePolicy, optional): how to handle overlapping spans. Defaults to 'nest'.
+        min_overlap (float, optional): spans that overlap by less than this fraction of the shorter span (see `overlap_ratio`)
+            are kept distinct rather than merged. Defaults to 0.0 (merge any overlap, including spans that just touch).
+
+    Returns:
+        list[Span]: the merged spans, sorted by (start, stop)
+    """
+    if policy == 'distinct':
+        return sorted(spans, key=lambda x: (x.start, x.stop))
+
+    def should_merge(outer: _SpanGroup, inner: _SpanGroup) -> bool:
+        if policy == 'nest' and outer.start < inner.start and outer.stop > inner.stop:
+            return False
+        return min_overlap <= 0.0 or overlap_ratio(outer, inner) >= min_overlap
+
+    # stack of groups that are still open (i.e. a later span could still overlap them), innermost last
+    open_groups: list[_SpanGroup] = []
+    closed_groups: list[_SpanGroup] = []
+    for order, span in enumerate(sorted(spans, key=lambda x: (x.start, x.stop))):
+        while open_groups and open_groups[-1].stop < span.start:
+            closed_groups.append(open_groups.pop())
+
+        group = _SpanGroup(span.start, span.stop, [span.reason], span.task, order)
+        # merging can grow a group past the end of its enclosing group, in which case that merges too
+        while open_groups and should_merge(open_groups[-1], group):
+            outer = open_groups.pop()
+            outer.absorb(group)
+            group = outer
+        open_groups.append(group)
+
+    closed_groups.extend(open_groups)
+    closed_groups.sort(key=lambda group: (group.start, group.stop, group.order))
+    return [group.to_span() for group in closed_groups]
+
+
+class IncrementalMerger:
+    """
+    Maintains the merged (see `handle_overlaps`) view of a growing collection of spans.
+    Adding a span only re-merges the spans in the region of content it touches, rather than all of them.
+    """
+    def __init__(self, policy: MergePolicy = 'nest', min_overlap: float = 0.0):
+        self.policy: MergePolicy = policy
+        self.min_overlap = min_overlap
+        self.spans: list[Span] = []   # every span added so far, sorted by (start, stop)
+        self.merged: list[Span] = []  # the merged spans, sorted by (start, stop)
+
+    def add(self, span: Span) -> None:
+        insort(self.spans, span, key=lambda x: (x.start, x.stop))
+
+        # grow the affected region until no merged span partially sticks out of it
+        start, stop = span.start, span.stop
+        while True:
+            touching = [m for m in self.merged if m.start <= stop and m.stop >= start]
+            new_start = min([start, *(m.start for m in touching)])
+            new_stop = max([stop, *(m.stop for m in touching)])
+            if (new_start, new_stop) == (start, stop):
+                break
+            start, stop = new_start, new_stop
+
+        # every span starting in the region lies entirely within it, so the region can be merged on its own
+        key = lambda x: x.start
+        region = self.spans[bisect_left(self.spans, start, key=key):bisect_right(self.spans, stop, key=key)]
+        lo, hi = bisect_left(self.merged, start, key=key), bisect_right(self.merged, stop, key=key)
+        self.merged[lo:hi] = handle_overlaps(region, self.policy, self.min_overlap)
+
+
+@dataclass
+class Window:
+    """A run of lines [start_line, stop_line) (0-based) shown around one or more spans"""
+    start_line: int
+    stop_line: int
+    labels: list[int]  # indices (into the merged spans) of the spans in the window
+
+
+class LineIndex:
+    """Character offsets of the start of each line, for converting spans to line ranges"""
+    def __init__(self, source_code: str):
+        # the final entry is the end of the code, so the last line always has a stop offset
+        self.starts = [0, *accumulate(len(line) for line in source_code.splitlines(keepends=True))]
+        self.n_lines = len(self.starts) - 1
+
+    def line_of(self, offset: int) -> int:
+        return min(max(bisect_right(self.starts, offset) - 1, 0), max(self.n_lines - 1, 0))
+
+    def lines_of(self, span: Span) -> tuple[int, int]:
+        """the lines [first, last] that a span touches"""
+        return self.line_of(span.start), self.line_of(max(span.stop - 1, span.start))
+
+
+def make_windows(lines: LineIndex, spans: list[Span], context: int = 3) -> list[Window]:
+    """
+    Group (already merged and sorted) spans into windows of lines, each span with `context` lines either side.
+    Windows that would overlap or touch are combined.
+    """
+    windows: list[Window] = []
+    for i, span in enumerate(spans):
+        first, last = lines.lines_of(span)
+        start, stop = max(first - context, 0), min(last + context + 1, lines.n_lines)
+        if windows and start <= windows[-1].stop_line:
+            windows[-1].stop_line = max(windows[-1].stop_line, stop)
+            windows[-1].labels.append(i)
+        else:
+            windows.append(Window(start, stop, [i]))
+    return windows
+
+
+def render_window(source_code: str, lines: LineIndex, spans: list[Span], window: Window) -> Columns:
+    """Render the lines of one window (with line numbers) and the explanations of its spans, like `render_explanation`"""
+    offset, end = lines.starts[window.start_line], lines.starts[window.stop_line]
+    chunk = source_code[offset:end]
+    code_text = Text(chunk[:-1] if chunk.endswith('\n') else chunk)
+    labels = []
+    for i in window.labels:
+        span, color = spans[i], COLORS[i % len(COLORS)]
+        code_text.stylize(color, max(span.start, offset) - offset, min(span.stop, end) - offset)
+        labels.append((f'[{i + 1}]', color, span.reason))
+
+    width = len(str(window.stop_line))
+    numbered = Text()
+    for number, line in enumerate(code_text.split('\n', allow_blank=True), window.start_line + 1):
+        if number > window.start_line + 1:
+            numbered.append('\n')
+        numbered.append(f'{number:>{width}} ', style='dim')
+        numbered.append_text(line)
+
+    code_panel = Panel(numbered, title=f"Lines {window.start_line + 1}-{window.stop_line}", border_style="blue", width=80)
+    return Columns([code_panel, render_explanations(labels, len(spans))])
+
+
+def iter_windows(source_code: str, spans: list[Span], context: int = 3) -> Iterator[Text | Columns]:
+    """
+    Lazily render (already merged) spans window by window: each window of lines around spans, with a
+    one line marker for every collapsed run of untouched lines in between.
     """
     spans = sorted(spans, key=lambda x: (x.start, x.stop))
+    lines = LineIndex(source_code)
+    position = 0
+    for window in make_windows(lines, spans, context):
+        if window.start_line > position:
+            yield collapsed_marker(window.start_line - position)
+        yield render_window(source_code, lines, spans, window)
+        position = window.stop_line
+    if lines.n_lines > position:
+        yield collapsed_marker(lines.n_lines - position)
+
+
+def collapsed_marker(n_lines: int) -> Text:
+    return Text(f'  ⋯ {n_lines} unchanged line{"s" if n_lines != 1 else ""} ⋯', style='dim italic')
+
+
+def explain_code_windowed(
+    source_code: str,
+    spans: list[Span],
+    policy: MergePolicy = 'nest',
+    min_overlap: float = 0.0,
+    context: int = 3,
+    page_size: int | None = None,
+):
+    """
+    Like `explain_code`, but for large files: only windows of `context` lines around the spans are shown,
+    and the untouched regions between them are collapsed. Windows are rendered one at a time as they are printed.
+
+    Args:
+        source_code (str): the code
+        spans (list[Span]): the spans to show
+        policy (MergePolicy, optional): see `handle_overlaps`. Defaults to 'nest'.
+        min_overlap (float, optional): see `handle_overlaps`. Defaults to 0.0.
+        context (int, optional): lines of context to show either side of each span. Defaults to 3.
+        page_size (int, optional): if given (and the terminal is interactive), pause for Enter after this many windows. Defaults to None.
+    """
+    console = Console()
+    n_windows = 0
+    for renderable in iter_windows(source_code, handle_overlaps(spans, policy, min_overlap), context):
+        console.print(renderable)
+        if isinstance(renderable, Columns):
+            n_windows += 1
+            if page_size and n_windows % page_size == 0 and console.is_interactive:
+                console.input('[dim]-- Enter for more --[/dim]')
+
+
+HTML_COLORS = {"on red": "#f8b4b4", "on green": "#b4f0c0", "on yellow": "#f8ec9c", "on cyan": "#a8e8f0", "on magenta": "#f0b4f0", "on blue": "#b4c8f8"}
 
-    i = 0
-    while i < len(spans) - 1:
-        left = spans[i]
-        right = spans[i + 1]
-
-
-        # # if the spans are identical
-        # if left.start == right.start and left.stop == right.stop:
-        #     spans[i] = merge_spans(left, right)
-        #     del spans[i + 1]
-        #     continue
-
-        # # if the overlap is close enough
-        # dstart = abs(left.start - right.start)
-        # dstop = abs(left.stop - right.stop)
-        # overlap = abs(min(left.stop, right.stop) - max(left.start, right.start))
-        # if (dstart + dstop) / overlap < 0.1:
-        #     spans[i] = merge_spans(left, right)
-        #     del spans[i + 1]
-        #     continue
-
-        # if right is completely inside the left, it's ok
-        if left.start < right.start and left.stop > right.stop:
-            i += 1
-            continue
-        # if right.start < left.start and right.stop > left.stop:
-        #     # i += 2
-        #     j += 1
-        #     continue
-        
-        # in the case of any overlap at all
-        # TODO: for now just merge them, but probably want something better...
-        if left.start <= right.start and left.stop >= right.start:
-            spans[i] = merge_spans(left, right)
-            del spans[i + 1]
-            continue
-
-        # otherwise the spans should have no overlap
-        i += 1
-
-    return spans
+
+def export_json(source_code: str, spans: list[Span], policy: MergePolicy = 'nest', min_overlap: float = 0.0, context: int = 3) -> dict:
+    """
+    A static, self contained description of a review: the merged spans (with their line ranges) and the windows of
+    code around them. Spans are labelled (1-based) in the same order as the terminal display.
+    """
+    spans = handle_overlaps(spans, policy, min_overlap)
+    lines = LineIndex(source_code)
+    return {
+        'n_lines': lines.n_lines,
+        'spans': [
+            {'label': i + 1, 'start': span.start, 'stop': span.stop, 'lines': [first + 1, last + 1], 'task': span.task, 'reason': span.reason}
+            for i, span in enumerate(spans) for first, last in [lines.lines_of(span)]
+        ],
+        'windows': [
+            {
+                'lines': [window.start_line + 1, window.stop_line],
+                'code': source_code[lines.starts[window.start_line]:lines.starts[window.stop_line]],
+                'labels': [i + 1 for i in window.labels],
+            }
+            for window in make_windows(lines, spans, context)
+        ],
+    }
+
+
+def highlight_html(source_code: str, spans: list[Span], indices: list[int], start: int, stop: int) -> str:
+    """HTML for source_code[start:stop], with each character marked by the innermost of the spans (`spans[i] for i in indices`) covering it"""
+    bounds = sorted({start, stop, *(min(max(pos, start), stop) for i in indices for pos in (spans[i].start, spans[i].stop))})
+    parts = []
+    for lo, hi in zip(bounds, bounds[1:]):
+        # spans are sorted by (start, stop), so among those covering the segment the last one is the innermost
+        covering = [i for i in indices if spans[i].start <= lo and spans[i].stop >= hi]
+        text = escape(source_code[lo:hi])
+        if covering:
+            i = covering[-1]
+            parts.append(f'<mark style="background:{HTML_COLORS[COLORS[i % len(COLORS)]]}" title="[{i + 1}]">{text}</mark>')
+        else:
+            parts.append(text)
+    return ''.join(parts)
+
+
+def export_html(source_code: str, spans: list[Span], policy: MergePolicy = 'nest', min_overlap: float = 0.0, context: int = 3, title: str = 'Code review') -> str:
+    """
+    A static HTML page of a review, for sharing: windows of code around the spans with their explanations,
+    and the untouched regions in between collapsed (expandable in the page)
+    """
+    spans = handle_overlaps(spans, policy, min_overlap)
+    lines = LineIndex(source_code)
+
+    def code(start_line: int, stop_line: int, indices: list[int]) -> str:
+        marked = highlight_html(source_code, spans, indices, lines.starts[start_line], lines.starts[stop_line])
+        return f'<pre>{marked}</pre>'
+
+    def collapsed(start_line: int, stop_line: int) -> str:
+        return f'<details><summary>⋯ {stop_line - start_line} unchanged lines ({start_line + 1}-{stop_line})</summary>{code(start_line, stop_line, [])}</details>'
+
+    body = []
+    position = 0
+    for window in make_windows(lines, spans, context):
+        if window.start_line > position:
+            body.append(collapsed(position, window.start_line))
+        explanations = ''.join(
+            f'<li value="{i + 1}" style="border-left:6px solid {HTML_COLORS[COLORS[i % len(COLORS)]]}">{escape(spans[i].reason)}</li>'
+            for i in window.labels
+        )
+        body.append(f'<section><h3>Lines {window.start_line + 1}-{window.stop_line}</h3>{code(window.start_line, window.stop_line, window.labels)}<ol>{explanations}</ol></section>')
+        position = window.stop_line
+    if lines.n_lines > position:
+        body.append(collapsed(position, lines.n_lines))
+
+    return HTML_TEMPLATE.format(title=escape(title), body='\n'.join(body))
+
+
+HTML_TEMPLATE = '''\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{ font-family: sans-serif; max-width: 110ch; margin: 2em auto; }}
+section {{ display: grid; grid-template-columns: 80ch 1fr; gap: 1em; border-top: 1px solid #ddd; }}
+section h3 {{ grid-column: 1 / -1; margin-bottom: 0; }}
+pre {{ font-size: 13px; white-space: pre-wrap; }}
+ol li {{ padding-left: 0.5em; margin-bottom: 0.5em; white-space: pre-wrap; }}
+details {{ color: #888; margin: 0.5em 0; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+</body>
+</html>
+'''
+
+
+def export_review(path: Path, source_code: str, spans: list[Span], policy: MergePolicy = 'nest', min_overlap: float = 0.0, context: int = 3, title: str = 'Code review') -> None:
+    """Write a review to a static .html or .json file (by the path's suffix), see `export_html` and `export_json`"""
+    if path.suffix == '.json':
+        path.write_text(json.dumps(export_json(source_code, spans, policy, min_overlap, context), indent=2), encoding='utf-8')
+    elif path.suffix in ('.html', '.htm'):
+        path.write_text(export_html(source_code, spans, policy, min_overlap, context, title), encoding='utf-8')
+    else:
+        raise ValueError(f'unknown export format {path.suffix!r}, expected .html or .json')
 
 
 
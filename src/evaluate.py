@@ -0,0 +1,302 @@
+"""
+Score reviews against gold annotations.
+
+Gold spans are attached to the example yaml entries, written the same way the reviewer selects spans:
+
+    - query: ...
+      code: |
+        ...
+      gold:
+        - start_line: 7
+          quote: df = pd.read_csv('stat5_data.csv')
+          reason: the file name was given, but the column names are assumed
+          task: 1  # optional: the review task (index into review.review_tasks) the span belongs to
+
+Predictions can come from batch.py output files and/or straight from the review_code cache. Scores are
+character-level precision, recall, F1 and IoU (overall and per review task), computed with NumPy over
+interval masks of each example's code, so thousands of runs score in seconds.
+
+Usage:
+    python -m src.evaluate results.jsonl --examples examples/*.yaml
+    python -m src.evaluate --cache
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, Sequence
+import argparse
+import json
+import warnings
+
+import numpy as np
+
+from .utils import Span, VagueSpan, SpanResolver, load_examples, example_id, stored_example
+from .cache import DiskStore
+from .spanset import SpanSet, ReasonTable, NO_TASK
+from .catalog import load_example
+
+import pdb
+
+
+here = Path(__file__).parent
+
+MASK_CELLS = 1 << 22  # most mask cells (predictions x tasks x characters) to build at once, bounding memory use for long programs
+
+
+@dataclass
+class Prediction:
+    source: str         # where the prediction came from (e.g. a results file, or a cache fingerprint). Scores are aggregated per source
+    example: str        # see `example_id`
+    spans: Sequence[Span]  # usually a SpanSet
+
+
+@dataclass
+class GoldExample:
+    length: int         # number of characters in the code
+    spans: list[Span]   # spans with task None count for every task
+
+
+def load_gold(paths: Iterable[Path]) -> dict[str, GoldExample]:
+    """Load the gold spans of every annotated example in the given files, keyed by `example_id`"""
+    gold: dict[str, GoldExample] = {}
+    for path in paths:
+        for index, example in enumerate(load_examples(path, with_gold=True)):
+            if 'gold' not in example:
+                continue
+            resolver = SpanResolver(example['code'])
+            spans = []
+            for gold_span in example['gold']:
+                try:
+                    span = resolver.resolve(VagueSpan(gold_span['start_line'], gold_span['quote'], gold_span.get('reason', '')))
+                except ValueError as e:
+                    raise ValueError(f'{path} example {index}: could not locate gold span on line {gold_span["start_line"]}: {e}') from e
+                span.task = gold_span.get('task')
+                spans.append(span)
+            gold[example_id(example)] = GoldExample(length=len(example['code']), spans=spans)
+    return gold
+
+
+def predictions_from_results(path: Path, table: ReasonTable | None = None) -> Iterator[Prediction]:
+    """Predictions from a batch.py results file. Failed reviews are skipped. Reasons are interned in `table` (if given)"""
+    if table is None:
+        table = ReasonTable()
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['spans'] is None:
+                continue
+            if 'example' in record:
+                reviewed = record['example']
+            else:
+                # older results files don't record the example id, so go by its position in the example file
+                example = load_example(Path(record['path']), record['index'])
+                if example['query'] != record['query']:
+                    raise ValueError(f'{path}: example {record["index"]} of {record["path"]} has changed since it was reviewed')
+                reviewed = example_id(example)
+            yield Prediction(source=str(path), example=reviewed, spans=SpanSet.from_dicts(record['spans'], table))
+
+
+def predictions_from_cache(store: DiskStore | None = None, table: ReasonTable | None = None) -> Iterator[Prediction]:
+    """
+    Predictions from every entry in the review_code cache, including stale ones (e.g. from earlier prompts or
+    models), each sourced by its fingerprint. Reasons are interned in `table` (if given)
+    """
+    if table is None:
+        table = ReasonTable()
+    if store is None:
+        from .review import review_code
+        store = review_code.cache  # type: ignore[attr-defined]
+    for key, fingerprint, value in store.items():
+        yield Prediction(
+            source=f'cache:{(fingerprint or "legacy")[:8]}',
+            example=example_id(stored_example(store, key)),
+            spans=SpanSet.from_dicts(json.loads(value), table),
+        )
+
+
+def interval_masks(length: int, rows: np.ndarray, starts: np.ndarray, stops: np.ndarray, n_rows: int) -> np.ndarray:
+    """
+    Character masks of sets of intervals.
+
+    Returns:
+        np.ndarray: (n_rows, length) bool array, True wherever some interval [starts[i], stops[i]) of row rows[i] covers
+    """
+    width = length + 1
+    starts = np.clip(starts, 0, length)
+    stops = np.clip(stops, 0, length)
+    diff = np.bincount(rows * width + starts, minlength=n_rows * width) - np.bincount(rows * width + stops, minlength=n_rows * width)
+    return np.cumsum(diff.reshape(n_rows, width), axis=1, dtype=np.int32)[:, :length] > 0
+
+
+def as_spanset(spans: Sequence[Span]) -> SpanSet:
+    return spans if isinstance(spans, SpanSet) else SpanSet.from_spans(spans)
+
+
+def span_rows(spans_per_item: list[SpanSet], n_tasks: int, tag_all: bool) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Flatten spans into (row, start, stop) arrays, with n_tasks + 1 rows per item: row 0 holds all of the item's spans,
+    row t + 1 the spans of task t. Spans without a task only go in row 0, unless `tag_all` (then they also go in every task row)
+    """
+    width = n_tasks + 1
+    empty: np.ndarray = np.zeros(0, dtype=np.int64)  # any dtype, so it can stand in for the int32/int16 columns
+    item = np.repeat(np.arange(len(spans_per_item), dtype=np.int64), [len(spans) for spans in spans_per_item])
+    starts = np.concatenate([spans.starts for spans in spans_per_item] or [empty]).astype(np.int64)
+    stops = np.concatenate([spans.stops for spans in spans_per_item] or [empty]).astype(np.int64)
+    tasks = np.concatenate([spans.tasks for spans in spans_per_item] or [empty]).astype(np.int64)
+
+    tagged = tasks != NO_TASK
+    rows, row_starts, row_stops = [item * width, item[tagged] * width + tasks[tagged] + 1], [starts, starts[tagged]], [stops, stops[tagged]]
+    if tag_all:
+        untagged = ~tagged
+        for task in range(n_tasks):
+            rows.append(item[untagged] * width + task + 1)
+            row_starts.append(starts[untagged])
+            row_stops.append(stops[untagged])
+    return np.concatenate(rows), np.concatenate(row_starts), np.concatenate(row_stops)
+
+
+@dataclass
+class Scores:
+    sources: np.ndarray     # (n,) source of each scored prediction
+    examples: np.ndarray    # (n,) example id of each scored prediction
+    tp: np.ndarray          # (n, n_tasks + 1) characters both predicted and gold. Column 0 is overall, column t + 1 is task t
+    predicted: np.ndarray   # (n, n_tasks + 1) characters predicted
+    gold: np.ndarray        # (n, n_tasks + 1) gold characters
+    skipped: int            # predictions for examples without gold annotations
+
+    @property
+    def n_tasks(self) -> int:
+        return self.tp.shape[1] - 1
+
+
+def score(predictions: Iterable[Prediction], gold: dict[str, GoldExample], chunk_size: int = 1024) -> Scores:
+    """
+    Count the character overlaps of each prediction with the gold spans of its example, overall and per task.
+
+    Args:
+        predictions (Iterable[Prediction]): the predictions to score
+        gold (dict[str, GoldExample]): gold spans by example id (see `load_gold`)
+        chunk_size (int, optional): most predictions to build masks for at once. Fewer are built at once for long
+            programs, so no more than MASK_CELLS mask cells are in memory. Defaults to 1024.
+
+    Returns:
+        Scores: the counts for every prediction of an annotated example
+    """
+    by_example: dict[str, list[tuple[str, SpanSet]]] = {}
+    skipped = 0
+    for prediction in predictions:
+        if prediction.example in gold:
+            by_example.setdefault(prediction.example, []).append((prediction.source, as_spanset(prediction.spans)))
+        else:
+            skipped += 1
+    gold_spans = {example: SpanSet.from_spans(g.spans) for example, g in gold.items()}
+
+    n_tasks = 1 + max(
+        (int(spans.tasks.max()) for spans in [*gold_spans.values(), *(s for ps in by_example.values() for _, s in ps)] if len(spans)),
+        default=-1,
+    )
+    width = n_tasks + 1
+
+    sources: list[str] = []
+    examples: list[str] = []
+    tp: list[np.ndarray] = []
+    predicted: list[np.ndarray] = []
+    gold_counts: list[np.ndarray] = []
+    for example, example_predictions in by_example.items():
+        g = gold[example]
+        gold_mask = interval_masks(g.length, *span_rows([gold_spans[example]], n_tasks, tag_all=True), width)
+        gold_len = gold_mask.sum(axis=1)
+        rows = max(1, min(chunk_size, MASK_CELLS // (width * (g.length + 1))))
+        for i in range(0, len(example_predictions), rows):
+            chunk = example_predictions[i:i + rows]
+            mask = interval_masks(g.length, *span_rows([spans for _, spans in chunk], n_tasks, tag_all=False), len(chunk) * width)
+            mask = mask.reshape(len(chunk), width, g.length)
+            tp.append((mask & gold_mask).sum(axis=2))
+            predicted.append(mask.sum(axis=2))
+            gold_counts.append(np.broadcast_to(gold_len, (len(chunk), width)))
+            sources.extend(source for source, _ in chunk)
+            examples.extend(example for _ in chunk)
+
+    empty = np.zeros((0, width), dtype=np.int64)
+    return Scores(
+        sources=np.array(sources, dtype=object),
+        examples=np.array(examples, dtype=object),
+        tp=np.concatenate(tp) if tp else empty,
+        predicted=np.concatenate(predicted) if predicted else empty,
+        gold=np.concatenate(gold_counts) if gold_counts else empty,
+        skipped=skipped,
+    )
+
+
+def metrics(tp: np.ndarray, predicted: np.ndarray, gold: np.ndarray) -> dict[str, np.ndarray]:
+    """Elementwise precision, recall, F1 and IoU from character counts. Undefined values (e.g. precision with nothing predicted) are NaN"""
+    tp, predicted, gold = (np.asarray(a, dtype=float) for a in (tp, predicted, gold))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return {
+            'precision': tp / predicted,
+            'recall': tp / gold,
+            'f1': 2 * tp / (predicted + gold),
+            'iou': tp / (predicted + gold - tp),
+        }
+
+
+def summarize(scores: Scores) -> dict[str, dict]:
+    """
+    Aggregate scores per source: micro averages (from the summed character counts) and the macro average
+    F1 (mean over predictions), overall and per task.
+    """
+    summary = {}
+    for source in dict.fromkeys(scores.sources):
+        rows = scores.sources == source
+        tp, predicted, gold = scores.tp[rows], scores.predicted[rows], scores.gold[rows]
+        micro = metrics(tp.sum(axis=0), predicted.sum(axis=0), gold.sum(axis=0))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # columns that are all NaN average to NaN, as they should
+            macro_f1 = np.nanmean(metrics(tp, predicted, gold)['f1'], axis=0)
+        columns = [{**{name: float(values[t]) for name, values in micro.items()}, 'macro_f1': float(macro_f1[t])} for t in range(tp.shape[1])]
+        summary[source] = {
+            'n': int(rows.sum()),
+            'examples': len(set(scores.examples[rows])),
+            'overall': columns[0],
+            'tasks': {t: columns[t + 1] for t in range(scores.n_tasks)},
+        }
+    return summary
+
+
+def print_summary(summary: dict[str, dict]) -> None:
+    header = f'{"":8} {"P":>6} {"R":>6} {"F1":>6} {"IoU":>6} {"mF1":>6}'
+    for source, result in summary.items():
+        print(f'{source}  ({result["n"]} reviews of {result["examples"]} examples)')
+        print(header)
+        for label, m in [('overall', result['overall']), *((f'task {t}', m) for t, m in result['tasks'].items())]:
+            print(f'{label:8} ' + ' '.join(f'{m[name]:6.3f}' for name in ('precision', 'recall', 'f1', 'iou', 'macro_f1')))
+        print()
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description='Score reviews against the gold spans annotated in the example files')
+    parser.add_argument('results', nargs='*', type=Path, help='batch.py results files to score')
+    parser.add_argument('--cache', action='store_true', help='also score every review in the review_code cache')
+    parser.add_argument('--examples', nargs='+', type=Path, default=sorted((here.parent / 'examples').glob('*.yaml')), help='annotated example files')
+    parser.add_argument('--json', type=Path, help='also write the summary to this file as JSON')
+    args = parser.parse_args(argv)
+
+    predictions: list[Prediction] = []
+    for path in args.results:
+        predictions.extend(predictions_from_results(path))
+    if args.cache:
+        predictions.extend(predictions_from_cache())
+
+    gold = load_gold(args.examples)
+    if not gold:
+        parser.error('none of the example files have gold annotations')
+    scores = score(predictions, gold)
+    summary = summarize(scores)
+    print_summary(summary)
+    if scores.skipped:
+        print(f'({scores.skipped} reviews of examples without gold annotations were skipped)')
+    if args.json:
+        args.json.write_text(json.dumps(summary, indent=2))
+
+
+if __name__ == '__main__':
+    main()
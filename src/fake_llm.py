@@ -0,0 +1,288 @@
+"""
+Deterministic stand-in LLMs, for running reviews offline (benchmarks, tests) without API keys or network access.
+
+`FakeModel` is an archytas model whose tool calls come from a responder instead of an LLM:
+- `SyntheticResponder` picks lines out of the numbered code in the prompt and reports them as issues
+- `ReplayResponder` replays tool calls recorded from a real review (see `record_trace`)
+
+Register one under a model name with `register_fake_model`, then select it via `review.MODEL` (or `make_agent(model=...)`).
+`FakeSwitchAI` is the equivalent stand-in for the `switchai.SwitchAI` chat interface, and `FakeOpenAIServer` serves
+a responder over a local OpenAI compatible HTTP API (e.g. for `providers.openai_provider(base_url=server.url)`).
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import cycle
+from pathlib import Path
+from typing import Callable, Iterator
+from uuid import uuid4
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+
+from archytas.models.base import BaseArchytasModel, ModelConfig
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+
+import pdb
+
+
+ToolCall = dict  # {'name': str, 'args': dict}
+Responder = Callable[[list[BaseMessage]], list[ToolCall]]
+
+
+def final_answer(response: str = 'done') -> ToolCall:
+    return {'name': 'final_answer', 'args': {'response': response}}
+
+
+class FakeModel(BaseArchytasModel):
+    """
+    archytas model that answers every turn with the tool calls chosen by a responder, after an (optional) injected latency
+    """
+    def __init__(self, responder: Responder, latency: float = 0.0):
+        # no underlying langchain model or credentials, so skip BaseArchytasModel.__init__
+        self.config = ModelConfig(model_name='fake', api_key='')
+        self.model = None
+        self.lc_tools = None
+        self.responder = responder
+        self.latency = latency
+
+    def initialize_model(self, **kwargs):
+        return None
+
+    async def ainvoke(self, input, *, config=None, stop=None, agent_tools=None, **kwargs) -> AIMessage:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        calls = self.responder(input)
+        # rough token counts (~4 characters per token), so usage shows up in traces like a real provider's would
+        input_tokens = sum(len(str(message.content)) for message in input) // 4
+        output_tokens = len(json.dumps(calls)) // 4
+        return AIMessage(
+            content='',
+            tool_calls=[{'id': uuid4().hex, 'name': call['name'], 'args': {'thought': '', **call['args']}} for call in calls],
+            usage_metadata={'input_tokens': input_tokens, 'output_tokens': output_tokens, 'total_tokens': input_tokens + output_tokens},
+        )
+
+    def invoke(self, input, *, config=None, stop=None, agent_tools=None, **kwargs) -> AIMessage:
+        return asyncio.run(self.ainvoke(input, config=config, stop=stop, agent_tools=agent_tools, **kwargs))
+
+
+numbered_line = re.compile(r'^\s*(\d+)\| (.*)$', re.MULTILINE)
+
+class SyntheticResponder:
+    """
+    Responds to each new task with a single `add_spans` call flagging `spans_per_task` lines of the code under review,
+    and with a final answer once the tool result comes back.
+
+    Choices are seeded by the task text, so the same example and task always produce the same spans.
+    """
+    def __init__(self, spans_per_task: int = 3, seed: int = 0):
+        self.spans_per_task = spans_per_task
+        self.seed = seed
+
+    def __call__(self, messages: list[BaseMessage]) -> list[ToolCall]:
+        last = messages[-1]
+        if not isinstance(last, HumanMessage):
+            return [final_answer()]
+
+        lines = self.code_lines(messages)
+        rng = random.Random(f'{self.seed}:{last.content}')
+        picks = sorted(rng.sample(lines, min(self.spans_per_task, len(lines))))
+        spans = [{'start_line': line, 'quote': text.strip(), 'reason': f'synthetic issue on line {line}'} for line, text in picks]
+        return [{'name': 'add_spans', 'args': {'spans': spans}}]
+
+    @staticmethod
+    def code_lines(messages: list[BaseMessage]) -> list[tuple[int, str]]:
+        """the non-blank (line number, text) pairs of the numbered code in the first prompt that has any"""
+        for message in messages:
+            if isinstance(message, HumanMessage) and isinstance(message.content, str):
+                lines = [(int(num), text) for num, text in numbered_line.findall(message.content) if text.strip()]
+                if lines:
+                    return lines
+        return []
+
+
+class ReplayResponder:
+    """
+    Replays a recorded trace: a list of turns, each a list of tool calls. Once the trace runs out, every turn is a final answer.
+
+    Holds a position in the trace, so use a fresh instance per agent.
+    """
+    def __init__(self, trace: list[list[ToolCall]]):
+        self.turns = iter(trace)
+
+    def __call__(self, messages: list[BaseMessage]) -> list[ToolCall]:
+        return next(self.turns, [final_answer()])
+
+    @staticmethod
+    def load(path: Path) -> list[list[ToolCall]]:
+        return json.loads(path.read_text())
+
+
+def record_trace(messages: list[BaseMessage]) -> list[list[ToolCall]]:
+    """
+    Extract the tool calls of every model turn from an agent's message history, e.g. `record_trace(agent.messages)`,
+    for later replay with `ReplayResponder`.
+    """
+    trace = []
+    for message in messages:
+        if isinstance(message, AIMessage) and message.tool_calls:
+            trace.append([
+                {'name': call['name'], 'args': {k: v for k, v in call['args'].items() if k != 'thought'}}
+                for call in message.tool_calls
+            ])
+    return trace
+
+
+def register_fake_model(
+    name: str = 'fake',
+    responder: Callable[[], Responder] = SyntheticResponder,
+    latency: float = 0.0,
+) -> str:
+    """
+    Make `name` usable as a model name in review.py, constructing a new FakeModel (with a new responder) for every agent.
+
+    Args:
+        name (str, optional): the model name to register. Defaults to 'fake'.
+        responder (Callable[[], Responder], optional): factory for each agent's responder. Defaults to SyntheticResponder.
+        latency (float, optional): seconds to wait before each model turn, simulating network/generation time. Defaults to 0.0.
+
+    Returns:
+        str: the registered name
+    """
+    from .review import model_factories
+    model_factories[name] = lambda: FakeModel(responder(), latency=latency)
+    return name
+
+
+class FakeSwitchAI:
+    """
+    Stand-in for the chat interface of `switchai.SwitchAI`, cycling through canned replies after an (optional) injected latency
+    """
+    def __init__(self, replies: list[str] | None = None, latency: float = 0.0, chunk_size: int = 16):
+        self.replies = cycle(replies or ['ok'])
+        self.latency = latency
+        self.chunk_size = chunk_size
+
+    def chat(self, messages, temperature=1.0, max_tokens=None, tools=None, response_format=None, stream=False):
+        from switchai.types import ChatMessage, ChatResponse, ChatUsage
+
+        reply = next(self.replies)
+        time.sleep(self.latency)
+        input_tokens = sum(len(str(m.get('content', '')).split()) for m in messages)
+        usage = ChatUsage(input_tokens=input_tokens, output_tokens=len(reply.split()), total_tokens=input_tokens + len(reply.split()))
+        if not stream:
+            return ChatResponse(id=uuid4().hex, message=ChatMessage(role='assistant', content=reply), usage=usage, finish_reason='completed')
+
+        def chunks() -> Iterator[ChatResponse]:
+            for i in range(0, len(reply), self.chunk_size):
+                yield ChatResponse(id=uuid4().hex, message=ChatMessage(role='assistant', content=reply[i:i+self.chunk_size]), usage=usage, finish_reason=None)
+        return chunks()
+
+
+class FakeOpenAIServer:
+    """
+    Local HTTP server speaking (the tool calling subset of) the OpenAI chat completions API, answering with a responder.
+
+    Latency and failures can be injected per request, e.g. to make the first request slow (to exercise hedging)
+    or every request fail (to exercise fallback). Counts requests and TCP connections, to check connection reuse.
+
+        with FakeOpenAIServer(latency=lambda n: 5.0 if n == 0 else 0.0) as server:
+            provider = openai_provider('local', base_url=server.url, api_key='local')
+    """
+    def __init__(
+        self,
+        responder: Responder | None = None,
+        latency: float | Callable[[int], float] = 0.0,
+        status: int | Callable[[int], int] = 200,
+    ):
+        self.responder = responder or SyntheticResponder()
+        self.latency = latency if callable(latency) else (lambda n: latency)
+        self.status = status if callable(status) else (lambda n: status)
+        self.requests = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.httpd.server_port}/v1'
+
+    def __enter__(self) -> 'FakeOpenAIServer':
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @staticmethod
+    def to_messages(messages: list[dict]) -> list[BaseMessage]:
+        kinds = {'system': SystemMessage, 'user': HumanMessage, 'assistant': AIMessage}
+        return [
+            ToolMessage(content=message.get('content') or '', tool_call_id=message.get('tool_call_id', ''))
+            if message['role'] == 'tool' else
+            kinds.get(message['role'], HumanMessage)(content=message.get('content') or '')
+            for message in messages
+        ]
+
+    def complete(self, request: dict) -> dict:
+        calls = self.responder(self.to_messages(request['messages']))
+        prompt_tokens = sum(len(str(message.get('content') or '')) for message in request['messages']) // 4
+        completion_tokens = len(json.dumps(calls)) // 4
+        return {
+            'id': f'chatcmpl-{uuid4().hex}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'fake'),
+            'choices': [{
+                'index': 0,
+                'message': {
+                    'role': 'assistant',
+                    'content': None,
+                    'tool_calls': [
+                        {'id': uuid4().hex, 'type': 'function', 'function': {'name': call['name'], 'arguments': json.dumps({'thought': '', **call['args']})}}
+                        for call in calls
+                    ],
+                },
+                'finish_reason': 'tool_calls',
+            }],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+        }
+
+    def handler(self) -> type[BaseHTTPRequestHandler]:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, so clients can reuse connections
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.connections += 1
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server.lock:
+                    n = server.requests
+                    server.requests += 1
+                time.sleep(server.latency(n))
+                status = server.status(n)
+                if status == 200:
+                    body = json.dumps(server.complete(request)).encode()
+                else:
+                    body = json.dumps({'error': {'message': f'injected failure {status}', 'type': 'server_error'}}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up on the request, e.g. a hedged request that lost
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,203 @@
+"""
+Incremental re-review of edited code.
+
+Any change to an example's code changes its `review_code` cache key, so a small edit would otherwise cost a
+whole new review. Instead, the new code is diffed against the most similar earlier review of the same query
+(from the review caches), the earlier spans over unchanged lines are moved to their new offsets, and only the
+changed hunks (with some surrounding context, and the program's imports as a header, see `chunking`) are
+reviewed again. The cost of a re-review is then proportional to the size of the edit.
+
+    spans = review_code_incremental(edited_example)
+"""
+from bisect import bisect_right
+from dataclasses import dataclass, replace
+from typing import Iterator
+import ast
+import difflib
+import json
+
+from .cache import DiskStore, diskcache, digest
+from .chunking import header_lines, line_offsets, make_chunk, review_chunks, query_tag
+from .utils import Example, Span, serialize_span, deserialize_span, call_example, vectorize
+from . import telemetry
+
+import pdb
+
+
+@dataclass
+class Plan:
+    kept: list[Span]              # earlier spans, moved to their offsets in the new code
+    hunks: list[tuple[int, int]]  # 1-based [first, last] line ranges of the new code to review again
+    n_lines: int                  # lines in the new code
+
+    @property
+    def rereview_lines(self) -> int:
+        return sum(last - first + 1 for first, last in self.hunks)
+
+
+def plan_incremental(old_code: str, old_spans: list[Span], new_code: str, context: int = 5) -> Plan:
+    """
+    Work out which earlier spans carry over to the new code, and which lines of the new code must be reviewed again.
+
+    A span carries over if all of its lines are unchanged and none of them fall in a hunk. A hunk covers the
+    changed lines plus `context` lines either side, extended to cover any span it partly overlaps, so that a
+    span is either carried over whole or found again by the re-review.
+
+    Args:
+        old_code (str): the code that was reviewed
+        old_spans (list[Span]): the spans selected in old_code
+        new_code (str): the edited code
+        context (int, optional): unchanged lines either side of each change to include in its hunk. Defaults to 5.
+    """
+    old_lines, new_lines = old_code.splitlines(keepends=True), new_code.splitlines(keepends=True)
+    old_offsets, new_offsets = line_offsets(old_code), line_offsets(new_code)
+    opcodes = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+
+    def new_line_of(old_line: int) -> int:
+        """the (0-based) line of the new code at the same place as an old line"""
+        for tag, i1, i2, j1, j2 in opcodes:
+            if i1 <= old_line < i2:
+                return j1 + (old_line - i1 if tag == 'equal' else min(old_line - i1, max(j2 - j1 - 1, 0)))
+        return len(new_lines)
+
+    # move the spans that lie entirely in unchanged lines, and mark the lines of the rest as needing review
+    moved: list[tuple[Span, int, int]] = []  # (span in new code, first line, last line), 0-based
+    dirty: list[tuple[int, int]] = []        # 0-based [first, last] new lines
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != 'equal':
+            dirty.append((j1, j2 - 1) if j2 > j1 else (j1 - 1, j1))  # a deletion dirties the lines either side
+    for span in old_spans:
+        if span.stop <= span.start:
+            continue
+        first = bisect_right(old_offsets, span.start) - 1
+        last = bisect_right(old_offsets, span.stop - 1) - 1
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == 'equal' and i1 <= first and last < i2:
+                shift = new_offsets[j1] - old_offsets[i1]
+                moved.append((replace(span, start=span.start + shift, stop=span.stop + shift), first - i1 + j1, last - i1 + j1))
+                break
+        else:
+            dirty.append((new_line_of(first), new_line_of(last)))
+
+    # grow the changes into hunks, until no carried over span partly overlaps one
+    n_lines = len(new_lines)
+    hunks = [(max(first - context, 0), min(last + context, n_lines - 1)) for first, last in dirty if n_lines]
+    while True:
+        hunks = merge_ranges(hunks)
+        overlapping = [(first, last) for _, first, last in moved if any(a <= last and first <= b for a, b in hunks)]
+        if not overlapping:
+            break
+        hunks += overlapping
+        moved = [(span, first, last) for span, first, last in moved if (first, last) not in overlapping]
+
+    return Plan([span for span, _, _ in moved], [(first + 1, last + 1) for first, last in hunks], n_lines)
+
+
+def merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+    """merge overlapping or adjacent inclusive ranges"""
+    merged: list[tuple[int, int]] = []
+    for first, last in sorted(ranges):
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+        else:
+            merged.append((first, last))
+    return merged
+
+
+def iter_reviews(store: DiskStore, tag: str, fingerprint: str) -> Iterator[tuple[Example, str]]:
+    """
+    (example, JSON encoded spans) of the current (non-stale) entries in a review cache with the given tag, newest first.
+    Only those entries are loaded, so the cost doesn't grow with the rest of the cache
+    """
+    for key, value in store.tagged(tag, fingerprint):
+        yield call_example(*store.load_call(key)), value
+
+
+def incremental_tag(example: Example, parallel: bool, context: int, max_rereview: float, base_fingerprint: str) -> str:
+    """Cache tag (see `cache.diskcache`) of an incremental review: a digest of its query and the `review_code` fingerprint it was based on"""
+    return digest(json.dumps([query_tag(example['query']), base_fingerprint]))
+
+
+def find_previous_review(example: Example, base_fingerprint: str) -> tuple[str, list[Span]] | None:
+    """
+    The earlier review of the same query whose code is most similar to the example's (newest first among equals).
+
+    Looks through both the `review_code` cache and earlier incremental reviews, using only reviews of whole programs
+    computed with the current prompts and model (`base_fingerprint` is that of `review_code`).
+
+    Returns:
+        tuple[str, list[Span]] | None: the code that was reviewed and its spans, or None if there is no earlier review
+    """
+    from .review import review_code
+
+    candidates = [(candidate['code'], value) for candidate, value in iter_reviews(review_code.cache, query_tag(example['query']), base_fingerprint)]  # type: ignore[attr-defined]
+    incremental = iter_reviews(
+        _review_code_incremental.cache,  # type: ignore[attr-defined]
+        incremental_tag(example, False, 0, 0.0, base_fingerprint),  # the tag only depends on the example and base_fingerprint
+        _review_code_incremental.fingerprint(),  # type: ignore[attr-defined]
+    )
+    candidates += [(candidate['code'], value) for candidate, value in incremental]
+    if not candidates:
+        return None
+
+    new_lines = example['code'].splitlines(keepends=True)
+    def similarity(code: str) -> float:
+        return difflib.SequenceMatcher(None, code.splitlines(keepends=True), new_lines, autojunk=False).ratio()
+    code, value = max(candidates, key=lambda candidate: similarity(candidate[0]))  # max keeps the first (newest) of ties
+    return code, [deserialize_span(span) for span in json.loads(value)]
+
+
+@diskcache(
+    serializer=vectorize(serialize_span),
+    deserializer=vectorize(deserialize_span),
+    depends_on=[plan_incremental, find_previous_review, make_chunk, review_chunks],
+    tag=incremental_tag,
+)
+def _review_code_incremental(example: Example, parallel: bool, context: int, max_rereview: float, base_fingerprint: str) -> list[Span]:
+    from .review import review_code
+
+    previous = find_previous_review(example, base_fingerprint)
+    if previous is None:
+        return review_code(example, parallel=parallel)
+    old_code, old_spans = previous
+    plan = plan_incremental(old_code, old_spans, example['code'], context)
+    if plan.rereview_lines > max_rereview * plan.n_lines:
+        return review_code(example, parallel=parallel)
+
+    code = example['code']
+    try:
+        header = header_lines(ast.parse(code))
+    except SyntaxError:
+        header = []
+    offsets = line_offsets(code)
+    chunks = [make_chunk(code, offsets, first, last, header) for first, last in plan.hunks]
+    with telemetry.span('review_code_incremental', hunks=len(chunks)):
+        telemetry.add('incremental.kept_spans', len(plan.kept))
+        telemetry.add('incremental.rereview_lines', plan.rereview_lines)
+        results = review_chunks(example, chunks, parallel)
+
+    # only spans starting in a hunk's own lines count, the rest (e.g. in its header) were carried over
+    spans = list(plan.kept)
+    for (first, last), hunk_spans in zip(plan.hunks, results):
+        spans.extend(span for span in hunk_spans if offsets[first - 1] <= span.start < offsets[last])
+    return sorted(spans, key=lambda span: (span.start, span.stop))
+
+
+def review_code_incremental(example: Example, parallel: bool = False, context: int = 5, max_rereview: float = 0.5) -> list[Span]:
+    """
+    Review an example, re-using the most similar earlier review of the same query for any unchanged code.
+
+    Falls back to a full `review_code` if there is no earlier review, or if more than `max_rereview` of the code
+    would need reviewing again anyway. Results are cached, so they can serve as the base of later re-reviews.
+
+    Args:
+        example (Example): the example to review
+        parallel (bool, optional): see `review_code`. Defaults to False.
+        context (int, optional): unchanged lines either side of each change to review again with it. Defaults to 5.
+        max_rereview (float, optional): largest fraction of the lines to re-review incrementally. Defaults to 0.5.
+
+    Returns:
+        list[Span]: the selected spans, each tagged with the index of the task that selected it
+    """
+    from .review import review_code
+    return _review_code_incremental(example, parallel, context, max_rereview, review_code.fingerprint())  # type: ignore[attr-defined]
@@ -0,0 +1,142 @@
+"""
+The catalog of example code issues (code-issues-examples.md) that review prompts draw on.
+
+The catalog is parsed once (per version of the file) into its numbered entries, and a TF-IDF index is built over
+them. For each example, only the entries most relevant to its query and code are put in the prompt, rather than
+the whole catalog. Everything is local: no embeddings or network calls.
+
+    catalog = load_catalog()
+    text = catalog.render(catalog.select(example['query'] + '\\n' + example['code'], k=8))
+"""
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+import keyword
+import re
+
+import numpy as np
+
+import pdb
+
+
+here = Path(__file__).parent
+default_catalog_path = here / 'code-issues-examples.md'
+
+STOPWORDS = frozenset(keyword.kwlist) | {
+    'the', 'and', 'for', 'that', 'this', 'with', 'are', 'not', 'but', 'from', 'all', 'any', 'can', 'has', 'have',
+    'its', 'into', 'may', 'might', 'should', 'would', 'which', 'when', 'than', 'then', 'there', 'these', 'they',
+    'was', 'were', 'will', 'what', 'where', 'who', 'how', 'also', 'only', 'such', 'each', 'other', 'use', 'used',
+    'using', 'code', 'task', 'issue', 'assumption', 'self', 'print', 'len', 'range', 'str', 'int', 'float', 'list', 'dict',
+}
+word = re.compile(r'[A-Z]?[a-z]+|[A-Z]+(?![a-z])')
+
+
+def tokenize(text: str) -> list[str]:
+    """lowercased words, with identifiers split on snake_case and camelCase, ignoring short words and stopwords"""
+    words = (w.lower() for w in word.findall(text))
+    return [w for w in words if len(w) > 2 and w not in STOPWORDS]
+
+
+@dataclass
+class IssueEntry:
+    number: int
+    title: str
+    category: str
+    text: str  # the entry's markdown, including its heading
+
+
+class IssueCatalog:
+    """Parsed issue entries, with a TF-IDF index over them"""
+    def __init__(self, title: str, entries: list[IssueEntry], source: str = ''):
+        self.title = title
+        self.entries = entries
+        self.source = source  # the markdown the catalog was parsed from
+
+        docs = [tokenize(f'{entry.category} {entry.title} {entry.title} {entry.text}') for entry in entries]
+        self.vocabulary = {term: i for i, term in enumerate(sorted({term for doc in docs for term in doc}))}
+        counts = np.zeros((len(entries), len(self.vocabulary)))
+        for row, doc in enumerate(docs):
+            np.add.at(counts[row], [self.vocabulary[term] for term in doc], 1)
+        self.idf = np.log((1 + len(entries)) / (1 + (counts > 0).sum(axis=0))) + 1
+        self.matrix = self.weigh(counts)
+
+    @classmethod
+    def parse(cls, text: str) -> 'IssueCatalog':
+        """Split the catalog markdown into its `### N. Title` entries, each under its `## Category`"""
+        title, category = '', ''
+        entries: list[IssueEntry] = []
+        current: list[str] | None = None
+        def finish():
+            if current is not None:
+                entries[-1].text = ''.join(current).strip()
+        for line in text.splitlines(keepends=True):
+            if line.startswith('# ') and not title:
+                title = line[2:].strip()
+            elif line.startswith('## '):
+                finish()
+                current = None
+                category = line[3:].strip()
+            elif match := re.match(r'### (\d+)\. (.*)', line):
+                finish()
+                current = [line]
+                entries.append(IssueEntry(int(match[1]), match[2].strip(), category, ''))
+            elif current is not None:
+                current.append(line)
+        finish()
+        return cls(title, entries, text)
+
+    def weigh(self, counts: np.ndarray) -> np.ndarray:
+        """L2 normalized (sublinear) TF-IDF rows from raw term counts"""
+        weights = np.log1p(counts) * self.idf
+        norms = np.linalg.norm(weights, axis=-1, keepdims=True)
+        return weights / np.where(norms == 0, 1, norms)
+
+    def scores(self, text: str) -> np.ndarray:
+        """cosine similarity of the text to each entry"""
+        counts = np.zeros(len(self.vocabulary))
+        np.add.at(counts, [i for term in tokenize(text) if (i := self.vocabulary.get(term)) is not None], 1)
+        return self.matrix @ self.weigh(counts)
+
+    def select(self, text: str, k: int) -> list[IssueEntry]:
+        """The k entries most relevant to the text, in catalog order"""
+        if k >= len(self.entries):
+            return list(self.entries)
+        best = np.argsort(-self.scores(text), kind='stable')[:k]
+        return [self.entries[i] for i in sorted(best)]
+
+    def render(self, entries: list[IssueEntry] | None = None) -> str:
+        """Markdown of the given entries (by default all of them) under their category headings"""
+        entries = self.entries if entries is None else entries
+        parts = [f'# {self.title}']
+        category = None
+        for entry in entries:
+            if entry.category != category:
+                category = entry.category
+                parts.append(f'## {category}')
+            parts.append(entry.text)
+        return '\n\n'.join(parts) + '\n'
+
+
+@lru_cache(maxsize=8)
+def _load_catalog(path: Path, mtime_ns: int) -> IssueCatalog:
+    return IssueCatalog.parse(path.read_text())
+
+
+def load_catalog(path: Path = default_catalog_path) -> IssueCatalog:
+    """The parsed catalog, cached in memory until the file changes"""
+    return _load_catalog(path, path.stat().st_mtime_ns)
+
+
+def issue_examples(example_text: str, k: int | None, path: Path = default_catalog_path) -> str:
+    """
+    The catalog text to put in a review prompt.
+
+    Args:
+        example_text (str): what the entries should be relevant to, e.g. the example's query and code
+        k (int, optional): how many entries to include. None includes the whole catalog, verbatim.
+        path (Path, optional): the catalog file. Defaults to code-issues-examples.md next to this module.
+    """
+    catalog = load_catalog(path)
+    if k is None:
+        return catalog.source
+    return catalog.render(catalog.select(example_text, k))
@@ -0,0 +1,291 @@
+"""
+Routing of model calls over a pool of providers.
+
+A `ProviderPool` sends each model turn to one of several providers (e.g. the same model at different endpoints or
+accounts), with:
+- a limit on concurrent requests and (optionally) on tokens per minute, per provider
+- one client per provider, shared by every agent, so HTTP connections are reused across reviews
+- hedging: if a request hasn't answered within `hedge_after` seconds, a duplicate is sent (to the next provider)
+  and whichever answers first is used, cutting the tail latency of slow responses
+- fallback: if every attempt fails, the request goes to the fallback providers (e.g. a secondary model) in order
+
+Every agent in review.py runs its own event loop (`asyncio.run`), while HTTP clients are tied to the loop they were
+created on, so the pool runs all requests on its own long-lived event loop in a background thread.
+
+    pool = ProviderPool(
+        [openai_provider('primary', 'gpt-4o', max_concurrency=8, tokens_per_minute=30_000)],
+        fallback=[openai_provider('secondary', 'gpt-4o-mini')],
+        hedge_after=20.0,
+    )
+    review.MODEL = register_pool('pooled', pool)
+"""
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable
+import asyncio
+import threading
+import time
+
+from archytas.models.base import BaseArchytasModel
+from archytas.models.openai import OpenAIModel
+from langchain_core.messages import AIMessage, BaseMessage
+
+from .utils import estimate_tokens
+from . import telemetry
+
+import pdb
+
+
+class TokenBucket:
+    """
+    Tokens-per-minute limit. A request reserves its estimated tokens up front (waiting while the bucket is in
+    debt), and the estimate is corrected with the actual usage once the response arrives.
+    """
+    def __init__(self, tokens_per_minute: float):
+        self.rate = tokens_per_minute / 60
+        self.capacity = tokens_per_minute
+        self.level = tokens_per_minute
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: int) -> None:
+        self.refill()
+        self.level -= tokens
+        if self.level < 0:
+            await asyncio.sleep(-self.level / self.rate)
+
+    def correct(self, tokens: int) -> None:
+        """account for `tokens` more (or, if negative, fewer) tokens than were reserved"""
+        self.refill()
+        self.level -= tokens
+
+
+@dataclass(eq=False)
+class Provider:
+    """
+    One model endpoint. The model is created once (on first use) and shared by every request, so `factory`
+    should return a model that is safe to call concurrently.
+    """
+    name: str
+    factory: Callable[[], BaseArchytasModel]
+    max_concurrency: int = 8
+    tokens_per_minute: float | None = None
+
+    # created on first use (the limits on the pool's event loop, which they belong to)
+    _model: BaseArchytasModel | None = field(default=None, init=False, repr=False)
+    _semaphore: asyncio.Semaphore | None = field(default=None, init=False, repr=False)
+    _bucket: TokenBucket | None = field(default=None, init=False, repr=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def model(self) -> BaseArchytasModel:
+        with self._lock:
+            if self._model is None:
+                self._model = self.factory()
+            return self._model
+
+    def limits(self) -> tuple[asyncio.Semaphore, TokenBucket | None]:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+            self._bucket = TokenBucket(self.tokens_per_minute) if self.tokens_per_minute else None
+        return self._semaphore, self._bucket
+
+
+class PooledOpenAIModel(OpenAIModel):
+    """OpenAIModel for an OpenAI compatible endpoint, with its own base url and key (rather than the process wide environment)"""
+    def __init__(self, model_name: str, base_url: str | None = None, api_key: str | None = None, timeout: float = 120.0, max_retries: int = 2):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        super().__init__({'model_name': model_name, 'api_key': api_key or ''})
+
+    def auth(self, **kwargs) -> None:
+        pass  # the key goes straight to the client (or, if not given, the client reads OPENAI_API_KEY)
+
+    def initialize_model(self, **kwargs):
+        from langchain_openai.chat_models import ChatOpenAI
+        return ChatOpenAI(
+            model=self.config['model_name'],
+            base_url=self.base_url,
+            api_key=self.config['api_key'] or None,
+            timeout=self.timeout,
+            max_retries=self.max_retries,
+        )
+
+
+def openai_provider(
+    name: str,
+    model: str = 'gpt-4o',
+    base_url: str | None = None,
+    api_key: str | None = None,
+    max_concurrency: int = 8,
+    tokens_per_minute: float | None = None,
+    timeout: float = 120.0,
+) -> Provider:
+    """
+    A provider for OpenAI, or any server with an OpenAI compatible chat completions API.
+
+    Args:
+        name (str): name of the provider, used in telemetry counters
+        model (str, optional): the model name to request. Defaults to 'gpt-4o'.
+        base_url (str, optional): the API base url, e.g. 'http://localhost:8000/v1'. Defaults to OpenAI's (or OPENAI_BASE_URL).
+        api_key (str, optional): the API key. Defaults to the OPENAI_API_KEY environment variable.
+        max_concurrency (int, optional): maximum requests in flight to this provider. Defaults to 8.
+        tokens_per_minute (float, optional): maximum (estimated) tokens per minute to this provider. Defaults to no limit.
+        timeout (float, optional): seconds before a request fails. Defaults to 120.0.
+    """
+    return Provider(name, lambda: PooledOpenAIModel(model, base_url, api_key, timeout), max_concurrency, tokens_per_minute)
+
+
+class ProviderPool:
+    """
+    Routes model turns over providers (see the module docstring). Safe to share between threads and agents.
+
+    Args:
+        providers (list[Provider]): the providers to spread requests (and hedges) over, in turn
+        fallback (list[Provider], optional): providers to try, in order, once every attempt at the others has failed
+        hedge_after (float, optional): seconds to wait for an answer before sending a duplicate request. Defaults to never.
+        max_hedges (int, optional): maximum duplicate requests per turn. Defaults to 1.
+    """
+    def __init__(self, providers: list[Provider], fallback: list[Provider] = [], hedge_after: float | None = None, max_hedges: int = 1):
+        if not providers:
+            raise ValueError('a ProviderPool needs at least one provider')
+        self.providers = list(providers)
+        self.fallback = list(fallback)
+        self.hedge_after = hedge_after
+        self.max_hedges = max_hedges
+        self.stats: Counter[str] = Counter()  # requests, hedges, fallbacks, errors and wins, overall and per provider
+        self._next = 0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, name='provider-pool', daemon=True).start()
+            return self._loop
+
+    def close(self) -> None:
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+    def count(self, name: str, provider: Provider | None = None) -> None:
+        self.stats[name] += 1
+        telemetry.add(f'providers.{name}')
+        if provider is not None:
+            self.stats[f'{provider.name}.{name}'] += 1
+            telemetry.add(f'providers.{provider.name}.{name}')
+
+    async def ainvoke(self, input: list[BaseMessage], **kwargs) -> AIMessage:
+        """Run a model turn on the pool's event loop (from any other event loop)"""
+        # scheduled from this thread, so the request runs in a copy of the current context (e.g. the telemetry span)
+        future = asyncio.run_coroutine_threadsafe(self.route(input, kwargs), self.loop())
+        return await asyncio.wrap_future(future)
+
+    async def call(self, provider: Provider, input: list[BaseMessage], kwargs: dict[str, Any]) -> AIMessage:
+        semaphore, bucket = provider.limits()
+        async with semaphore:
+            estimate = estimate_tokens(input)
+            if bucket is not None:
+                await bucket.acquire(estimate)
+            self.count('requests', provider)
+            result = await provider.model().ainvoke(input, **kwargs)
+            usage = getattr(result, 'usage_metadata', None)
+            if bucket is not None and usage:
+                bucket.correct(usage['total_tokens'] - estimate)
+            return result
+
+    async def route(self, input: list[BaseMessage], kwargs: dict[str, Any]) -> AIMessage:
+        start = self._next
+        self._next = (self._next + 1) % len(self.providers)
+        # after a failure, any provider not tried yet (the other primaries, then the fallbacks)
+        untried = self.providers[start + 1:] + self.providers[:start] + self.fallback
+        attempts: dict[asyncio.Task, Provider] = {}
+
+        def launch(provider: Provider) -> None:
+            attempts[asyncio.create_task(self.call(provider, input, kwargs))] = provider
+            if provider in untried:
+                untried.remove(provider)
+
+        launch(self.providers[start])
+        n_hedges = 0
+        error: BaseException | None = None
+        try:
+            while attempts:
+                hedging = self.hedge_after is not None and n_hedges < self.max_hedges
+                done, _ = await asyncio.wait(attempts, timeout=self.hedge_after if hedging else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    n_hedges += 1
+                    provider = self.providers[(start + n_hedges) % len(self.providers)]
+                    self.count('hedges', provider)
+                    launch(provider)
+                    continue
+                for task in done:
+                    provider = attempts.pop(task)
+                    if task.exception() is None:
+                        self.count('wins', provider)
+                        return task.result()
+                    error = task.exception()
+                    self.count('errors', provider)
+                if not attempts and untried:
+                    provider = untried[0]
+                    if provider in self.fallback:
+                        self.count('fallbacks', provider)
+                    launch(provider)
+            assert error is not None
+            raise error
+        finally:
+            for task in attempts:
+                task.cancel()
+
+
+class RoutedModel(BaseArchytasModel):
+    """
+    archytas model that sends every turn through a ProviderPool. One is created per agent, while the providers'
+    models are shared, so all agents using a pool must have the same tools (as review agents do).
+    """
+    def __init__(self, pool: ProviderPool):
+        # no model of its own, so skip BaseArchytasModel.__init__
+        self.pool = pool
+        self.lc_tools = None
+        self.agent_tools: dict | None = None
+        self.model = None
+        self.config = pool.providers[0].model().config
+
+    def initialize_model(self, **kwargs):
+        return None
+
+    @property
+    def MODEL_PROMPT_INSTRUCTIONS(self) -> str:  # type: ignore[override]
+        return self.pool.providers[0].model().MODEL_PROMPT_INSTRUCTIONS
+
+    def set_tools(self, agent_tools: dict):
+        self.agent_tools = agent_tools
+        return super().set_tools(agent_tools)
+
+    async def ainvoke(self, input, *, config=None, stop=None, agent_tools: dict | None = None, **kwargs) -> AIMessage:
+        return await self.pool.ainvoke(input, config=config, stop=stop, agent_tools=agent_tools or self.agent_tools, **kwargs)
+
+    def _rectify_result(self, response_message: AIMessage):
+        return self.pool.providers[0].model()._rectify_result(response_message)
+
+    def process_result(self, response_message: AIMessage):
+        return self.pool.providers[0].model().process_result(response_message)
+
+
+def register_pool(name: str, pool: ProviderPool) -> str:
+    """
+    Make `name` usable as a model name in review.py, routing every agent's turns through the pool.
+
+    Returns:
+        str: the registered name
+    """
+    from .review import model_factories
+    model_factories[name] = lambda: RoutedModel(pool)
+    return name
@@ -1,12 +1,24 @@
 # from switchai import SwitchAI
-from .utils import Example, VagueSpan, Span, serialize_span, deserialize_span, vectorize, pinpoint_span, add_line_numbers
-from .cache import diskcache
+from .utils import Example, VagueSpan, Span, SpanResolver, serialize_span, deserialize_span, vectorize, add_line_numbers, estimate_tokens
+from .cache import diskcache, digest
+from .chunking import review_tag
+from .issues import issue_examples
+from . import telemetry
 
 from archytas.tool_utils import tool
 from archytas.react import ReActAgent
+from archytas.models.base import BaseArchytasModel
 # from archytas.agent import Message, Role
 from langchain_core.messages import HumanMessage
+from collections import Counter
+from contextvars import ContextVar, copy_context
+from dataclasses import replace
 from pathlib import Path
+from typing import Callable, Iterator, Literal
+import asyncio
+import json
+import queue
+import threading
 
 
 here = Path(__file__).parent
@@ -14,6 +26,10 @@ here = Path(__file__).parent
 import pdb
 
 
+# set to False to keep agents from showing a terminal spinner, e.g. while something else holds rich's live display
+show_spinner: ContextVar[bool] = ContextVar('show_spinner', default=True)
+
+
 review_tasks = [
     'Identify all constrained parameters in the code. constrained parameters in this context are any parameters that were selected either explicitly or implicitly that are somehow indicated by the original query. Parameters in this context means anything that would affect the output from the code were it changed, think function arguments, api request parameters, other various settings, etc.',
     'Identify all free parameters in the code. This is the opposite of constrained, i.e. query does not mention or touch on them implicitly or explicitly, and so the code is directly making an assumption about what they should be',
@@ -35,10 +51,29 @@ review_tasks = [
 # So when you are given a task on some code, you will respond with a list of spans
 # """
 
+# if set, called with each span as soon as a CodeReview resolves it (see review_code_stream)
+span_listener: ContextVar[Callable[[Span], None] | None] = ContextVar('span_listener', default=None)
+
+# if set, reviews check it before starting each task, and stop with ReviewCancelled once it is set (see review_code_stream)
+cancel_event: ContextVar[threading.Event | None] = ContextVar('cancel_event', default=None)
+
+
+class ReviewCancelled(Exception):
+    """A review was stopped early because nothing is waiting for its result any more"""
+
+
+def check_cancelled() -> None:
+    if (event := cancel_event.get()) is not None and event.is_set():
+        raise ReviewCancelled()
+
+
 class CodeReview:
-    def __init__(self, example: Example):
+    def __init__(self, example: Example, task: int | None = None):
         self.example = example
+        self.task = task  # index of the review task currently being worked on. Selected spans are tagged with it
+        self.resolver = SpanResolver(example['code'])
         self.spans: list[Span] = []
+        self.failed_lines: set[int] = set()  # start lines of spans that failed to resolve, to spot resubmissions
     
     @tool
     def add_span(self, start_line:int, quote: str, reason: str) -> bool:
@@ -55,12 +90,67 @@ class CodeReview:
         """
         # TBD if tell the agent this below, perhaps pinpoint span will check against both versions
         # Note: the code quote should not include the line numbers
-        span = VagueSpan(start_line=start_line, quote=quote, reason=reason)
-        span = pinpoint_span(span, self.example['code'])
-        self.spans.append(span)
+        telemetry.add('review.tool_calls')
+        span = self._resolve(VagueSpan(start_line=start_line, quote=quote, reason=reason))
+        self._save(span)
         return True
+
+    @tool
+    def add_spans(self, spans: list[VagueSpan]) -> str:
+        """
+        Identify several spans of code that match the given criteria at once, and save them to the list of spans.
+        Prefer this over calling add_span repeatedly, and submit all of your selections for a task in a single call.
+
+        Each span is an object with the following fields:
+            start_line (int): The line number on which the span starts (use line numbers as they appear in the code)
+            quote (str): A verbatim string of the entire portion of code that you are selecting. Do not include line numbers in this quote
+            reason (str): A brief explanation of why you selected this span
+
+        Args:
+            spans (list[VagueSpan]): The spans to add
+
+        Returns:
+            str: a report of which spans were added. Spans that failed are not added, and should be fixed and resubmitted
+        """
+        telemetry.add('review.tool_calls')
+        report = []
+        n_failed = 0
+        for i, vague_span in enumerate(spans, 1):
+            try:
+                span = self._resolve(vague_span)
+            except ValueError as e:
+                n_failed += 1
+                report.append(f'span {i}: FAILED. {e}')
+                continue
+            self._save(span)
+            report.append(f'span {i}: added')
+
+        summary = f'{len(spans) - n_failed} of {len(spans)} spans added.'
+        if n_failed:
+            summary += ' Fix and resubmit only the FAILED spans.'
+        return '\n'.join([summary, *report])
     
 
+    def _resolve(self, vague_span: VagueSpan) -> Span:
+        """Resolve a span submitted by the agent, counting resolution failures and resubmissions of failed spans"""
+        telemetry.add('review.spans_submitted')
+        if vague_span.start_line in self.failed_lines:
+            telemetry.add('review.resolution_retries')
+        try:
+            span = self.resolver.resolve(vague_span)
+        except ValueError:
+            self.failed_lines.add(vague_span.start_line)
+            telemetry.add('review.resolution_failures')
+            raise
+        self.failed_lines.discard(vague_span.start_line)
+        return span
+
+    def _save(self, span: Span) -> None:
+        span.task = self.task
+        self.spans.append(span)
+        if (listener := span_listener.get()) is not None:
+            listener(span)
+
     # @tool
     def view_code(self) -> str:
         """
@@ -73,46 +163,260 @@ class CodeReview:
         
 
 
-@diskcache(serializer=vectorize(serialize_span), deserializer=vectorize(deserialize_span))
-def review_code(example: Example) -> list[Span]:
-    task0 = review_tasks[0]
-    review = CodeReview(example)
-    tools = [review]
-    prompt_message = HumanMessage(content=f'''\
+MODEL = 'gpt-4o'
+
+# how many entries of code-issues-examples.md to put in each review prompt, picked by relevance to the example
+# (see issues.py). None puts in the whole catalog
+ISSUE_EXAMPLES: int | None = 8
+
+# eviction limits of the review caches, enforced in the background on first use. Entries cached under other models,
+# prompts or settings are kept (in case they are switched back to) until they fall outside these limits, or are
+# removed with `llm-review cache compact --stale`
+CACHE_MAX_ENTRIES = 10_000
+CACHE_MAX_AGE = 90 * 24 * 60 * 60  # seconds
+
+# models that are constructed locally rather than looked up by name by archytas (e.g. the stand-ins in fake_llm)
+model_factories: dict[str, Callable[[], BaseArchytasModel]] = {}
+
+REVIEW_PROMPT = '''\
 You are an expert code reviewer. Your job is to identify various assumptions or deficiencies in given pieces of code.
 Here is a large collection of the kinds of issues you should be looking for: 
-{(here / 'code-issues-examples.md').read_text()}
+{issue_examples}
 
 
-{'-'*80}
+{divider}
 
 In general, I will give you a piece of code, the task that the code was attempting to complete, and a specific direction for the kind of issues to look for. At a high level, the goal is to identify sections that might need review from a domain expert.
-''')
-    agent = ReActAgent(model='gpt-4o', tools=tools, messages=[prompt_message], allow_ask_user=False, verbose=False)
-    res = agent.react(f'''\
+'''
+
+# the code comes before the task so that every task shares the same prompt prefix
+FIRST_TASK_PROMPT = '''\
 Please review the following code
                 
 Code:
 ```python
-# Query: {example['query']}
+# Query: {query}
 
-{add_line_numbers(example['code'])}
+{numbered_code}
 ```
 
 Task:
-{task0}
+{task}
 
-Please use the CodeReview.add_span tool to indicate your selections.
-''')
-    # print(res)
-    for taskN in review_tasks[1:]:
-        res = agent.react(f'''\
+Please use the CodeReview.add_spans tool to indicate your selections, submitting all of them in a single call.
+'''
+
+NEXT_TASK_PROMPT = '''\
 Now I would like you to review the code again (select spans) for this task:
-{taskN}
-''')
-        # print(res)
+{task}
+'''
+
+# how the sequential review condenses the conversation between tasks (see compact_history):
+#   'off': keep every earlier task's full transcript
+#   'summary': replace the finished tasks' transcripts with a short list of the spans they selected
+#   'drop': remove the finished tasks' transcripts entirely
+COMPACTION: Literal['off', 'summary', 'drop'] = 'summary'
+
+COMPACTED_TASKS_PROMPT = '''\
+(The transcript of the earlier tasks has been condensed.) For those tasks you selected these spans:
+{selections}
+
+'''
+
+
+def review_prompt(example: Example) -> str:
+    return REVIEW_PROMPT.format(
+        issue_examples=issue_examples(f'{example["query"]}\n{example["code"]}', ISSUE_EXAMPLES),
+        divider='-'*80,
+    )
+
+
+def make_agent(review: CodeReview, model: str | None = None, spinner: bool | None = None) -> ReActAgent:
+    """
+    Create a fresh review agent whose only tool is the given CodeReview
+
+    Args:
+        review (CodeReview): the review the agent will add its selected spans to
+        model (str, optional): the model to use. Defaults to MODEL
+        spinner (bool, optional): whether to show a terminal spinner while waiting on the model. Must be False
+            when several agents run at once, since only one live display may be active at a time. Defaults to
+            showing one only on the main thread (so agents in worker threads, e.g. batch.py, never collide), and
+            only if `show_spinner` is set.
+    """
+    prompt_message = HumanMessage(content=review_prompt(review.example))
+    model = model or MODEL
+    llm = model_factories[model]() if model in model_factories else model
+    if spinner is None:
+        spinner = show_spinner.get() and threading.current_thread() is threading.main_thread()
+    kwargs = {} if spinner else {'spinner': None}
+    agent = ReActAgent(model=llm, tools=[review], messages=[prompt_message], allow_ask_user=False, verbose=False, **kwargs)
+    if telemetry.enabled():
+        telemetry.instrument_model(agent.model)
+    return agent
+
+
+def summarize_selections(review: CodeReview, n_tasks: int) -> str:
+    """one line per span selected in the first n_tasks tasks: its line, the start of its quote, and the start of its reason"""
+    code = review.example['code']
+    lines = []
+    for task in range(n_tasks):
+        lines.append(f'Task {task + 1}:')
+        spans = [span for span in review.spans if span.task == task]
+        for span in spans:
+            line = code.count('\n', 0, span.start) + 1
+            quote = code[span.start:span.stop].strip().split('\n')[0][:60]
+            reason = span.reason.strip().split('\n')[0][:100]
+            lines.append(f'- line {line}: `{quote}`: {reason}')
+        if not spans:
+            lines.append('- (none)')
+    return '\n'.join(lines)
+
+
+def compact_history(agent: ReActAgent, review: CodeReview, n_tasks: int, compaction: str | None = None) -> str:
+    """
+    Condense the transcripts of the finished tasks, keeping only the review prompt and the first task's prompt (which
+    holds the code), so later tasks don't pay for every earlier tool call and result.
+
+    Args:
+        agent (ReActAgent): the review agent, between tasks
+        review (CodeReview): the agent's review
+        n_tasks (int): the number of tasks finished so far
+        compaction (str, optional): 'off', 'summary' or 'drop' (see COMPACTION). Defaults to COMPACTION.
+
+    Returns:
+        str: text to start the next task's prompt with (the summary of the earlier selections, if any)
+    """
+    compaction = compaction or COMPACTION
+    if compaction == 'off':
+        return ''
+    before = estimate_tokens(agent.messages)
+    del agent.messages[2:]
+    prefix = COMPACTED_TASKS_PROMPT.format(selections=summarize_selections(review, n_tasks)) if compaction == 'summary' else ''
+    telemetry.add('review.compaction.tokens_saved', before - estimate_tokens(agent.messages) - len(prefix) // 4)
+    return prefix
+
+
+def first_task_prompt(example: Example, task: str) -> str:
+    return FIRST_TASK_PROMPT.format(query=example['query'], numbered_code=add_line_numbers(example['code']), task=task)
+
+
+def prompt_version() -> str:
+    """Digest of all the prompt text that an independent review task sees (besides the example and the task itself)"""
+    return digest(json.dumps([REVIEW_PROMPT, FIRST_TASK_PROMPT, (here / 'code-issues-examples.md').read_text(), ISSUE_EXAMPLES]))
+
+
+@diskcache(
+    serializer=vectorize(serialize_span),
+    deserializer=vectorize(deserialize_span),
+    depends_on=[CodeReview, SpanResolver, make_agent, review_prompt, issue_examples, first_task_prompt],
+    max_entries=CACHE_MAX_ENTRIES,
+    max_age=CACHE_MAX_AGE,
+)
+def review_task(example: Example, task: str, model: str, prompt_version: str) -> list[Span]:
+    """
+    Run a single review task over an example, as its own agent conversation.
+
+    Results are cached per (example, task text, model, prompt version), so adding or rewording a review
+    task only sends that task to the model. Always pass every argument (rather than relying on defaults)
+    so they all make it into the cache key.
+
+    Args:
+        example (Example): the example to review
+        task (str): the text of the review task
+        model (str): the model to use
+        prompt_version (str): the current `prompt_version()`
+
+    Returns:
+        list[Span]: the spans selected for the task (untagged, see `review_tasks_parallel`)
+    """
+    review = CodeReview(example)
+    make_agent(review, model=model, spinner=False).react(first_task_prompt(example, task))
     return review.spans
 
+
+async def review_tasks_parallel(example: Example) -> list[Span]:
+    """
+    Run every review task as its own independent agent conversation, all concurrently.
+
+    Each agent starts from the same prefix (system prompt + numbered code), so latency is roughly that
+    of the slowest single task rather than the sum of all of them. Each task's result is cached
+    separately (see `review_task`), so only new or changed tasks are sent to the model.
+
+    Args:
+        example (Example): the example to review
+
+    Returns:
+        list[Span]: the spans from all tasks (tagged with their task), sorted by position
+    """
+    version = prompt_version()
+    listener = span_listener.get()
+
+    def run_task(i: int, task: str) -> list[Span]:
+        # runs in a copy of the current context, so this only tags the spans streamed from this task
+        if listener is not None:
+            span_listener.set(lambda span: listener(replace(span, task=i)))
+        check_cancelled()
+        with telemetry.span('review.task', task=i):
+            return review_task(example, task, MODEL, version)
+
+    results = await asyncio.gather(*(
+        asyncio.to_thread(run_task, i, task)
+        for i, task in enumerate(review_tasks)
+    ))
+    # copy rather than tag in place, since cached results may be shared
+    spans = [replace(span, task=i) for i, task_spans in enumerate(results) for span in task_spans]
+    return sorted(spans, key=lambda span: (span.start, span.stop))
+
+
+def review_settings() -> dict[str, object]:
+    """The module settings that review_code's results depend on and that may be changed at runtime (part of its cache key)"""
+    return {'model': MODEL, 'compaction': COMPACTION, 'issue_examples': ISSUE_EXAMPLES}
+
+
+@diskcache(
+    serializer=vectorize(serialize_span),
+    deserializer=vectorize(deserialize_span),
+    settings=review_settings,
+    depends_on=[
+        here / 'code-issues-examples.md', review_tasks, REVIEW_PROMPT, FIRST_TASK_PROMPT, NEXT_TASK_PROMPT,
+        COMPACTED_TASKS_PROMPT, CodeReview, SpanResolver, make_agent, review_prompt, issue_examples, first_task_prompt, review_task,
+        review_tasks_parallel, summarize_selections, compact_history,
+    ],
+    max_entries=CACHE_MAX_ENTRIES,
+    max_age=CACHE_MAX_AGE,
+    tag=review_tag,
+)
+def review_code(example: Example, parallel: bool = False) -> list[Span]:
+    """
+    Have an agent select spans of the example's code that need review, for each of the review tasks.
+
+    Args:
+        example (Example): the example to review
+        parallel (bool, optional): if True, run each review task as an independent concurrent agent
+            (see `review_tasks_parallel`) rather than one after another in a single conversation. Each task's
+            result is then also cached on its own, so only new or changed tasks are re-run. Defaults to False.
+
+    Returns:
+        list[Span]: the selected spans, each tagged with the index of the task that selected it
+    """
+    if parallel:
+        with telemetry.span('review_code', parallel=True):
+            return asyncio.run(review_tasks_parallel(example))
+
+    with telemetry.span('review_code', parallel=False):
+        review = CodeReview(example, task=0)
+        agent = make_agent(review)
+        with telemetry.span('review.task', task=0):
+            res = agent.react(first_task_prompt(example, review_tasks[0]))
+        # print(res)
+        for i, taskN in enumerate(review_tasks[1:], 1):
+            check_cancelled()
+            review.task = i
+            with telemetry.span('review.task', task=i):
+                res = agent.react(compact_history(agent, review, i) + NEXT_TASK_PROMPT.format(task=taskN))
+            # print(res)
+        return review.spans
+
     # # print out the result
     # for span in review.spans:
     #     print(f'Span:\n```\n{example["code"][span.start:span.stop]}\n```\n\nReason: {span.reason}\n')
@@ -122,4 +426,67 @@ Now I would like you to review the code again (select spans) for this task:
     # res = client.chat()
     # run through each of the review steps which return spans in the code
     pdb.set_trace()
-    ...
\ No newline at end of file
+    ...
+
+
+def review_code_stream(example: Example, parallel: bool = False) -> Iterator[Span]:
+    """
+    Like `review_code`, but yields each span as soon as the agent selects it, rather than all at the end.
+
+    The review runs in a background thread. If the result (or for parallel reviews, some of the tasks)
+    was already cached, those spans are yielded together once the review finishes.
+
+    If the stream is abandoned (closed, garbage collected, or interrupted e.g. by Ctrl-C), the review stops after
+    the task it is working on (parallel reviews after the tasks already running), and nothing is cached.
+
+    Args:
+        example (Example): the example to review
+        parallel (bool, optional): see `review_code`. Defaults to False.
+
+    Yields:
+        Span: the selected spans, each tagged with the index of the task that selected it
+    """
+    events: queue.Queue[tuple[str, object]] = queue.Queue()
+    abandoned = threading.Event()
+
+    def listener(span: Span) -> None:
+        if not abandoned.is_set():
+            events.put(('span', span))
+
+    def run():
+        span_listener.set(listener)
+        cancel_event.set(abandoned)
+        show_spinner.set(False)  # the caller is rendering the spans, likely in a live display of its own
+        try:
+            events.put(('done', review_code(example, parallel=parallel)))
+        except ReviewCancelled:
+            pass
+        except BaseException as e:
+            events.put(('error', e))
+
+    # run in a copy of this context, so e.g. an active trace or cache.disabled() carries over
+    threading.Thread(target=copy_context().run, args=(run,), daemon=True).start()
+
+    streamed: Counter[tuple] = Counter()
+    try:
+        while True:
+            kind, item = events.get()
+            if kind == 'span':
+                assert isinstance(item, Span)
+                streamed[(item.start, item.stop, item.reason, item.task)] += 1
+                yield item
+            elif kind == 'error':
+                assert isinstance(item, BaseException)
+                raise item
+            else:
+                # yield whatever didn't come through the listener (i.e. came from the cache)
+                assert isinstance(item, list)
+                for span in item:
+                    key = (span.start, span.stop, span.reason, span.task)
+                    if streamed[key]:
+                        streamed[key] -= 1
+                    else:
+                        yield span
+                return
+    finally:
+        abandoned.set()  # stops the review if the consumer stopped early
@@ -0,0 +1,189 @@
+"""
+Compact, array-backed storage for large numbers of spans (e.g. aggregated over many reviews).
+
+A `SpanSet` keeps starts, stops and tasks in NumPy arrays, and each reason as an index into a shared
+table of interned strings, so identical reasons (e.g. the same cached review loaded for many runs) are
+stored once. Sorting, merging, filtering and (de)serializing work on the arrays directly. It is also a
+read-only sequence of `Span`s, materializing each one only when it is accessed.
+
+    spans = SpanSet.from_spans(review_code(example))
+    merged = spans.merged('merge')
+    task_0 = spans.with_task(0)
+"""
+from typing import Iterable, Iterator, Sequence, overload
+
+import numpy as np
+
+from .utils import Span
+
+import pdb
+
+
+REASON_DIVIDER = f'\n{"-" * 80}\n'  # between the reasons of merged spans, as in display.handle_overlaps
+NO_TASK = -1                         # task of spans whose task is None
+
+
+class ReasonTable:
+    """Interned reason strings, shared between span sets derived from one another"""
+    def __init__(self, reasons: Iterable[str] = ()):
+        self.reasons: list[str] = []
+        self.ids: dict[str, int] = {}
+        for reason in reasons:
+            self.intern(reason)
+
+    def intern(self, reason: str) -> int:
+        id = self.ids.get(reason)
+        if id is None:
+            id = self.ids[reason] = len(self.reasons)
+            self.reasons.append(reason)
+        return id
+
+    def __getitem__(self, id: int) -> str:
+        return self.reasons[id]
+
+    def __len__(self) -> int:
+        return len(self.reasons)
+
+
+class SpanSet(Sequence[Span]):
+    __slots__ = ('starts', 'stops', 'reason_ids', 'tasks', 'table')
+
+    def __init__(self, starts, stops, reason_ids, tasks, table: ReasonTable):
+        self.starts = np.asarray(starts, dtype=np.int32)
+        self.stops = np.asarray(stops, dtype=np.int32)
+        self.reason_ids = np.asarray(reason_ids, dtype=np.int32)
+        self.tasks = np.asarray(tasks, dtype=np.int16)
+        self.table = table
+
+    @classmethod
+    def from_spans(cls, spans: Iterable[Span], table: ReasonTable | None = None) -> 'SpanSet':
+        if table is None:
+            table = ReasonTable()
+        spans = list(spans)
+        return cls(
+            np.fromiter((span.start for span in spans), np.int32, len(spans)),
+            np.fromiter((span.stop for span in spans), np.int32, len(spans)),
+            np.fromiter((table.intern(span.reason) for span in spans), np.int32, len(spans)),
+            np.fromiter((NO_TASK if span.task is None else span.task for span in spans), np.int16, len(spans)),
+            table,
+        )
+
+    @classmethod
+    def from_dicts(cls, spans: list[dict], table: ReasonTable | None = None) -> 'SpanSet':
+        """From serialized spans (see `utils.serialize_span`), without creating a Span for each"""
+        if table is None:
+            table = ReasonTable()
+        return cls(
+            np.fromiter((span['start'] for span in spans), np.int32, len(spans)),
+            np.fromiter((span['stop'] for span in spans), np.int32, len(spans)),
+            np.fromiter((table.intern(span['reason']) for span in spans), np.int32, len(spans)),
+            np.fromiter((NO_TASK if span.get('task') is None else span['task'] for span in spans), np.int16, len(spans)),
+            table,
+        )
+
+    @classmethod
+    def concat(cls, sets: Sequence['SpanSet'], table: ReasonTable | None = None) -> 'SpanSet':
+        """Concatenate span sets. Reasons are re-interned into `table` (by default the first set's) where the tables differ"""
+        if table is None:
+            table = sets[0].table if sets else ReasonTable()
+        reason_ids = []
+        for spans in sets:
+            if spans.table is table:
+                reason_ids.append(spans.reason_ids)
+            else:
+                remap = np.fromiter((table.intern(reason) for reason in spans.table.reasons), np.int32, len(spans.table))
+                reason_ids.append(remap[spans.reason_ids] if len(remap) else spans.reason_ids)
+        return cls(
+            np.concatenate([spans.starts for spans in sets]) if sets else [],
+            np.concatenate([spans.stops for spans in sets]) if sets else [],
+            np.concatenate(reason_ids) if sets else [],
+            np.concatenate([spans.tasks for spans in sets]) if sets else [],
+            table,
+        )
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @overload
+    def __getitem__(self, index: int) -> Span: ...
+    @overload
+    def __getitem__(self, index: 'slice | np.ndarray') -> 'SpanSet': ...
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            task = int(self.tasks[index])
+            return Span(int(self.starts[index]), int(self.stops[index]), self.table[self.reason_ids[index]], None if task == NO_TASK else task)
+        return SpanSet(self.starts[index], self.stops[index], self.reason_ids[index], self.tasks[index], self.table)
+
+    def __iter__(self) -> Iterator[Span]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f'SpanSet({len(self)} spans, {len(self.table)} reasons)'
+
+    def to_list(self) -> list[Span]:
+        return list(self)
+
+    @property
+    def nbytes(self) -> int:
+        """bytes used by the arrays (the reason table may be shared, so isn't counted)"""
+        return self.starts.nbytes + self.stops.nbytes + self.reason_ids.nbytes + self.tasks.nbytes
+
+    def sorted(self) -> 'SpanSet':
+        """sorted by (start, stop), stable"""
+        return self[np.lexsort((self.stops, self.starts))]
+
+    def with_task(self, task: int | None) -> 'SpanSet':
+        return self[self.tasks == (NO_TASK if task is None else task)]
+
+    def merged(self, policy: str = 'merge', min_overlap: float = 0.0) -> 'SpanSet':
+        """
+        Merge overlapping spans, with the same results as `display.handle_overlaps`.
+
+        The 'merge' and 'distinct' policies (with the default min_overlap) are vectorized. The others are
+        inherently sequential, so they go through handle_overlaps.
+        """
+        if policy == 'distinct':
+            return self.sorted()
+        if policy != 'merge' or min_overlap > 0.0:
+            from .display import handle_overlaps
+            return SpanSet.from_spans(handle_overlaps(self.to_list(), policy, min_overlap), self.table)  # type: ignore[arg-type]
+        if len(self) == 0:
+            return self
+
+        spans = self.sorted()
+        # a span starts a new group unless it starts at or before the furthest stop so far (touching spans merge)
+        furthest = np.maximum.accumulate(spans.stops)
+        firsts = np.flatnonzero(np.concatenate([[True], spans.starts[1:] > furthest[:-1]]))
+        sizes = np.diff(np.append(firsts, len(spans)))
+
+        stops = np.maximum.reduceat(spans.stops, firsts)
+        low, high = np.minimum.reduceat(spans.tasks, firsts), np.maximum.reduceat(spans.tasks, firsts)
+        tasks = np.where(low == high, low, NO_TASK)
+        reason_ids = spans.reason_ids[firsts].copy()
+        for group in np.flatnonzero(sizes > 1):
+            ids = spans.reason_ids[firsts[group]:firsts[group] + sizes[group]]
+            reason_ids[group] = self.table.intern(REASON_DIVIDER.join(self.table[i] for i in ids))
+        return SpanSet(spans.starts[firsts], stops, reason_ids, tasks, self.table)
+
+    def to_dict(self) -> dict:
+        """Columnar, JSON serializable form. Only the reasons actually used are included"""
+        used, reason_ids = np.unique(self.reason_ids, return_inverse=True)
+        return {
+            'starts': self.starts.tolist(),
+            'stops': self.stops.tolist(),
+            'tasks': self.tasks.tolist(),
+            'reason_ids': reason_ids.tolist(),
+            'reasons': [self.table[i] for i in used],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict | list[dict], table: ReasonTable | None = None) -> 'SpanSet':
+        """Inverse of `to_dict`. Also accepts a list of serialized spans (see `from_dicts`)"""
+        if isinstance(data, list):
+            return cls.from_dicts(data, table)
+        if table is None:
+            table = ReasonTable()
+        remap = np.fromiter((table.intern(reason) for reason in data['reasons']), np.int32, len(data['reasons']))
+        reason_ids = np.asarray(data['reason_ids'], dtype=np.int32)
+        return cls(data['starts'], data['stops'], remap[reason_ids] if len(remap) else reason_ids, data['tasks'], table)
@@ -0,0 +1,243 @@
+"""
+Lightweight tracing for reviews: timed spans with counters, exportable as JSONL or OpenTelemetry-style (OTLP/JSON) traces.
+
+Tracing is off unless a `tracing()` context is active, in which case instrumented code records into it:
+
+    with tracing(Path('trace.jsonl')) as tracer:
+        review_code(example)
+    print(tracer.summary())
+
+When off, `span()` and `add()` amount to a single ContextVar lookup. The tracer and current span live in
+ContextVars, so they follow the work into asyncio tasks and any threads started with a copy of the context
+(e.g. batch.py workers, `asyncio.to_thread`).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator, Literal
+import json
+import os
+import threading
+import time
+
+import pdb
+
+
+ExportFormat = Literal['jsonl', 'otel']
+
+
+@dataclass(slots=True)
+class TraceSpan:
+    name: str
+    trace_id: str
+    span_id: str
+    parent: 'TraceSpan | None'
+    start_ns: int
+    end_ns: int | None = None
+    attributes: dict[str, object] = field(default_factory=dict)
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e9
+
+
+class Tracer:
+    """Collects finished spans (from any thread), plus running totals of every counter"""
+    def __init__(self):
+        self.spans: list[TraceSpan] = []
+        self.totals: dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def finish(self, span: TraceSpan) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+    def add(self, name: str, value: float, span: TraceSpan | None = None) -> None:
+        """Add to a counter's total, and on the given span and all of its ancestors (which other threads may share)"""
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + value
+            while span is not None:
+                span.attributes[name] = span.attributes.get(name, 0) + value  # type: ignore[operator]
+                span = span.parent
+
+    def summary(self) -> dict[str, object]:
+        """the counter totals, plus the count and total seconds of each kind of span"""
+        with self.lock:
+            durations: dict[str, list[float]] = {}
+            for span in self.spans:
+                durations.setdefault(span.name, []).append(span.duration)
+            return {
+                'counters': dict(self.totals),
+                'spans': {name: {'count': len(times), 'seconds': sum(times)} for name, times in durations.items()},
+            }
+
+    def export(self, path: Path, format: ExportFormat = 'jsonl') -> None:
+        """
+        Write the finished spans to a file.
+
+        Args:
+            path (Path): the file to write
+            format ('jsonl' | 'otel', optional): 'jsonl' writes one flat record per span. 'otel' writes a single
+                OTLP/JSON `resourceSpans` document, which OpenTelemetry collectors and trace viewers can import. Defaults to 'jsonl'.
+        """
+        with self.lock:
+            spans = list(self.spans)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if format == 'jsonl':
+            with open(path, 'w', encoding='utf-8') as f:
+                for span in spans:
+                    f.write(json.dumps(serialize_trace_span(span)) + '\n')
+        elif format == 'otel':
+            path.write_text(json.dumps(otel_document(spans)), encoding='utf-8')
+        else:
+            raise ValueError(f'unknown trace export format: {format}')
+
+
+def serialize_trace_span(span: TraceSpan) -> dict:
+    return {
+        'name': span.name,
+        'trace_id': span.trace_id,
+        'span_id': span.span_id,
+        'parent_id': span.parent.span_id if span.parent else None,
+        'start': span.start_ns / 1e9,
+        'duration': span.duration,
+        'attributes': span.attributes,
+        'error': span.error,
+    }
+
+
+def otel_value(value: object) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}  # OTLP/JSON encodes 64 bit ints as strings
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def otel_document(spans: list[TraceSpan]) -> dict:
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'code-review'}}]},
+        'scopeSpans': [{
+            'scope': {'name': __name__},
+            'spans': [{
+                'traceId': span.trace_id,
+                'spanId': span.span_id,
+                'parentSpanId': span.parent.span_id if span.parent else '',
+                'name': span.name,
+                'kind': 1,  # SPAN_KIND_INTERNAL
+                'startTimeUnixNano': str(span.start_ns),
+                'endTimeUnixNano': str(span.end_ns),
+                'attributes': [{'key': key, 'value': otel_value(value)} for key, value in span.attributes.items()],
+                'status': {'code': 2, 'message': span.error} if span.error else {'code': 1},
+            } for span in spans],
+        }],
+    }]}
+
+
+current_tracer: ContextVar[Tracer | None] = ContextVar('current_tracer', default=None)
+current_span: ContextVar[TraceSpan | None] = ContextVar('current_span', default=None)
+
+
+def enabled() -> bool:
+    return current_tracer.get() is not None
+
+
+@contextmanager
+def tracing(path: Path | None = None, format: ExportFormat = 'jsonl') -> Iterator[Tracer]:
+    """
+    Record everything instrumented within this context, and (if a path is given) export it on exit.
+
+    Args:
+        path (Path, optional): file to export the trace to. Defaults to None (don't export).
+        format ('jsonl' | 'otel', optional): see `Tracer.export`. Defaults to 'jsonl'.
+
+    Yields:
+        Tracer: the tracer collecting the spans
+    """
+    tracer = Tracer()
+    token = current_tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        current_tracer.reset(token)
+        if path is not None:
+            tracer.export(path, format)
+
+
+class _NullSpan:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc) -> None:
+        return None
+
+_null_span = _NullSpan()
+
+
+class _ActiveSpan:
+    def __init__(self, tracer: Tracer, name: str, attributes: dict[str, object]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self) -> TraceSpan:
+        parent = current_span.get()
+        self.span = TraceSpan(
+            name=self.name,
+            trace_id=parent.trace_id if parent else os.urandom(16).hex(),
+            span_id=os.urandom(8).hex(),
+            parent=parent,
+            start_ns=time.time_ns(),
+            attributes=self.attributes,
+        )
+        self.token = current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.span.end_ns = time.time_ns()
+        if exc is not None:
+            self.span.error = f'{exc_type.__name__}: {exc}'
+        current_span.reset(self.token)
+        self.tracer.finish(self.span)
+
+
+def span(name: str, **attributes: object) -> '_ActiveSpan | _NullSpan':
+    """Context manager timing the enclosed code as a span (a child of the current one), if tracing is on"""
+    tracer = current_tracer.get()
+    if tracer is None:
+        return _null_span
+    return _ActiveSpan(tracer, name, attributes)
+
+
+def add(name: str, value: float = 1) -> None:
+    """Add to a counter on the current span and all of its ancestors (and the tracer's totals), if tracing is on"""
+    tracer = current_tracer.get()
+    if tracer is None:
+        return
+    tracer.add(name, value, current_span.get())
+
+
+def instrument_model(model):
+    """
+    Wrap an archytas model's `ainvoke` so each model call is recorded as an `llm.call` span, with its
+    token usage (when the provider reports it) and number of tool calls counted up the current span chain.
+    """
+    ainvoke = model.ainvoke
+
+    async def traced_ainvoke(*args, **kwargs):
+        with span('llm.call'):
+            result = await ainvoke(*args, **kwargs)
+            add('llm.calls')
+            add('llm.tool_calls', len(getattr(result, 'tool_calls', None) or []))
+            usage = getattr(result, 'usage_metadata', None) or {}
+            for key in ('input_tokens', 'output_tokens', 'total_tokens'):
+                if key in usage:
+                    add(f'llm.{key}', usage[key])
+            return result
+
+    model.ainvoke = traced_ainvoke
+    return model
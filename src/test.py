@@ -1,6 +1,6 @@
 from pathlib import Path
 from .utils import load_examples
-from .review import review_code
+from .catalog import load_example
 
 here = Path(__file__).parent
 
@@ -12,14 +12,14 @@ import pdb
 
 
 
-from switchai import SwitchAI
-from switchai.types import ChatResponse
-from easyrepl import REPL
-from typing import Generator, Callable
+# the LLM stack is slow to import, so it is only imported by the tests that use it
+from typing import Generator, Callable, TYPE_CHECKING
 from functools import partial
+if TYPE_CHECKING:
+    from switchai.types import ChatResponse
 
 no_op = lambda: None
-def stream_do(gen:Generator[ChatResponse, None, None], fn: Callable[[str], None], final:Callable[[], None]=no_op) -> str:
+def stream_do(gen:'Generator[ChatResponse, None, None]', fn: Callable[[str], None], final:Callable[[], None]=no_op) -> str:
     """
     Perform some action while streaming LLM messages, and then return the whole result as a string.
     
@@ -42,8 +42,10 @@ def stream_do(gen:Generator[ChatResponse, None, None], fn: Callable[[str], None]
 
 
 
-def test_switch():
-    client = SwitchAI(provider="openai", model_name="gpt-4o")
+def test_switch(provider: str = "openai", model_name: str = "gpt-4o"):
+    from switchai import SwitchAI
+    from easyrepl import REPL
+    client = SwitchAI(provider=provider, model_name=model_name)
     messages = []
     for query in REPL(history_file='.chat'):
         messages.append({"role": "user", "content": query})
@@ -58,16 +60,710 @@ def test_example():
     ...
 
 
+def test_line_index():
+    """the resolver maps 1-based lines to offsets for any line endings, and finds exact quotes from (or else just before) the start line"""
+    from .utils import SpanResolver, VagueSpan
+
+    resolver = SpanResolver('a = 1\r\nb = 2\n\nc = 3')
+    assert resolver.line_starts == [0, 7, 13, 14] and resolver.line_stops == [5, 12, 13, 19]
+    assert [resolver.line_text(line) for line in range(1, 5)] == ['a = 1', 'b = 2', '', 'c = 3']
+
+    code = 'x = 1\ny = x\nx = 1\n'
+    resolver = SpanResolver(code)
+    resolve = lambda line, quote: resolver.resolve(VagueSpan(line, quote, ''))
+    assert (resolve(1, 'x = 1').start, resolve(2, 'x = 1').start, resolve(3, 'x = 1').start) == (0, 12, 12)
+    assert resolve(2, 'y = x\nx').start == 6 and resolve(3, 'y = x').start == 6  # a quote starting just before its start line
+    
+
+
+def test_review_export():
+    """spans map to the lines they touch, windows around nearby spans are combined, and the exports label spans and collapse untouched lines"""
+    import json
+    import tempfile
+    from .display import LineIndex, Window, export_html, export_json, export_review, make_windows
+    from .utils import Span
+
+    lines = LineIndex('ab\ncd\r\n\nef')
+    assert lines.starts == [0, 3, 7, 8, 10] and lines.n_lines == 4
+    assert [lines.line_of(offset) for offset in (0, 2, 3, 6, 7, 9, 10, 99)] == [0, 0, 1, 1, 2, 3, 3, 3]
+    assert lines.lines_of(Span(0, 3, '')) == (0, 0)  # ending on a newline doesn't touch the next line
+    assert lines.lines_of(Span(4, 4, '')) == (1, 1) and lines.lines_of(Span(1, 9, '')) == (0, 3)
+    assert LineIndex('').n_lines == 0 and LineIndex('').lines_of(Span(0, 0, '')) == (0, 0)
+
+    code = ''.join(f'line{i} = {i}\n' for i in range(20))
+    lines = LineIndex(code)
+    at = lambda line, reason: Span(lines.starts[line], lines.starts[line + 1] - 1, reason)
+    spans = [at(1, 'first'), at(4, 'touching <first>'), at(15, 'far away'), at(18, 'touching far away')]
+    assert make_windows(lines, spans, context=1) == [Window(0, 6, [0, 1]), Window(14, 20, [2, 3])]
+    assert make_windows(lines, spans, context=0) == [Window(1, 2, [0]), Window(4, 5, [1]), Window(15, 16, [2]), Window(18, 19, [3])]
+    assert make_windows(lines, spans, context=5) == [Window(0, 20, [0, 1, 2, 3])]
+
+    exported = json.loads(json.dumps(export_json(code, spans[::-1], context=1)))  # spans are sorted on export
+    assert exported['n_lines'] == 20
+    assert [(span['label'], span['lines'], span['reason']) for span in exported['spans']] == [(1, [2, 2], 'first'), (2, [5, 5], 'touching <first>'), (3, [16, 16], 'far away'), (4, [19, 19], 'touching far away')]
+    assert [(window['lines'], window['labels']) for window in exported['windows']] == [([1, 6], [1, 2]), ([15, 20], [3, 4])]
+    assert exported['windows'][0]['code'] == code[:lines.starts[6]]
+
+    page = export_html(code, spans, context=1, title='<review>')
+    assert '<title>&lt;review&gt;</title>' in page and 'touching &lt;first&gt;' in page
+    assert page.count('<section>') == 2 and '8 unchanged lines (7-14)' in page
+    assert page.count('<mark') == 4 and 'title="[1]">line1 = 1</mark>' in page
+
+    with tempfile.TemporaryDirectory() as tmp:
+        export_review(Path(tmp) / 'review.html', code, spans, context=1, title='<review>')
+        assert (Path(tmp) / 'review.html').read_text(encoding='utf-8') == page  # utf-8 whatever the locale, for the '⋯' markers
+    
+
+
+def test_tolerant_quotes():
+    """quotes that differ from the code in whitespace, or by a small typo, still resolve. Anything below match_tolerance is rejected"""
+    import pytest
+    from .utils import SpanResolver, VagueSpan
+
+    code = 'import pandas as pd\n\ndef load(path):\n    df = pd.read_csv(path,\n                     sep=",")\n    return df.dropna()\n'
+    resolver = SpanResolver(code)
+    resolve = lambda line, quote, tolerance=0.9: resolver.resolve(VagueSpan(line, quote, ''), tolerance)
+    quoted = lambda span: code[span.start:span.stop]
+
+    # whitespace normalized: the quote joins a statement that spans two lines
+    assert quoted(resolve(4, 'df = pd.read_csv(path, sep=",")')) == 'df = pd.read_csv(path,\n                     sep=",")'
+    # approximate alignment: only resolves with fuzzy matching
+    assert quoted(resolve(6, 'retrun df.dropna()')) == 'return df.dropna()'
+    assert quoted(resolve(4, 'df = pd.read_csv(path,  sep=";")')) == 'df = pd.read_csv(path,\n                     sep=",")'
+    with pytest.raises(ValueError, match='scored 0.97'):
+        resolve(4, 'df = pd.read_csv(path,  sep=";")', tolerance=0.99)
+
+    # a quote that differs more than the tolerance allows is rejected, unless the tolerance is lowered
+    with pytest.raises(ValueError, match=r'scored 0\.86 \(needs 0\.90\)'):
+        resolve(6, 'return df.dropna(axis=0)')
+    assert quoted(resolve(6, 'return df.dropna(axis=0)', tolerance=0.8)) == 'return df.dropna()'
+    with pytest.raises(ValueError):
+        resolve(6, 'completely unrelated text here')
+
+
+def test_add_spans():
+    """in a batch of spans, the ones that resolve are added, and each of the others is reported without failing the batch"""
+    from .review import CodeReview
+    from .utils import VagueSpan
+
+    review = CodeReview({'query': 'add two numbers', 'code': 'a = 1\nb = 2\nprint(a + b)\n'}, task=3)
+    report = review.add_spans([
+        VagueSpan(1, 'a = 1', 'constant'),
+        VagueSpan(2, 'not in the code at all', 'missing'),
+        VagueSpan(9, 'b = 2', 'past the end'),
+        VagueSpan(3, 'print(a + b)', 'output'),
+    ])
+    assert report.splitlines()[0].startswith('2 of 4 spans added'), report
+    assert [line.split(':')[1].split('.')[0].strip() for line in report.splitlines()[1:]] == ['added', 'FAILED', 'FAILED', 'added']
+    assert [(span.start, span.stop, span.task) for span in review.spans] == [(0, 5, 3), (12, 24, 3)]
+
+    empty = CodeReview({'query': 'nothing', 'code': ''})
+    assert empty.add_spans([VagueSpan(0, 'a = 1', 'no code')]).startswith('0 of 1 spans added')
+    
+
+
+def test_merge_equivalence(n_trials: int = 2000):
+    """IncrementalMerger and SpanSet.merged give the same spans as handle_overlaps, for every policy, including zero-length spans"""
+    import random
+    from .display import IncrementalMerger, handle_overlaps
+    from .spanset import SpanSet
+    from .utils import Span
+
+    as_tuples = lambda spans: [(span.start, span.stop, span.reason, span.task) for span in spans]
+    rng = random.Random(0)
+    for _ in range(n_trials):
+        spans = []
+        for i in range(rng.randint(0, 8)):
+            start = rng.randint(0, 30)
+            spans.append(Span(start, start + rng.choice([0, 0, 1, 2, 3, 5, 8, 13]), f'reason {i}', rng.choice([None, 0, 1])))
+        for policy in ('nest', 'merge', 'distinct'):
+            for min_overlap in (0.0, 0.5):
+                expected = as_tuples(handle_overlaps(spans, policy, min_overlap))
+                merger = IncrementalMerger(policy, min_overlap)
+                for span in spans:
+                    merger.add(span)
+                assert as_tuples(merger.merged) == expected, (policy, min_overlap, spans)
+                assert as_tuples(SpanSet.from_spans(spans).merged(policy, min_overlap).to_list()) == expected, (policy, min_overlap, spans)
+
+    # a span nested in a group doesn't keep it from merging with a later overlapping span (the pre-sweep loop kept all three)
+    assert [(span.start, span.stop) for span in handle_overlaps([Span(0, 10, 'a'), Span(2, 4, 'b'), Span(8, 12, 'c')])] == [(0, 12), (2, 4)]
+    
+
+
+def test_span_set():
+    """span sets round trip through spans, serialized spans and their columnar form, keeping tasks (including None) and sharing interned reasons (even from an empty table)"""
+    import json
+    import tempfile
+    from .evaluate import predictions_from_results
+    from .spanset import ReasonTable, SpanSet
+    from .utils import Span, serialize_span
+
+    as_tuples = lambda spans: [(span.start, span.stop, span.reason, span.task) for span in spans]
+    spans = [Span(5, 9, 'same', 2), Span(0, 3, 'other'), Span(7, 7, 'same', 0), Span(1, 4, 'unicode ✓', 1)]
+    span_set = SpanSet.from_spans(spans)
+    assert as_tuples(span_set.to_list()) == as_tuples(spans) and len(span_set.table) == 3
+    assert as_tuples(span_set[1:3]) == as_tuples(spans[1:3]) and span_set[-1] == spans[-1]
+    assert as_tuples(SpanSet.from_dicts([serialize_span(span) for span in spans])) == as_tuples(spans)
+
+    data = json.loads(json.dumps(span_set.to_dict()))
+    assert as_tuples(SpanSet.from_dict(data)) == as_tuples(spans)
+    assert as_tuples(SpanSet.from_dict([serialize_span(span) for span in spans])) == as_tuples(spans)
+
+    # a subset only serializes the reasons it uses, and loading into an existing table reuses its ids
+    subset = span_set.with_task(None)
+    assert subset.to_dict()['reasons'] == ['other']
+    table = ReasonTable(['unrelated', 'same'])
+    loaded = SpanSet.from_dict(data, table)
+    assert loaded.table is table and len(table) == 4 and table.ids['same'] == 1
+    assert as_tuples(loaded) == as_tuples(spans)
+    assert as_tuples(SpanSet.concat([loaded, span_set])) == as_tuples(spans + spans) and len(table) == 4
+
+    empty = SpanSet.from_spans([])
+    assert len(empty) == 0 and empty.to_list() == [] and len(SpanSet.from_dict(empty.to_dict())) == 0
+
+    # an empty table passed in is shared, not replaced by a new one
+    shared = ReasonTable()
+    assert SpanSet.from_spans(spans, shared).table is shared
+    with tempfile.TemporaryDirectory() as tmp:
+        results = Path(tmp) / 'results.jsonl'
+        results.write_text(''.join(json.dumps({'example': str(i), 'spans': [serialize_span(span) for span in spans]}) + '\n' for i in range(3)))
+        shared = ReasonTable()
+        predictions = list(predictions_from_results(results, shared))
+        assert len(predictions) == 3 and all(prediction.spans.table is shared for prediction in predictions) and len(shared) == 3
+    
+
+
+def test_score():
+    """character overlap counts and metrics for a small hand-worked case"""
+    import math
+    from .evaluate import GoldExample, Prediction, metrics, score
+    from .utils import Span
+
+    # 20 characters of code. Gold: [0, 10) for task 0, and [15, 20) for every task
+    gold = {'ex': GoldExample(length=20, spans=[Span(0, 10, 'gold', 0), Span(15, 20, 'gold')])}
+    scores = score([
+        Prediction('a', 'ex', [Span(5, 15, 'tagged', 0), Span(18, 25, 'untagged, runs past the end')]),
+        Prediction('a', 'ex', []),
+        Prediction('a', 'not annotated', [Span(0, 1, 'skipped')]),
+    ], gold)
+    assert scores.skipped == 1 and scores.n_tasks == 1
+    # overall: predicted [5, 15) + [18, 20), of which [5, 10) + [18, 20) are gold. Task 0: only the tagged span counts
+    assert scores.tp.tolist() == [[7, 5], [0, 0]]
+    assert scores.predicted.tolist() == [[12, 10], [0, 0]]
+    assert scores.gold.tolist() == [[15, 15], [15, 15]]
+
+    m = metrics(scores.tp, scores.predicted, scores.gold)
+    assert [m[name][0, 0] for name in ('precision', 'recall', 'f1', 'iou')] == [7 / 12, 7 / 15, 14 / 27, 7 / 20]
+    assert math.isnan(m['precision'][1, 0]) and m['recall'][1, 0] == 0 and m['f1'][1, 0] == 0
+    
+
+
 def test_review():
     from .display import explain_code
-    examples = load_examples(here/'../examples/contrived_examples.yaml')
-    example = examples[0]
+    from .review import review_code
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
     spans = review_code(example)
     explain_code(example['code'], spans)
+
+
+def test_review_stream():
+    """the live display of a streamed review ends up showing the same spans as the whole review"""
+    from . import review
+    from .cache import disabled
+    from .display import explain_code_live, handle_overlaps
+    from .fake_llm import register_fake_model
+
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
+    model = review.MODEL
+    review.MODEL = register_fake_model('test-stream')
+    try:
+        with disabled():
+            shown = explain_code_live(example['code'], review.review_code_stream(example))
+            spans = review.review_code(example)
+    finally:
+        review.MODEL = model
+    assert spans and shown == handle_overlaps(spans)
+
+
+def test_review_stream_abandoned():
+    """a review whose stream is abandoned stops after its current task, instead of running every task in the background"""
+    import time
+    from . import review
+    from .cache import disabled
+    from .fake_llm import SyntheticResponder, register_fake_model
+
+    turns = []
+    def counting_responder():
+        responder = SyntheticResponder()
+        def respond(messages):
+            turns.append(len(messages))
+            return responder(messages)
+        return respond
+
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
+    model = review.MODEL
+    review.MODEL = register_fake_model('test-abandoned', counting_responder, latency=0.05)
+    try:
+        with disabled():
+            stream = review.review_code_stream(example)
+            next(stream)
+            stream.close()
+            time.sleep(1.0)
+    finally:
+        review.MODEL = model
+    assert len(turns) == 2, f'{len(turns)} model turns after the stream was closed during the first task'
+    
+
+
+def test_import_time(budget: float = 0.5):
+    """the CLI must start quickly: commands that don't call the model must not import the LLM stack"""
+    import subprocess
+    import sys
+    import time
+
+    def run(code: str) -> float:
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], cwd=here.parent, check=True, capture_output=True)
+        return time.perf_counter() - t0
+
+    baseline = min(run('pass') for _ in range(3))
+    elapsed = min(run(
+        'import sys, src.cli; src.cli.main(["list"]); '
+        'heavy = [m for m in ("archytas", "langchain_core", "switchai", "easyrepl") if m in sys.modules]; '
+        'assert not heavy, f"imported {heavy}"'
+    ) for _ in range(3))
+    print(f'`llm-review list` took {elapsed - baseline:.3f}s beyond interpreter startup (budget {budget}s)')
+    assert elapsed - baseline < budget, f'CLI startup took {elapsed - baseline:.3f}s, over the {budget}s budget'
+    
+
+
+def test_review_cache_path():
+    """`llm-review show` reads the review_code cache from the same file that review_code uses"""
+    from .cache import filesafe_cache_name
+    from .cli import REVIEW_CODE_SIGNATURE, here as cli_here
+    from .review import review_code
+    assert review_code.cache.path == cli_here / filesafe_cache_name('review.py', 'review_code', REVIEW_CODE_SIGNATURE)  # type: ignore[attr-defined]
+    
+
+
+def test_cache_compact():
+    """entries computed under other settings are kept until compacted with stale=True, and the oldest are evicted beyond max_entries (automatically from the first call)"""
+    import tempfile
+    import time
+    from .cache import diskcache
+
+    settings = {'model': 'a'}
+    with tempfile.TemporaryDirectory() as tmp:
+        double = diskcache(lambda x: 2 * x, cache_path=Path(tmp) / 'double.cache', settings=lambda: settings, max_entries=3, memory_size=0, auto_compact=False)
+        for x in range(4):
+            double(x)
+            time.sleep(0.01)  # entries are evicted by creation time
+        settings['model'] = 'b'
+        double(0)
+        assert len(double.cache) == 5  # type: ignore[attr-defined]
+        assert double.compact() == 2 and len(double.cache) == 3  # type: ignore[attr-defined]
+        assert double.compact(stale=True) == 2 and len(double.cache) == 1  # type: ignore[attr-defined]
+        settings['model'] = 'a'
+        # the stale entry is gone, so it is computed again
+        assert double(3) == 6 and len(double.cache) == 2  # type: ignore[attr-defined]
+        double.cache.close()  # type: ignore[attr-defined]
+
+        # the limits are enforced in the background from the first call, but not from just reading the fingerprint
+        double = diskcache(lambda x: 2 * x, cache_path=Path(tmp) / 'double.cache', settings=lambda: settings, max_entries=1, memory_size=0)
+        double.fingerprint()  # type: ignore[attr-defined]
+        time.sleep(0.2)
+        assert len(double.cache) == 2  # type: ignore[attr-defined]
+        double(3)
+        for _ in range(100):
+            if len(double.cache) == 1:  # type: ignore[attr-defined]
+                break
+            time.sleep(0.05)
+        assert len(double.cache) == 1  # type: ignore[attr-defined]
+        double.cache.close()  # type: ignore[attr-defined]
+    
+
+
+def test_disk_store():
+    """the store is only created on first use, large arguments are stored once, and entries of an edited function are stale"""
+    import json
+    import sqlite3
+    import tempfile
+    from .cache import BLOB_THRESHOLD, diskcache
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'lines.cache'
+        path.write_text(json.dumps([[['old', 'args'], []], 'old value']) + '\n')  # a cache in the legacy JSONL format
+        count_lines = diskcache(lambda code, n: len(code.splitlines()[:n]), cache_path=path, memory_size=0)
+        assert path.read_text().startswith('[')  # nothing is opened until the first call
+
+        code = 'x = 1\n' * BLOB_THRESHOLD
+        assert [count_lines(code, n) for n in (1, 2, 3)] == [1, 2, 3]
+        assert count_lines.cache.load_call(next(key for key, fingerprint, _ in count_lines.cache.items() if fingerprint)) == ([code, 1], {})  # type: ignore[attr-defined]
+        with sqlite3.connect(path) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0] == 1
+            # the legacy entry is kept, but stale
+            assert conn.execute('SELECT COUNT(*) FROM entries WHERE fingerprint IS NULL').fetchone()[0] == 1
+        assert (Path(tmp) / 'lines.cache.jsonl').exists()
+        count_lines.cache.close()  # type: ignore[attr-defined]
+
+        # the same cache file under an edited function: every entry is stale, so values are recomputed
+        count_chars = diskcache(lambda code, n: len(code[:n]), cache_path=path, memory_size=0)
+        assert count_chars(code, 3) == 3 and len(count_chars.cache) == 4  # type: ignore[attr-defined]
+        assert count_chars.compact(stale=True) == 3  # type: ignore[attr-defined]
+        with sqlite3.connect(path) as conn:
+            assert conn.execute('SELECT COUNT(*) FROM blobs').fetchone()[0] == 1
+        count_chars.cache.close()  # type: ignore[attr-defined]
+    
+
+
+def test_cache_latest():
+    """cache entries can be looked up by their first argument, whether it was passed by position or keyword, and under any settings, or by their tag"""
+    import json
+    import tempfile
+    import time
+    from .cache import DiskStore, diskcache, subject_digest
+
+    settings = {'model': 'a'}
+    example = {'query': 'q', 'code': 'x = 1\n' * 100}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / 'review.cache'
+        path.write_text(json.dumps([[[[['code', 'legacy'], ['query', 'q']]], []], ['legacy']]) + '\n')  # a cache in the legacy JSONL format
+        tag = lambda example, parallel=False: None if parallel else example['query']
+        review = diskcache(lambda example, parallel=False: [settings['model'], parallel], cache_path=path, settings=lambda: settings, tag=tag)
+        review(example)
+        time.sleep(0.01)
+        settings['model'] = 'b'
+        review(example=example, parallel=True)
+        review({**example, 'code': 'y = 2'})
+        review.cache.close()  # type: ignore[attr-defined]
+
+        store = DiskStore(path, readonly=True)
+        assert json.loads(store.latest(subject_digest(example))[2]) == ['b', True]  # type: ignore[index]
+        assert store.latest(subject_digest({'code': 'legacy', 'query': 'q'})) is not None  # legacy entries are indexed on import
+        assert store.latest(subject_digest({**example, 'query': 'other'})) is None
+        # only the current entries with the tag, newest first
+        assert [json.loads(value) for _, value in store.tagged('q', review.fingerprint())] == [['b', False]]  # type: ignore[attr-defined]
+        settings['model'] = 'a'
+        assert [json.loads(value) for _, value in store.tagged('q', review.fingerprint())] == [['a', False]]  # type: ignore[attr-defined]
+        store.close()
+    
+
+
+def test_cache_single_flight(n_processes: int = 4):
+    """processes calling a diskcache'd function with the same arguments at once compute it only once, and leave no lock files behind"""
+    import subprocess
+    import sys
+    import tempfile
+
+    code = (
+        'import sys, time; from pathlib import Path; from src.cache import diskcache\n'
+        'tmp = Path(sys.argv[1])\n'
+        '@diskcache(cache_path=tmp / "slow.cache")\n'
+        'def slow(x):\n'
+        '    with open(tmp / "calls", "a") as f: f.write("call\\n")\n'
+        '    time.sleep(0.5)\n'
+        '    return 2 * x\n'
+        'print(slow(21))\n'
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        processes = [subprocess.Popen([sys.executable, '-c', code, tmp], cwd=here.parent, stdout=subprocess.PIPE, text=True) for _ in range(n_processes)]
+        outputs = [process.communicate()[0].strip() for process in processes]
+        assert outputs == ['42'] * n_processes, outputs
+        assert (Path(tmp) / 'calls').read_text().count('call') == 1
+        assert not list((Path(tmp) / 'slow.cache.locks').iterdir())
+    
+
+
+def test_batch_review():
+    """concurrent sequential reviews in the batch runner don't collide on the terminal spinner"""
+    import tempfile
+    from . import review
+    from .batch import review_batch
+    from .cache import disabled
+    from .fake_llm import register_fake_model
+
+    model = review.MODEL
+    review.MODEL = register_fake_model('test-batch', latency=0.05)
+    try:
+        with disabled(), tempfile.TemporaryDirectory() as tmp:
+            results = review_batch([here/'../examples/contrived_examples.yaml'], Path(tmp)/'results.jsonl', concurrency=4)
+    finally:
+        review.MODEL = model
+    assert len(results) > 1 and all(result.error is None for result in results), [result.error for result in results]
+    
+
+
+def test_chunked_review():
+    """spans selected in each chunk of a large program map back to the same text in the whole program"""
+    import re
+    from .chunking import split_code, review_code_chunked
+    from .utils import Span
+
+    code = (here/'display.py').read_text()
+    def select_defs_and_imports(example, parallel=False) -> list[Span]:
+        return [Span(m.start(), m.end(), 'selected', 0) for m in re.finditer(r'^(def \w+|from \S+ import)', example['code'], re.M)]
+
+    chunks = split_code(code, max_lines=100)
+    assert len(chunks) > 1 and chunks[0].first_line == 1 and chunks[-1].last_line == len(code.splitlines())
+    spans = review_code_chunked({'query': '', 'code': code}, max_lines=100, review=select_defs_and_imports)
+    assert [(span.start, span.stop) for span in spans] == [(span.start, span.stop) for span in select_defs_and_imports({'code': code})]
+    
+
+
+def test_plan_incremental():
+    """after an edit, spans on unchanged lines carry over to their new offsets and only the edited region is re-reviewed"""
+    import re
+    from .incremental import plan_incremental
+    from .utils import Span
+
+    code = (here/'display.py').read_text()
+    spans = [Span(m.start(), m.end(), m.group(), 0) for m in re.finditer(r'^def \w+', code, re.M)]
+    lines = code.splitlines(keepends=True)
+    lines.insert(80, '# an edit\n')  # 3 lines above `def render_explanations`
+    edited = ''.join(lines)
+
+    plan = plan_incremental(code, spans, edited, context=3)
+    assert plan.hunks == [(78, 84)], plan.hunks
+    assert all(edited[span.start:span.stop] == span.reason for span in plan.kept)
+    kept = {span.reason for span in plan.kept}
+    assert [span.reason for span in spans if span.reason not in kept] == ['def render_explanations']  # in the hunk, so re-reviewed
+    
+
+
+def test_incremental_keyword_call():
+    """an earlier review called with the example as a keyword argument is found, and re-used, by an incremental re-review. Reviews of chunks aren't"""
+    import tempfile
+    from contextvars import copy_context
+    from . import incremental, review, telemetry
+    from .cache import diskcache, disabled
+    from .chunking import review_tag, sub_review
+    from .fake_llm import register_fake_model
+    from .incremental import find_previous_review, incremental_tag, review_code_incremental
+    from .utils import deserialize_span, serialize_span, vectorize
+
+    def review_chunk(example):
+        sub_review.set(True)
+        return review.review_code(example)
+
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
+    lines = example['code'].splitlines(keepends=True)
+    edited = {**example, 'code': ''.join(lines[:-1] + ['# an edit\n', lines[-1]])}
+    model, review_code, review_code_incremental_cached = review.MODEL, review.review_code, incremental._review_code_incremental
+    review.MODEL = register_fake_model('test-incremental-keyword')
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            # the same functions, cached in the temporary directory rather than next to the source
+            options = dict(serializer=vectorize(serialize_span), deserializer=vectorize(deserialize_span), memory_size=0, auto_compact=False)
+            review.review_code = diskcache(cache_path=Path(tmp)/'review_code.cache', settings=review.review_settings, tag=review_tag, **options)(review_code.__wrapped__)  # type: ignore[attr-defined]
+            incremental._review_code_incremental = diskcache(cache_path=Path(tmp)/'incremental.cache', tag=incremental_tag, **options)(review_code_incremental_cached.__wrapped__)  # type: ignore[attr-defined]
+
+            review.review_code(example=example)
+            copy_context().run(review_chunk, edited)  # most similar to the edit, but only a chunk (of a larger program)
+            assert len(review.review_code.cache) == 2  # type: ignore[attr-defined]
+            previous = find_previous_review(edited, review.review_code.fingerprint())  # type: ignore[attr-defined]
+            assert previous is not None and previous[0] == example['code']
+            with telemetry.tracing() as tracer:
+                review_code_incremental(edited)
+            assert find_previous_review(edited, review.review_code.fingerprint())[0] == edited['code']  # type: ignore[attr-defined,index]
+            review.review_code.cache.close()  # type: ignore[attr-defined]
+            incremental._review_code_incremental.cache.close()  # type: ignore[attr-defined]
+    finally:
+        review.MODEL, review.review_code, incremental._review_code_incremental = model, review_code, review_code_incremental_cached
+    assert tracer.summary()['counters'].get('incremental.kept_spans', 0) > 0, tracer.summary()['counters']
+    
+
+
+def test_provider_pool():
+    """reviews through a ProviderPool against local stand-in servers: connections are reused, stragglers hedged, failures fall back"""
+    from . import review
+    from .cache import disabled
+    from .fake_llm import FakeOpenAIServer
+    from .providers import ProviderPool, openai_provider, register_pool
+
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
+    model = review.MODEL
+    try:
+        with FakeOpenAIServer(latency=lambda n: 5.0 if n == 0 else 0.0) as slow, FakeOpenAIServer(status=500) as broken, FakeOpenAIServer() as backup, disabled():
+            pool = ProviderPool([openai_provider('slow', base_url=slow.url, api_key='local', max_concurrency=2)], hedge_after=0.5)
+            review.MODEL = register_pool('test-hedged', pool)
+            review.review_code(example)
+            review.review_code(example, parallel=True)
+            assert pool.stats['hedges'] == 1 and pool.stats['wins'] == slow.requests - 1, pool.stats
+            assert slow.connections <= 3, f'{slow.connections} connections for {slow.requests} requests'
+
+            pool = ProviderPool(
+                [openai_provider('broken', base_url=broken.url, api_key='local')],
+                fallback=[openai_provider('backup', 'gpt-4o-mini', base_url=backup.url, api_key='local')],
+            )
+            review.MODEL = register_pool('test-fallback', pool)
+            assert review.review_code(example)
+            assert pool.stats['backup.wins'] == pool.stats['fallbacks'] == backup.requests, pool.stats
+    finally:
+        review.MODEL = model
+    
+
+
+def test_compaction():
+    """compacting the conversation between tasks leaves the selected spans unchanged, and sends fewer tokens to the model"""
+    from . import review, telemetry
+    from .cache import disabled
+    from .fake_llm import ReplayResponder, final_answer, register_fake_model
+
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
+    lines = [(i, line) for i, line in enumerate(example['code'].splitlines(), 1) if line.strip()]
+    # each task selects two fixed lines, whatever the conversation looks like
+    trace = []
+    for task in range(len(review.review_tasks)):
+        picks = lines[2 * task:2 * task + 2]
+        trace += [[{'name': 'add_spans', 'args': {'spans': [{'start_line': i, 'quote': line.strip(), 'reason': f'task {task}'} for i, line in picks]}}], [final_answer()]]
+
+    model, compaction = review.MODEL, review.COMPACTION
+    review.MODEL = register_fake_model('test-replay', lambda: ReplayResponder(trace))
+    results, fingerprints = {}, set()
+    try:
+        for review.COMPACTION in ['off', 'summary', 'drop']:
+            with disabled(), telemetry.tracing() as tracer:
+                spans = review.review_code(example)
+            results[review.COMPACTION] = spans, tracer.summary()['counters']
+            fingerprints.add(review.review_code.fingerprint())  # type: ignore[attr-defined]
+    finally:
+        review.MODEL, review.COMPACTION = model, compaction
+
+    (off, off_counters), (summary, summary_counters), (drop, drop_counters) = results.values()
+    assert off == summary == drop and {span.task for span in off} == set(range(len(review.review_tasks)))
+    assert len(fingerprints) == 3, 'each compaction mode must be cached separately'
+    saved = off_counters['llm.input_tokens'] - summary_counters['llm.input_tokens']
+    print(f'input tokens: {off_counters["llm.input_tokens"]} without compaction, {summary_counters["llm.input_tokens"]} with summaries, {drop_counters["llm.input_tokens"]} dropping')
+    assert saved > 0 and summary_counters['review.compaction.tokens_saved'] > 0
+    assert drop_counters['llm.input_tokens'] < summary_counters['llm.input_tokens']
+    
+
+
+def test_tracing():
+    """spans nest under the current span, even in other threads, and counters from every thread add up on the tracer and on each ancestor"""
+    import contextvars
+    import threading
+    from . import telemetry
+
+    n_threads, n_adds = 8, 500
+    with telemetry.span('off'):
+        telemetry.add('ignored')  # no-op without a tracer
+    with telemetry.tracing() as tracer:
+        def work():
+            with telemetry.span('worker'):
+                for _ in range(n_adds):
+                    telemetry.add('items')
+                    telemetry.add('tokens', 2)
+        with telemetry.span('root') as root:
+            with telemetry.span('child') as child:
+                threads = [threading.Thread(target=contextvars.copy_context().run, args=(work,)) for _ in range(n_threads)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            try:
+                with telemetry.span('failing'):
+                    raise ValueError('boom')
+            except ValueError:
+                pass
+        assert telemetry.current_span.get() is None
+
+    summary = tracer.summary()
+    assert summary['counters'] == {'items': n_threads * n_adds, 'tokens': 2 * n_threads * n_adds}
+    assert summary['spans']['worker']['count'] == n_threads and 'off' not in summary['spans']  # type: ignore[index]
+    assert root.attributes == child.attributes == {'items': n_threads * n_adds, 'tokens': 2 * n_threads * n_adds}
+    workers = [span for span in tracer.spans if span.name == 'worker']
+    assert all(span.parent is child and span.trace_id == root.trace_id and span.attributes['items'] == n_adds for span in workers)
+    assert child.parent is root and root.parent is None
+    assert next(span for span in tracer.spans if span.name == 'failing').error == 'ValueError: boom'
+    assert tracer.spans[-1] is root  # spans are finished innermost first
+    
+
+
+def test_example_catalog():
+    """the catalog recompiles a file when it is edited, but not when it is only touched, and rejects indices past the end"""
+    import os
+    import tempfile
+    import pytest
+    from .catalog import Catalog
+    from .utils import example_id
+
+    yaml_example = lambda query: f'- query: {query}\n  code: "x = 1"\n  gold: []\n'
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / 'examples.yaml'
+        source.write_text(yaml_example('first') + yaml_example('second'))
+        catalog = Catalog(Path(tmp) / 'examples.catalog')
+        assert catalog.count(source) == 2
+        assert catalog.get(source, 1) == {'query': 'second', 'code': 'x = 1'}
+        assert 'gold' in catalog.get(source, 1, with_gold=True)
+        with pytest.raises(IndexError, match='has 2 examples'):
+            catalog.get(source, 2)
+
+        # touched but unchanged
+        os.utime(source, ns=(source.stat().st_atime_ns, source.stat().st_mtime_ns + 10**9))
+        assert catalog.get(source, 0)['query'] == 'first'
+
+        # edited (to the same size) with a later mtime
+        source.write_text(yaml_example('third') + yaml_example('fourth'))
+        os.utime(source, ns=(source.stat().st_atime_ns, source.stat().st_mtime_ns + 2 * 10**9))
+        assert [example['query'] for _, _, example in catalog.iter([source])] == ['third', 'fourth']
+        assert catalog.find(example_id({'query': 'fourth', 'code': 'x = 1'})) == (source, 1, {'query': 'fourth', 'code': 'x = 1'})
+        with pytest.raises(KeyError):
+            catalog.find(example_id({'query': 'second', 'code': 'x = 1'}))
+        catalog.close()
+    
+
+
+def test_issue_catalog():
+    """the catalog parses into its numbered entries, a statistics example is given the statistics entries, and reviews are cached per selection size"""
+    from .issues import load_catalog
+
+    catalog = load_catalog()
+    assert [entry.number for entry in catalog.entries] == list(range(1, len(catalog.entries) + 1))
+    assert load_catalog() is catalog
+    example = load_example(here/'../examples/contrived_examples.yaml', 0)
+    selected = catalog.select(f'{example["query"]}\n{example["code"]}', k=8)
+    print(example['query'], '->', [entry.title for entry in selected])
+    assert len(selected) == 8 and 'Statistical Assumption Violations' in [entry.title for entry in selected]
+    assert len(catalog.render(selected)) < len(catalog.source) / 2
+
+    from . import review
+    issue_examples = review.ISSUE_EXAMPLES
+    try:
+        fingerprints = set()
+        for review.ISSUE_EXAMPLES in [None, 4, 8]:
+            fingerprints.add(review.review_code.fingerprint())  # type: ignore[attr-defined]
+    finally:
+        review.ISSUE_EXAMPLES = issue_examples
+    assert len(fingerprints) == 3, 'reviews with different catalog selections must be cached separately'
     
 
 
 if __name__ == '__main__':
     # test_switch()
     # test_example()
+    # test_review_stream()
+    # test_review_stream_abandoned()
+    # test_import_time()
+    # test_review_cache_path()
+    # test_cache_compact()
+    # test_disk_store()
+    # test_cache_latest()
+    # test_cache_single_flight()
+    # test_batch_review()
+    # test_chunked_review()
+    # test_plan_incremental()
+    # test_incremental_keyword_call()
+    # test_provider_pool()
+    # test_compaction()
+    # test_example_catalog()
+    # test_issue_catalog()
+    # test_tracing()
+    # test_line_index()
+    # test_review_export()
+    # test_tolerant_quotes()
+    # test_add_spans()
+    # test_merge_equivalence()
+    # test_span_set()
+    # test_score()
     test_review()
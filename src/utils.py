@@ -1,28 +1,85 @@
 from dataclasses import dataclass
-from typing import Annotated, Callable, TypeVar, ParamSpec
+from typing import Annotated, Callable, TypeVar, ParamSpec, TYPE_CHECKING
 from typing_extensions import NotRequired, TypedDict
 import yaml
 from yaml.loader import SafeLoader
 from pathlib import Path
+from array import array
+from bisect import bisect_left
+from difflib import SequenceMatcher
+import hashlib
+import inspect
+import json
+import re
 import pydantic
 import pdb
 
+if TYPE_CHECKING:
+    from .cache import DiskStore
 
 
 
+
+class GoldSpan(TypedDict):
+    start_line: Annotated[int, 'The line number on which the span starts.']
+    quote: Annotated[str, 'The verbatim code of the span.']
+    reason: NotRequired[Annotated[str, 'Why the span is critical.']]
+    task: NotRequired[Annotated[int, 'Index of the review task the span belongs to. If omitted, the span counts for every task.']]
+
 class Example(TypedDict):
     query: Annotated[str, 'The user query that is solved by this example.']
     code: Annotated[str, 'The code that solves the example.']
     notes: NotRequired[Annotated[str, 'Optional notes about the example.']]
+    gold: NotRequired[Annotated[list[GoldSpan], 'Optional annotated spans that a review should find (see evaluate.py).']]
+
+# libyaml's C loader is much faster than the pure python one, when pyyaml was built with it
+YamlLoader = getattr(yaml, 'CSafeLoader', SafeLoader)
+examples_adapter = pydantic.TypeAdapter(list[Example])
 
-def load_examples(path:Path) -> list[Example]:
-    with path.open('r') as f:
-        examples: list[Example] = yaml.load(f, Loader=SafeLoader)
+def parse_examples(data: str | bytes, source: object = '<string>') -> list[Example]:
+    """Parse and validate the contents of an example yaml file (keeping any gold annotations)"""
+    examples: list[Example] = yaml.load(data, Loader=YamlLoader)
     if not isinstance(examples, list):
-        raise ValueError(f"Loaded examples from {path} is not a list of examples. Found: {type(examples)}")
-    pydantic.TypeAdapter(list[Example]).validate_python(examples)
+        raise ValueError(f"Loaded examples from {source} is not a list of examples. Found: {type(examples)}")
+    examples_adapter.validate_python(examples)
     return examples
 
+def load_examples(path:Path, with_gold: bool = False) -> list[Example]:
+    """
+    Load the examples from a yaml file. To look up individual examples, or iterate over large files, see catalog.py
+
+    Args:
+        path (Path): the example yaml file
+        with_gold (bool, optional): whether to keep any gold annotations. They are dropped by default so that they
+            never reach the reviewer, and so annotating an example doesn't change its review cache key. Defaults to False.
+    """
+    examples = parse_examples(path.read_bytes(), path)
+    if not with_gold:
+        for example in examples:
+            example.pop('gold', None)
+    return examples
+
+def example_id(example: Example) -> str:
+    """Stable id of an example, from its query and code"""
+    return hashlib.blake2b(json.dumps([example['query'], example['code']]).encode(), digest_size=16).hexdigest()
+
+
+# the cached review functions (review_code, review_task, ...) all take the example as their first parameter
+_review_signature = inspect.Signature([
+    inspect.Parameter('example', inspect.Parameter.POSITIONAL_OR_KEYWORD),
+    inspect.Parameter('args', inspect.Parameter.VAR_POSITIONAL),
+    inspect.Parameter('kwargs', inspect.Parameter.VAR_KEYWORD),
+])
+
+def call_example(args: list, kwargs: dict) -> Example:
+    """The example in the stored arguments of a cached review (see `DiskStore.load_call`), whether it was passed by position or by keyword"""
+    # frozen dicts are stored as lists of [key, value] pairs
+    return dict(_review_signature.bind(*args, **kwargs).arguments['example'])  # type: ignore[return-value]
+
+def stored_example(store: 'DiskStore', key: str) -> Example:
+    """The example that the review cached under `key` in `store` was computed from"""
+    return call_example(*store.load_call(key))
+
 
 
 """
@@ -37,25 +94,28 @@ class VagueSpan:
     reason: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Span:
     start: int
     stop: int
     reason: str
+    task: int | None = None  # index into review.review_tasks of the task that selected this span (if known)
 
 
 def serialize_span(span: Span) -> dict:
     return {
         'start': span.start,
         'stop': span.stop,
-        'reason': span.reason
+        'reason': span.reason,
+        'task': span.task,
     }
 
 def deserialize_span(span_dict: dict) -> Span:
     return Span(
         start=span_dict['start'],
         stop=span_dict['stop'],
-        reason=span_dict['reason']
+        reason=span_dict['reason'],
+        task=span_dict.get('task'),
     )
 
 
@@ -67,11 +127,179 @@ def vectorize(f: Callable[P, R]) -> Callable[[list[P]], list[R]]:
     return vectorized
 
 
+class SpanResolver:
+    """
+    Resolves vague spans (given by an LLM) into concrete spans over a fixed piece of content.
+
+    Build one per piece of content and reuse it for every span: the line offset table is computed once,
+    so mapping a line number to an offset is O(1), and quotes are searched for directly in the original
+    string without copying any part of it.
+
+    Quotes are matched in increasingly tolerant stages:
+    1. exact match, from the start line onwards (or else just before the start line)
+    2. exact match ignoring differences in whitespace
+    3. approximate alignment within a window of lines around the start line, accepted if it scores at least `match_tolerance`
+    """
+    def __init__(self, content: str, search_radius: int = 10):
+        """
+        Args:
+            content (str): The full content over which to resolve spans.
+            search_radius (int, optional): number of lines before/after the quoted region to consider when the
+                quote does not match exactly, or occurs before the start line. Defaults to 10.
+        """
+        self.content = content
+        self.search_radius = search_radius
+        self.line_starts: list[int] = []  # offset of the first character of each line
+        self.line_stops: list[int] = []   # offset just past the last character of each line (excluding the line break)
+        offset = 0
+        for line, bare_line in zip(content.splitlines(keepends=True), content.splitlines()):
+            self.line_starts.append(offset)
+            self.line_stops.append(offset + len(bare_line))
+            offset += len(line)
+        # searches never extend into a trailing line break at the very end of the content
+        self.stop = self.line_stops[-1] if self.line_stops else 0
+
+        # whitespace normalized copy of the content, only built if a quote fails to match exactly
+        self._normalized: str | None = None
+        self._normalized_offsets: array | None = None  # offset in content of each character in _normalized
+
+    def line_offset(self, line: int) -> int:
+        """Offset in the content of the start of the given (1-based) line"""
+        return self.line_starts[line - 1]
+
+    def line_text(self, line: int) -> str:
+        """The text of the given (1-based) line, without its line break"""
+        return self.content[self.line_starts[line - 1]:self.line_stops[line - 1]]
+
+    def resolve(self, vague_span: VagueSpan, match_tolerance: float = 0.9) -> Span:
+        """
+        Convert a vague span into a concrete span for this resolver's content.
+        > Note: ideally the vague span's quote would be an exact substring within content,
+        >       however this function can tolerate minor mismatches
+
+        Args:
+            vague_span (VagueSpan): The vague span with start line and quote of the content to highlight.
+            match_tolerance (float, optional): percentage (from 0.0 to 1.0) of how closely the quote must match the content. Defaults to 0.9.
+        Returns:
+            Span: A concrete span with start and stop indices.
+        """
+        n_lines = len(self.line_starts)
+        if n_lines == 0:
+            raise ValueError("The content is empty, so there is nothing to select")
+        if vague_span.start_line > n_lines:
+            raise ValueError(f"Start line {vague_span.start_line} is out of range. The content only has {n_lines} lines")
+        start_line = max(vague_span.start_line, 1)
+        quote = vague_span.quote
+
+        # window of lines to search when the quote isn't found exactly from the start line onwards
+        first_line = max(start_line - self.search_radius, 1)
+        last_line = min(start_line + quote.count('\n') + self.search_radius, n_lines)
+
+        # 1. exact match from the start line onwards, or else the closest one just before it
+        start = self.content.find(quote, self.line_offset(start_line), self.stop)
+        if start == -1:
+            start = self.content.rfind(quote, self.line_offset(first_line), self.line_offset(start_line) + len(quote) - 1)
+        if start != -1:
+            return Span(start=start, stop=start + len(quote), reason=vague_span.reason)
+
+        # 2. exact match ignoring whitespace differences
+        normalized_quote = ' '.join(quote.split())
+        if not normalized_quote:
+            raise ValueError(f"Quote must contain non-whitespace content: {quote!r}")
+        match = self._find_normalized(normalized_quote, start_line, first_line)
+        if match is not None:
+            start, stop = match
+            return Span(start=start, stop=stop, reason=vague_span.reason)
+
+        # 3. approximate alignment near the start line
+        start, stop, score = self._align(normalized_quote, first_line, last_line)
+        if score < match_tolerance:
+            closest = f"Closest match scored {score:.2f} (needs {match_tolerance:.2f}): {self.content[start:stop]!r}" if stop > start else "No similar content found nearby"
+            raise ValueError(f"Quote not found in content starting from line {vague_span.start_line}: {quote!r}. Specified start line's content is {self.line_text(start_line)!r}. {closest}")
+
+        return Span(start=start, stop=stop, reason=vague_span.reason)
+
+    def _build_normalized(self) -> None:
+        """Collapse every run of whitespace in the content to a single space, remembering where each character came from"""
+        parts: list[str] = []
+        offsets = array('q')
+        prev_stop = 0
+        for token in re.finditer(r'\S+', self.content):
+            if parts:
+                parts.append(' ')
+                offsets.append(prev_stop)
+            parts.append(token.group())
+            offsets.extend(range(token.start(), token.end()))
+            prev_stop = token.end()
+        self._normalized = ''.join(parts)
+        self._normalized_offsets = offsets
+
+    def _normalized_index(self, offset: int) -> int:
+        """Index in the normalized content of the first character at or after the given content offset"""
+        assert self._normalized_offsets is not None
+        return bisect_left(self._normalized_offsets, offset)
+
+    def _to_content_range(self, start: int, stop: int) -> tuple[int, int]:
+        """Convert a (non-empty) range of the normalized content back to a range of the original content"""
+        assert self._normalized_offsets is not None
+        return self._normalized_offsets[start], self._normalized_offsets[stop - 1] + 1
+
+    def _find_normalized(self, normalized_quote: str, start_line: int, first_line: int) -> tuple[int, int] | None:
+        if self._normalized is None:
+            self._build_normalized()
+        assert self._normalized is not None
+
+        line_start = self._normalized_index(self.line_offset(start_line))
+        start = self._normalized.find(normalized_quote, line_start)
+        if start == -1:
+            window_start = self._normalized_index(self.line_offset(first_line))
+            start = self._normalized.rfind(normalized_quote, window_start, line_start + len(normalized_quote) - 1)
+        if start == -1:
+            return None
+        return self._to_content_range(start, start + len(normalized_quote))
+
+    def _align(self, normalized_quote: str, first_line: int, last_line: int) -> tuple[int, int, float]:
+        """
+        Find the region of the normalized content within the given lines that best aligns with the quote.
+
+        Returns:
+            tuple[int, int, float]: start and stop of the region in the original content, and its similarity score from 0.0 to 1.0
+        """
+        assert self._normalized is not None
+        window_start = self._normalized_index(self.line_offset(first_line))
+        window_stop = self._normalized_index(self.line_stops[last_line - 1])
+        window = self._normalized[window_start:window_stop]
+        if not window:
+            return 0, 0, 0.0
+
+        # anchor the quote on its longest exact overlap with the window
+        anchor = SequenceMatcher(None, window, normalized_quote, autojunk=False).find_longest_match(0, len(window), 0, len(normalized_quote))
+        if anchor.size == 0:
+            return 0, 0, 0.0
+
+        # align the whole quote around the anchor, leaving some slack for insertions/deletions
+        slack = len(normalized_quote) // 4 + 1
+        lo = max(anchor.a - anchor.b - slack, 0)
+        hi = min(anchor.a - anchor.b + len(normalized_quote) + slack, len(window))
+        blocks = [block for block in SequenceMatcher(None, window[lo:hi], normalized_quote, autojunk=False).get_matching_blocks() if block.size]
+        first, last = blocks[0], blocks[-1]
+        start = lo + max(first.a - first.b, 0)
+        stop = lo + min(last.a + len(normalized_quote) - last.b, hi - lo)
+        while start < stop and window[start] == ' ':
+            start += 1
+        while stop > start and window[stop - 1] == ' ':
+            stop -= 1
+        if start == stop:
+            return 0, 0, 0.0
+
+        score = SequenceMatcher(None, window[start:stop], normalized_quote, autojunk=False).ratio()
+        return *self._to_content_range(window_start + start, window_start + stop), score
+
+
 def pinpoint_span(vague_span:VagueSpan, content:str, match_tolerance:float=0.9) -> Span:
     """
     Convert a vague span (given by an LLM) into a concrete span for the given content.
-    > Note: ideally the vague span's quote would be an exact substring within content,
-    >       however this function can tolerate minor mismatches
+    > Note: when resolving several spans over the same content, build a single `SpanResolver` and reuse it instead
 
     Args:
         vague_span (VagueSpan): The vague span with start line and quote of the content to highlight.
@@ -80,19 +308,7 @@ def pinpoint_span(vague_span:VagueSpan, content:str, match_tolerance:float=0.9)
     Returns:
         Span: A concrete span with start and stop indices.
     """
-    lines = content.splitlines()
-    start_line = vague_span.start_line - 1
-    prefix = '\n'.join(lines[:start_line])  # everything before the start line
-    subset = '\n'.join(lines[start_line:])  # everything from the start line onwards
-    
-    # TODO: better more tolerant matching here
-    subset_start = subset.find(vague_span.quote)
-    if subset_start == -1:
-        raise ValueError(f"Quote not found in content starting from line {vague_span.start_line}: {vague_span.quote!r}. Specified start line's content is {lines[start_line]!r}")
-    
-    start = len(prefix) + subset_start + int(start_line > 0)
-    stop = start + len(vague_span.quote)
-    return Span(start=start, stop=stop, reason=vague_span.reason)
+    return SpanResolver(content).resolve(vague_span, match_tolerance)
 
 
 
@@ -102,3 +318,13 @@ def add_line_numbers(program:str) -> str:
     lines = program.splitlines()
     width = len(str(len(lines) + start_index - 1)) # maximum width of the line numbers being added
     return '\n'.join([f"{i:>{width}}| {line}" for i, line in enumerate(lines, start_index)])
+
+
+def estimate_tokens(messages: list) -> int:
+    """rough token count of chat messages (~4 characters per token), including any tool calls"""
+    chars = 0
+    for message in messages:
+        chars += len(str(message.content))
+        if tool_calls := getattr(message, 'tool_calls', None):
+            chars += len(json.dumps([call['args'] for call in tool_calls]))
+    return chars // 4